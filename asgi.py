@@ -0,0 +1,239 @@
+"""ASGI serving mode for the song app (`python msetton.py serve_async`).
+
+The Flask views, models and templates are reused as they are: each request is
+handed to the WSGI app on a bounded thread pool. What changes is where the
+waiting happens. A song search first checks the saved songs and, if iTunes is
+needed, awaits all the search variants on the event loop (with httpx when it
+is installed) and stores the results in the search cache the sync view reads,
+so no thread sits blocked on iTunes. Concurrent searches for the same term share
+one fetch, and the wait for the rate limiter's go-ahead is awaited too. Email was already moved off the request
+path by the outbox (mail_queue.py), so song_status, send_song and
+send_from_friends only do their database work on the pool. Response bodies
+are sent as the view produces them, so streamed pages stay streamed.
+"""
+import asyncio
+import io
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+try:
+    import httpx
+except ImportError:  # optional, without it iTunes calls run on the thread pool instead
+    httpx = None
+
+from cache import normalize_term
+from itunes import parse_search_results, ITunesUnavailable, MAX_LIMIT
+from rate_limit import Throttled
+
+STREAM_CHUNK = 16 * 1024  # bytes of a streamed response sent at a time
+
+
+def _environ(scope, body):
+    server = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', ''),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    if scope.get('client'):
+        environ['REMOTE_ADDR'] = scope['client'][0]
+    for name, value in scope['headers']:
+        name = name.decode('latin-1')
+        value = value.decode('latin-1')
+        if name == 'content-length':
+            key = 'CONTENT_LENGTH'
+        elif name == 'content-type':
+            key = 'CONTENT_TYPE'
+        else:
+            key = 'HTTP_' + name.upper().replace('-', '_')
+        if key in environ:
+            value = environ[key] + ('; ' if key == 'HTTP_COOKIE' else ',') + value
+        environ[key] = value
+    return environ
+
+
+class AsyncSongApp(object):
+
+    def __init__(self, flask_app, itunes, local_search=None, threads=16):
+        self.flask_app = flask_app
+        self.itunes = itunes
+        self.local_search = local_search  # local_search(term, number) -> hits or None, see msetton.py
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.http = None
+        self._inflight = {}  # (term, limit) -> task fetching it, for searches arriving while it runs
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self._open_http()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.http is not None:
+                    await self.http.aclose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    def _open_http(self):
+        if httpx is not None and self.http is None:
+            connect, read = self.itunes.timeout
+            self.http = httpx.AsyncClient(timeout=httpx.Timeout(read, connect=connect),
+                                          limits=httpx.Limits(max_connections=self.itunes.pool_size))
+
+    ## Requests
+
+    async def _http(self, scope, receive, send):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        if scope['path'].startswith('/song/'):
+            await self._warm_search(scope, body)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(self.executor, self._run_wsgi, _environ(scope, body), loop, send)
+
+    def _run_wsgi(self, environ, loop, send):
+        """Runs the WSGI app on this pool thread and sends each chunk of the body as it is produced, so streamed
+        responses (/all_songs?stream=1) go out as they are generated. The whole body is iterated on this one thread:
+        streamed views keep their request context and db session in thread locals."""
+        response = {}
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+
+        def emit(body, more_body):
+            # waits until the server has taken the chunk, so a slow client slows the view down instead of filling memory
+            start = None
+            if not response.get('started'):
+                response['started'] = True
+                start = {'type': 'http.response.start', 'status': response['status'],
+                         'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                     for name, value in response['headers']]}
+            asyncio.run_coroutine_threadsafe(self._send_body(send, start, body, more_body), loop).result()
+
+        chunks = self.flask_app.wsgi_app(environ, start_response)
+        try:
+            # templates stream in pieces of a few bytes, so they are gathered up to STREAM_CHUNK before each send;
+            # whatever is left goes out last, with more_body=False
+            pending, size = [], 0
+            for chunk in chunks:
+                if size >= STREAM_CHUNK:
+                    emit(b''.join(pending), True)
+                    pending, size = [], 0
+                pending.append(chunk)
+                size += len(chunk)
+            emit(b''.join(pending), False)
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+    @staticmethod
+    async def _send_body(send, start, body, more_body):
+        if start is not None:
+            await send(start)
+        await send({'type': 'http.response.body', 'body': body, 'more_body': more_body})
+
+    ## Song search
+
+    async def _warm_search(self, scope, body):
+        """Fetches the search from iTunes on the event loop if song_input is going to need it"""
+        query = parse_qs(scope['query_string'].decode('latin-1'))
+        if scope['method'] == 'POST':
+            term = parse_qs(body.decode('utf-8', 'replace')).get('song', [''])[0]
+        else:
+            term = query.get('q', [''])[0]
+        term = normalize_term(term)
+        if not term:
+            return
+        number = 5 if scope['path'] == '/song/normal' else 10
+        try:
+            page = max(int(query.get('page', ['0'])[0]), 0)
+        except ValueError:
+            page = 0
+        loop = asyncio.get_running_loop()
+        if page == 0 and self.local_search is not None:
+            local = await loop.run_in_executor(self.executor, self._local_search, term, number)
+            if local is not None:
+                return
+        limit = min(MAX_LIMIT, max(self.itunes.page_size, (page + 1) * number))
+        if not self.itunes.needs_fetch(term, limit):
+            return
+        key = (term, limit)
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.ensure_future(self._fetch_search(term, limit))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        else:
+            self.itunes._count('coalesced')
+        await asyncio.shield(task)  # a client going away doesn't cancel the fetch for the others
+
+    async def _fetch_search(self, term, limit):
+        if not self.itunes.breaker.allow():
+            return  # iTunes is failing and the view will serve what it has
+        if self.itunes.limiter is not None:
+            loop = asyncio.get_running_loop()
+            try:
+                wait = await loop.run_in_executor(self.executor, self.itunes.limiter.reserve,
+                                                  len(self.itunes.variants), self.itunes.limit_wait)
+            except Throttled:
+                return  # so will the view (which counts it) when it finds nothing new stored
+            await asyncio.sleep(wait)
+        self.itunes._count('fetches')
+        outcomes = await asyncio.gather(*[self._fetch(term, limit, params) for params in self.itunes.variants],
+                                        return_exceptions=True)
+        try:
+            entry = self.itunes.merge(term, limit, list(outcomes))
+        except ITunesUnavailable:
+            self.itunes.breaker.record_failure()
+        else:
+            self.itunes.store(term, entry)
+
+    def _local_search(self, term, number):
+        with self.flask_app.app_context():
+            return self.local_search(term, number)
+
+    async def _fetch(self, term, limit, params):
+        if self.http is None:
+            self._open_http()
+        if self.http is None:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.itunes.executor, self.itunes._fetch, term, limit, params)
+        response = await self.http.get(self.itunes.base_url, params=dict(params, term=term, limit=limit))
+        response.raise_for_status()
+        return parse_search_results(response.content)
+
+
+def run(app, host='127.0.0.1', port=5000, server='uvicorn'):
+    """Serves an ASGI app with uvicorn or hypercorn, whichever is asked for (and installed)"""
+    if server == 'uvicorn':
+        import uvicorn
+        uvicorn.run(app, host=host, port=port, lifespan='on')
+    elif server == 'hypercorn':
+        from hypercorn.asyncio import serve
+        from hypercorn.config import Config
+        config = Config()
+        config.bind = ['{}:{}'.format(host, port)]
+        asyncio.run(serve(app, config))
+    else:
+        raise ValueError('Unknown ASGI server: {}'.format(server))
@@ -0,0 +1,92 @@
+"""Song search throughput with the sync server and with the ASGI mode.
+
+Both servers get the same number of threads for the Flask views. Every
+search is for a term nobody has searched before, so each one goes to the
+(fake, slow) iTunes: the sync server holds a thread for the whole wait while
+the ASGI mode awaits iTunes on the event loop and only uses a thread to
+render the page.
+
+    python -m benchmarks.async_mode --itunes-latency 0.2 --threads 8 --concurrency 64
+"""
+import argparse
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from benchmarks import common
+from benchmarks.fakes import FakeITunes, FakeSMTP
+from benchmarks.routes import run_route
+from benchmarks.seed import seed
+
+
+def unique_searches(mode):
+    counter = [0]
+    lock = threading.Lock()
+
+    def driver(ctx, rng):
+        with lock:
+            counter[0] += 1
+            n = counter[0]
+        return 'POST', '/song/normal', {'data': {'song': 'unheard {} {} {}'.format(mode, n, rng.randrange(10 ** 6))}}
+    return driver
+
+
+def serve_async(asgi_app, host='127.0.0.1'):
+    """Runs asgi_app with uvicorn in a background thread on a free port; returns (base url, uvicorn server)"""
+    import uvicorn
+    sock = socket.socket()
+    sock.bind((host, 0))
+    server = uvicorn.Server(uvicorn.Config(asgi_app, lifespan='on', log_level='warning'))
+    thread = threading.Thread(target=server.run, kwargs={'sockets': [sock]})
+    thread.daemon = True
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    return 'http://{}:{}'.format(host, sock.getsockname()[1]), server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database', help='database URL (default: a fresh sqlite file)')
+    parser.add_argument('--threads', type=int, default=8, help='threads running Flask views in either mode')
+    parser.add_argument('--concurrency', type=int, default=64, help='clients searching at once')
+    parser.add_argument('--requests', type=int, default=300, help='searches per mode')
+    parser.add_argument('--itunes-latency', type=float, default=0.2, help='seconds the fake iTunes waits')
+    parser.add_argument('--modes', default='sync,async', help='comma separated subset of: sync, async')
+    parser.add_argument('--output', help='where to write the JSON results')
+    args = parser.parse_args(argv)
+
+    database = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    itunes = FakeITunes(latency=args.itunes_latency).start()
+    smtp = FakeSMTP().start()
+    # cheap password hashes: the 64 logins before the searches shouldn't eat the CPU being measured
+    m = common.load_app(database, itunes_url=itunes.url, smtp_port=smtp.port, PASSWORD_HASH_METHOD='pbkdf2:sha256:1000')
+    ctx = seed(m, users=args.concurrency, friends=0, songs=200, artists=50, albums=50)
+    from asgi import AsyncSongApp
+
+    results = {}
+    for mode in args.modes.split(','):
+        if mode == 'sync':
+            base_url, server = common.serve(m.app, threads=args.threads)
+        else:
+            base_url, server = serve_async(AsyncSongApp(m.app, m.itunes, m.local_search, threads=args.threads))
+        calls = itunes.calls
+        results[mode] = run_route(base_url, unique_searches(mode), ctx, args.concurrency, args.requests)
+        results[mode]['itunes_calls'] = itunes.calls - calls
+        print('{:6} {}'.format(mode, json.dumps(results[mode], sort_keys=True)))
+        if mode == 'sync':
+            server.shutdown()
+        else:
+            server.should_exit = True
+
+    config = dict((key, value) for key, value in vars(args).items() if key != 'output')
+    config['database'] = database.split('://')[0]
+    path = common.write_results('async_mode', {'config': config, 'modes': results}, args.output)
+    print('Results written to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
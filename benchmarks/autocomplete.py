@@ -0,0 +1,65 @@
+"""Micro-benchmark for the autocomplete prefix index.
+
+Builds a PrefixIndex from made-up songs (1M titles by default, no database)
+and times lookups for random prefixes of each length from 1 to 6 letters.
+
+    python -m benchmarks.autocomplete --titles 1000000 --lookups 20000
+"""
+import argparse
+import random
+import time
+
+from benchmarks import common
+
+WORDS = ('love heart night baby time fire dream girl dance light rain blue summer home road wild gold '
+         'river moon star sweet lonely crazy little high city forever sky ocean broken young money shadow '
+         'angel devil kiss storm paradise morning thunder memory echo island silver golden highway').split()
+
+
+def make_songs(titles, artists, albums, seed=0):
+    rng = random.Random(seed)
+    for i in range(titles):
+        title = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 4))).title() + ' {}'.format(i)
+        yield title, 'Artist {}'.format(rng.randrange(artists)), 'Album {}'.format(rng.randrange(albums))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--titles', type=int, default=1000000)
+    parser.add_argument('--artists', type=int, default=50000)
+    parser.add_argument('--albums', type=int, default=100000)
+    parser.add_argument('--lookups', type=int, default=20000, help='lookups per prefix length')
+    parser.add_argument('--limit', type=int, default=8, help='suggestions per lookup')
+    parser.add_argument('--output', help='where to write the JSON results')
+    args = parser.parse_args(argv)
+
+    common.load_path()
+    from prefix_index import PrefixIndex
+    songs = list(make_songs(args.titles, args.artists, args.albums))
+    index = PrefixIndex(max_entries=args.titles + args.artists + args.albums)
+    started = time.time()
+    index.add_songs(songs)
+    build_seconds = time.time() - started
+    stats = index.stats()
+    print('Built {entries} entries in {0:.1f}s, about {1:.0f} MB'.format(build_seconds, stats['approx_bytes'] / 1e6, **stats))
+
+    rng = random.Random(1)
+    lookups = {}
+    for length in range(1, 7):
+        prefixes = [rng.choice(songs)[rng.randrange(3)][:length] for _ in range(args.lookups)]
+        latencies = []
+        for prefix in prefixes:
+            started = time.time()
+            index.lookup(prefix, limit=args.limit)
+            latencies.append(time.time() - started)
+        lookups[str(length)] = common.summarize(latencies, sum(latencies))
+        print('prefix length {}: p50 {p50_ms}ms p99 {p99_ms}ms'.format(length, **lookups[str(length)]))
+
+    path = common.write_results('autocomplete', {'config': dict((k, v) for k, v in vars(args).items() if k != 'output'),
+                                                 'build_seconds': round(build_seconds, 3), 'index': stats,
+                                                 'lookups': lookups}, args.output)
+    print('Results written to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Commits per request on the save-a-song path (/song_status).
+
+Seeds a database, then sends /song_status requests one at a time, half for
+songs that are already saved and half for new ones, and counts the COMMITs
+the database sees for each request (from SQLAlchemy engine events, so it
+runs the same on older commits of the app). Reports commits and queries per
+request next to the latency.
+
+    python -m benchmarks.commits --requests 200
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import requests
+from sqlalchemy import event
+
+from benchmarks import common
+from benchmarks.fakes import FakeITunes, FakeSMTP
+from benchmarks.seed import seed
+
+
+def _choice(title, artist, album):
+    return ':'.join(value.replace(' ', '*') for value in (title, artist, album))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database', help='database URL (default: a fresh sqlite file)')
+    parser.add_argument('--songs', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=200, help='requests of each kind (existing and new songs)')
+    parser.add_argument('--output', help='where to write the JSON results')
+    args = parser.parse_args(argv)
+
+    database = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    itunes = FakeITunes().start()
+    smtp = FakeSMTP().start()
+    m = common.load_app(database, itunes_url=itunes.url, smtp_port=smtp.port)
+    ctx = seed(m, users=1, friends=0, songs=args.songs, artists=args.songs // 10, albums=args.songs // 5)
+    with m.app.app_context():
+        engine = m.db.get_engine()
+    commits = [0]
+    event.listen(engine, 'commit', lambda conn: commits.__setitem__(0, commits[0] + 1))
+    base_url, server = common.serve(m.app)
+
+    rng = random.Random(0)
+    kinds = {'existing': [rng.choice(ctx['tracks']) for _ in range(args.requests)],
+             'new': [('New song {}'.format(i), 'New artist {}'.format(i % 50), 'New album {}'.format(i % 100))
+                     for i in range(args.requests)]}
+    session = requests.Session()
+    results = {}
+    for kind, tracks in kinds.items():
+        latencies, queries, per_request = [], [], []
+        errors = 0
+        started = time.time()
+        for track in tracks:
+            before = commits[0]
+            request_started = time.time()
+            response = session.get(base_url + '/song_status', params={'choice': _choice(*track)})
+            latencies.append(time.time() - request_started)
+            per_request.append(commits[0] - before)
+            errors += response.status_code >= 400
+            if 'X-Query-Count' in response.headers:
+                queries.append(int(response.headers['X-Query-Count']))
+        results[kind] = common.summarize(latencies, time.time() - started, errors, queries)
+        results[kind]['commits_per_request'] = round(sum(per_request) / float(len(per_request)), 2)
+        results[kind]['max_commits'] = max(per_request)
+        print('{:9} {commits_per_request} commits/request, {queries_per_request} queries/request, '
+              'p50 {p50_ms}ms'.format(kind, **results[kind]))
+    server.shutdown()
+
+    config = dict((key, value) for key, value in vars(args).items() if key != 'output')
+    config['database'] = database.split('://')[0]
+    path = common.write_results('commits', {'config': config, 'song_status': results}, args.output)
+    print('Results written to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
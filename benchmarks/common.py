@@ -0,0 +1,118 @@
+"""Helpers shared by the benchmark scripts: loading the app against local fakes,
+serving it on a free port, latency summaries and writing results as JSON."""
+import datetime
+import importlib
+import json
+import os
+import subprocess
+import sys
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+
+def load_path():
+    """makes the app's modules importable when a benchmark runs from anywhere"""
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+
+def load_app(database_url, itunes_url=None, smtp_port=None, **env):
+    """Imports msetton configured for benchmarking. Config is read at import time, so the environment is set first."""
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['INSTRUMENTATION'] = 'true'  # for X-Query-Count
+    if itunes_url:
+        os.environ['ITUNES_SEARCH_URL'] = itunes_url
+    if smtp_port:
+        os.environ.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=str(smtp_port), MAIL_USE_TLS='false')
+    env.setdefault('ITUNES_CALLS_PER_MINUTE', 10 ** 6)  # measure the app, not the rate limit (see benchmarks.itunes_limits)
+    env.setdefault('ITUNES_RATE_BACKEND', 'memory')
+    os.environ.update(dict((key, str(value)) for key, value in env.items()))
+    load_path()
+    m = importlib.import_module('msetton')
+    m.app.config['WTF_CSRF_ENABLED'] = False
+    m.app.config['MAIL_SENDER'] = 'bench@example.com'
+    return m
+
+
+def serve(app, host='127.0.0.1', threads=None):
+    """Runs app in a threaded werkzeug server on a free port; returns (base url, server).
+    With `threads` the server handles at most that many requests at once, like a fixed pool of sync workers."""
+    from werkzeug.serving import make_server, WSGIRequestHandler, BaseWSGIServer
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_request(self, *args, **kwargs):
+            pass
+
+    if threads:
+        from concurrent.futures import ThreadPoolExecutor
+
+        class PooledServer(BaseWSGIServer):
+            pool = ThreadPoolExecutor(max_workers=threads)
+
+            def process_request(self, request, client_address):
+                self.pool.submit(self._handle, request, client_address)
+
+            def _handle(self, request, client_address):
+                try:
+                    self.finish_request(request, client_address)
+                except Exception:
+                    self.handle_error(request, client_address)
+                finally:
+                    self.shutdown_request(request)
+
+        server = PooledServer(host, 0, app, handler=QuietHandler)
+    else:
+        server = make_server(host, 0, app, threaded=True, request_handler=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://{}:{}'.format(host, server.server_port), server
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, elapsed, errors=0, queries=None):
+    """latencies in seconds -> dict with p50/p95/p99 in ms, throughput and mean queries per request"""
+    values = sorted(latencies)
+    result = {
+        'requests': len(values),
+        'errors': errors,
+        'throughput_rps': round(len(values) / elapsed, 2) if elapsed else None,
+        'mean_ms': round(sum(values) / len(values) * 1000, 3) if values else None,
+    }
+    for pct in (50, 95, 99):
+        value = percentile(values, pct)
+        result['p{}_ms'.format(pct)] = round(value * 1000, 3) if value is not None else None
+    if queries:
+        result['queries_per_request'] = round(sum(queries) / float(len(queries)), 2)
+    return result
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def write_results(name, data, output=None):
+    """Writes {'benchmark', 'commit', 'timestamp', ...data} as JSON and returns the path"""
+    commit = git_commit()
+    timestamp = datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%SZ')
+    result = dict(benchmark=name, commit=commit, timestamp=timestamp, python=sys.version.split()[0])
+    result.update(data)
+    if output is None:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, '{}-{}-{}.json'.format(name, commit or 'nogit', timestamp))
+    with open(output, 'w') as f:
+        json.dump(result, f, indent=2, sort_keys=True)
+    return output
@@ -0,0 +1,68 @@
+"""Enriching saved songs: iTunes calls and time per song, with and without track ids.
+
+Seeds a database, queues every song for enrichment and runs the enrich
+worker pool until the queue is empty, against the fake iTunes with
+--latency per call. Songs are queued with made-up iTunes track ids, as
+songs picked from a search are, or with --without-ids as imported ones are
+(the fake never finds those, so they end up missing). Reports songs per
+second and iTunes calls per song. The rate limit is lifted
+(--calls-per-minute) so the numbers show the work done, not the limit.
+
+    python -m benchmarks.enrichment --songs 2000
+    python -m benchmarks.enrichment --songs 200 --without-ids
+"""
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks import common
+from benchmarks.fakes import FakeITunes, FakeSMTP
+from benchmarks.seed import seed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database', help='database URL (default: a fresh sqlite file)')
+    parser.add_argument('--songs', type=int, default=2000)
+    parser.add_argument('--without-ids', action='store_true', help='queue songs without iTunes track ids (one search each)')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds the fake iTunes takes per call')
+    parser.add_argument('--calls-per-minute', type=int, default=600000)
+    parser.add_argument('--output', help='where to write the JSON results')
+    args = parser.parse_args(argv)
+
+    database = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    itunes = FakeITunes(latency=args.latency).start()
+    smtp = FakeSMTP().start()
+    m = common.load_app(database, itunes_url=itunes.url, smtp_port=smtp.port,
+                        ENRICH_WORKERS=args.workers, ENRICH_CALLS_PER_MINUTE=args.calls_per_minute)
+    seed(m, users=1, friends=0, songs=args.songs, artists=args.songs // 10, albums=args.songs // 5)
+    with m.app.app_context():
+        song_ids = [song_id for song_id, in m.db.session.query(m.Song.id).order_by(m.Song.id)]
+        track_ids = None if args.without_ids else [100000 + song_id for song_id in song_ids]
+        m.queue_enrichment(m.db.session, song_ids, track_ids)
+        m.db.session.commit()
+
+    m.enricher.poll_every = 0.1
+    calls = itunes.calls
+    started = time.time()
+    stats = m.enricher.run(until_empty=True)
+    elapsed = time.time() - started
+    with m.app.app_context():
+        counts = m.enricher.counts()
+    results = {'seconds': round(elapsed, 3), 'songs_per_second': round(len(song_ids) / elapsed, 1),
+               'itunes_calls': itunes.calls - calls,
+               'calls_per_song': round((itunes.calls - calls) / float(len(song_ids)), 3),
+               'jobs': counts, 'workers': stats}
+    print('{} songs in {seconds}s ({songs_per_second} songs/s), {itunes_calls} iTunes calls '
+          '({calls_per_song} per song), jobs {jobs}'.format(len(song_ids), **results))
+
+    config = dict((key, value) for key, value in vars(args).items() if key != 'output')
+    config['database'] = database.split('://')[0]
+    path = common.write_results('enrichment', {'config': config, 'results': results}, args.output)
+    print('Results written to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
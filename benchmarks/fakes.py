@@ -0,0 +1,160 @@
+"""Local stand-ins for iTunes and the SMTP server so benchmarks never leave the machine.
+
+    itunes = FakeITunes(latency=0.05).start()   # itunes.url -> ITUNES_SEARCH_URL
+    smtp = FakeSMTP().start()                   # smtp.port  -> MAIL_PORT, with MAIL_USE_TLS=false
+"""
+import json
+import socketserver
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # the default of 5 drops connections when many searches fan out at once
+
+
+class FakeITunes(object):
+    """Answers /search like iTunes does, with `results` made-up tracks for any term after `latency` seconds,
+    and /lookup with a made-up track for every id"""
+
+    def __init__(self, latency=0.0, results=10, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.results = results
+        self.calls = 0
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real API
+            disable_nagle_algorithm = True  # headers and body go out in separate writes
+
+            def do_GET(self):
+                fake.calls += 1
+                url = urlparse(self.path)
+                query = parse_qs(url.query)
+                if fake.latency:
+                    time.sleep(fake.latency)
+                if url.path.endswith('/lookup'):
+                    payload = fake.lookup_payload([int(i) for i in query.get('id', [''])[0].split(',') if i])
+                else:
+                    term = query.get('term', [''])[0]
+                    limit = int(query.get('limit', [fake.results])[0])
+                    payload = fake.payload(term, min(limit, fake.results))
+                body = json.dumps(payload).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/javascript; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _ThreadingHTTPServer((host, port), Handler)
+
+    @property
+    def url(self):
+        return 'http://{}:{}/search'.format(*self.server.server_address)
+
+    def payload(self, term, count):
+        title = term.title() or 'Untitled'
+        results = [self.track(1000 + i, title, 'Artist {}'.format(i), 'Album {}'.format(i)) for i in range(count)]
+        return {'resultCount': len(results), 'results': results}
+
+    def lookup_payload(self, track_ids):
+        results = [self.track(track_id, 'Track {}'.format(track_id), 'Artist {}'.format(track_id % 100),
+                              'Album {}'.format(track_id % 500)) for track_id in track_ids]
+        return {'resultCount': len(results), 'results': results}
+
+    def track(self, track_id, title, artist, album):
+        return {'wrapperType': 'track', 'kind': 'song', 'trackId': track_id, 'trackName': title,
+                'artistName': artist, 'artistId': zlib.crc32(artist.encode('utf-8')), 'collectionName': album,
+                'collectionCensoredName': album, 'collectionId': zlib.crc32(album.encode('utf-8')),
+                'trackTimeMillis': 180000 + track_id % 60000, 'primaryGenreName': 'Pop',
+                'artworkUrl100': 'http://example.com/{}/100x100bb.jpg'.format(track_id)}
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeSMTP(object):
+    """Accepts every message and keeps (sender, recipients) in `messages`. Plain SMTP only, no TLS or auth.
+    Recipients in `refused` are turned down with a 550, like an address the server doesn't know."""
+
+    def __init__(self, latency=0.0, host='127.0.0.1', port=0, refused=()):
+        self.latency = latency
+        self.refused = set(refused)
+        self.messages = []
+        self.connections = 0
+        fake = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def reply(self, line):
+                self.wfile.write((line + '\r\n').encode('ascii'))
+
+            def handle(self):
+                fake.connections += 1
+                sender, recipients = None, []
+                self.reply('220 fake smtp ready')
+                while True:
+                    line = self.rfile.readline()
+                    if not line:
+                        return
+                    command = line.decode('utf-8', 'replace').strip()
+                    verb = command[:4].upper()
+                    if verb in ('HELO', 'EHLO'):
+                        self.reply('250 fake')
+                    elif verb == 'MAIL':
+                        sender, recipients = command[10:].strip(), []
+                        self.reply('250 OK')
+                    elif verb == 'RCPT':
+                        recipient = command[8:].strip()
+                        if recipient.strip('<>') in fake.refused:
+                            self.reply('550 No such user')
+                            continue
+                        recipients.append(recipient)
+                        self.reply('250 OK')
+                    elif verb == 'DATA':
+                        self.reply('354 End data with <CR><LF>.<CR><LF>')
+                        while self.rfile.readline().rstrip(b'\r\n') != b'.':
+                            pass
+                        if fake.latency:
+                            time.sleep(fake.latency)
+                        fake.messages.append((sender, recipients))
+                        self.reply('250 OK queued')
+                    elif verb == 'QUIT':
+                        self.reply('221 Bye')
+                        return
+                    else:  # RSET, NOOP and anything else
+                        self.reply('250 OK')
+
+        class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+            daemon_threads = True
+            allow_reuse_address = True
+
+        self.server = Server((host, port), Handler)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
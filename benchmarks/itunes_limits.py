@@ -0,0 +1,99 @@
+"""Single-flight searches and the iTunes rate limit: upstream calls, throttled searches and waits.
+
+First --clients threads search at once for --terms different terms nobody
+has searched before (so most clients share a term with others), against the
+fake iTunes with --latency per call; without single flight every client
+would make its own calls. Then --searches different terms are searched at
+once under a limit of --calls-per-minute (--burst at once), through the
+limiter shared by worker processes (a sqlite file), and it reports how many
+went to iTunes, how many were throttled and how long the others waited.
+
+    python -m benchmarks.itunes_limits --clients 50 --terms 5
+    python -m benchmarks.itunes_limits --searches 30 --calls-per-minute 60 --burst 12
+"""
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from benchmarks import common
+from benchmarks.fakes import FakeITunes
+
+
+def search_all(m, terms):
+    """searches every term on its own thread, all released at once; returns [(seconds, outcome)]"""
+    from itunes import ITunesUnavailable
+    start = threading.Event()
+    results = [None] * len(terms)
+
+    def run(i, term):
+        start.wait()
+        began = time.time()
+        try:
+            outcome = 'served' if m.itunes.search(term) else 'empty'
+        except ITunesUnavailable:
+            outcome = 'unavailable'
+        results[i] = (time.time() - began, outcome)
+    threads = [threading.Thread(target=run, args=(i, term)) for i, term in enumerate(terms)]
+    for thread in threads:
+        thread.start()
+    start.set()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--terms', type=int, default=5)
+    parser.add_argument('--searches', type=int, default=30)
+    parser.add_argument('--calls-per-minute', type=float, default=60)
+    parser.add_argument('--burst', type=int, default=12)
+    parser.add_argument('--wait', type=float, default=3, help='seconds a search may wait for its turn')
+    parser.add_argument('--latency', type=float, default=0.1, help='seconds the fake iTunes takes per call')
+    parser.add_argument('--output', help='where to write the JSON results')
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp()
+    itunes = FakeITunes(latency=args.latency).start()
+    m = common.load_app('sqlite:///' + os.path.join(tmp, 'bench.sqlite'), itunes_url=itunes.url)
+    from rate_limit import make_limiter
+    variants = len(m.itunes.variants)
+    results = {}
+
+    calls, stats = itunes.calls, dict(m.itunes.stats)
+    outcomes = search_all(m, ['hot term {}'.format(i % args.terms) for i in range(args.clients)])
+    results['hot'] = {'itunes_calls': itunes.calls - calls, 'without_single_flight': args.clients * variants,
+                      'coalesced': m.itunes.stats['coalesced'] - stats['coalesced'],
+                      'max_ms': round(max(seconds for seconds, _ in outcomes) * 1000, 1)}
+    print('hot:     {clients} clients, {terms} terms: {itunes_calls} iTunes calls instead of {without}, '
+          '{coalesced} searches coalesced'.format(clients=args.clients, terms=args.terms,
+                                                   without=results['hot']['without_single_flight'], **results['hot']))
+
+    m.itunes.limiter = make_limiter('sqlite', args.calls_per_minute, burst=args.burst,
+                                    path=os.path.join(tmp, 'rate_limit.sqlite'), name='itunes_search')
+    m.itunes.limit_wait = args.wait
+    calls, stats = itunes.calls, dict(m.itunes.stats)
+    outcomes = search_all(m, ['cold term {}'.format(i) for i in range(args.searches)])
+    waits = sorted(seconds for seconds, outcome in outcomes if outcome == 'served')
+    limiter = m.itunes.limiter.stats.as_dict()
+    results['limited'] = {'itunes_calls': itunes.calls - calls,
+                          'fetched': m.itunes.stats['fetches'] - stats['fetches'],
+                          'throttled': m.itunes.stats['throttled'] - stats['throttled'],
+                          'unavailable': sum(1 for _, outcome in outcomes if outcome == 'unavailable'),
+                          'delayed': limiter['delayed'],
+                          'p50_ms': round(common.percentile(waits, 50) * 1000, 1) if waits else None,
+                          'max_ms': round(waits[-1] * 1000, 1) if waits else None}
+    print('limited: {} searches at {} calls/min (burst {}): {fetched} fetched ({itunes_calls} calls, {delayed} after '
+          'waiting, max {max_ms}ms), {throttled} throttled'.format(args.searches, args.calls_per_minute, args.burst,
+                                                                   **results['limited']))
+
+    config = dict((key, value) for key, value in vars(args).items() if key != 'output')
+    path = common.write_results('itunes_limits', {'config': config, 'results': results}, args.output)
+    print('Results written to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
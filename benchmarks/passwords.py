@@ -0,0 +1,63 @@
+"""Logins per second per core for each password hashing setting.
+
+Times check_password_hash on one thread (one core) for each method, then
+through a PasswordHasher pool with --workers threads, which is what /login
+does under a burst of logins.
+
+    python -m benchmarks.passwords --methods pbkdf2:sha256:50000,pbkdf2:sha256:260000
+"""
+import argparse
+import os
+import threading
+import time
+
+from benchmarks import common
+
+DEFAULT_METHODS = 'pbkdf2:sha256:50000,pbkdf2:sha256:150000,pbkdf2:sha256:260000,pbkdf2:sha512:150000'
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--methods', default=DEFAULT_METHODS, help='comma separated werkzeug hash methods')
+    parser.add_argument('--logins', type=int, default=50, help='verifications per setting')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='pool size for the concurrent run')
+    parser.add_argument('--output', help='where to write the JSON results')
+    args = parser.parse_args(argv)
+
+    common.load_path()
+    from werkzeug.security import check_password_hash
+    from passwords import PasswordHasher
+
+    results = {}
+    for method in args.methods.split(','):
+        hasher = PasswordHasher(method, workers=args.workers)
+        pwhash = hasher.hash('correct horse battery staple')
+
+        latencies = []
+        for _ in range(args.logins):
+            started = time.time()
+            check_password_hash(pwhash, 'correct horse battery staple')
+            latencies.append(time.time() - started)
+        single = common.summarize(latencies, sum(latencies))
+
+        started = time.time()
+        threads = [threading.Thread(target=hasher.verify, args=[pwhash, 'correct horse battery staple'])
+                   for _ in range(args.logins)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        pooled = args.logins / (time.time() - started)
+
+        results[method] = {'logins_per_second_per_core': single['throughput_rps'], 'verify_p50_ms': single['p50_ms'],
+                           'verify_p99_ms': single['p99_ms'], 'pooled_logins_per_second': round(pooled, 2)}
+        print('{:28} {:8.1f} logins/s/core  {:8.1f} logins/s with {} workers'.format(
+            method, single['throughput_rps'], pooled, args.workers))
+
+    path = common.write_results('passwords', {'config': {'logins': args.logins, 'workers': args.workers},
+                                              'methods': results}, args.output)
+    print('Results written to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""Repeat views of the listing pages with and without HTTP caching.
+
+Seeds a database, logs in and fetches /all_songs and /see_friends over and
+over in three ways: a GET without compression, a GET accepting gzip/brotli
+and a conditional GET with the ETag from the first response (answered 304).
+Reports latency and bytes per response for each. With --fragment-cache 0
+every full GET renders the page again, which is what every view cost before.
+
+    python -m benchmarks.repeat_views --requests 500 --friends 200
+    python -m benchmarks.repeat_views --fragment-cache 0
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import requests
+
+from benchmarks import common
+from benchmarks.fakes import FakeITunes, FakeSMTP
+from benchmarks.seed import seed, email_for, PASSWORD
+
+MODES = {
+    'uncompressed': {'Accept-Encoding': 'identity'},
+    'compressed': {'Accept-Encoding': 'gzip, br'},
+    'conditional': {'Accept-Encoding': 'gzip, br'},  # plus If-None-Match
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database', help='database URL (default: a fresh sqlite file)')
+    parser.add_argument('--songs', type=int, default=5000)
+    parser.add_argument('--friends', type=int, default=100, help='saved friends of the logged in user')
+    parser.add_argument('--requests', type=int, default=300, help='requests per route and mode')
+    parser.add_argument('--fragment-cache', type=int, default=256, help='rendered pages kept, 0 to turn the cache off')
+    parser.add_argument('--output', help='where to write the JSON results')
+    args = parser.parse_args(argv)
+
+    database = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    itunes = FakeITunes().start()
+    smtp = FakeSMTP().start()
+    m = common.load_app(database, itunes_url=itunes.url, smtp_port=smtp.port, FRAGMENT_CACHE_SIZE=str(args.fragment_cache))
+    ctx = seed(m, users=1, friends=args.friends, songs=args.songs, artists=args.songs // 10, albums=args.songs // 5)
+    base_url, server = common.serve(m.app)
+    session = requests.Session()
+    session.post(base_url + '/login', data={'email': email_for(0), 'password': PASSWORD}, allow_redirects=False)
+    # /see_friends holds a form, so it is only cached while the session has a CSRF token: turn CSRF back on (after
+    # logging in without one), and the first GET of each page below puts the token in the session
+    m.app.config['WTF_CSRF_ENABLED'] = True
+
+    title, artist, _ = ctx['tracks'][0]
+    routes = {'all_songs': '/all_songs',
+              'see_friends': '/see_friends/{}/{}'.format(title.replace(' ', '*'), artist.replace(' ', '*'))}
+    results = {}
+    for route, path in routes.items():
+        results[route] = {}
+        session.get(base_url + path)
+        etag = session.get(base_url + path).headers.get('ETag')
+        if not etag:
+            server.shutdown()
+            sys.exit('{} sent no ETag, so it is not being cached and the numbers would mean nothing'.format(path))
+        for mode, headers in MODES.items():
+            headers = dict(headers)
+            if mode == 'conditional' and etag:
+                headers['If-None-Match'] = etag
+            latencies, sizes = [], []
+            errors = 0
+            started = time.time()
+            for _ in range(args.requests):
+                request_started = time.time()
+                response = session.get(base_url + path, headers=headers, stream=True)
+                body = response.raw.read()  # as sent, before requests would decompress it
+                latencies.append(time.time() - request_started)
+                sizes.append(len(body))
+                errors += response.status_code not in (200, 304)
+            results[route][mode] = common.summarize(latencies, time.time() - started, errors)
+            results[route][mode]['bytes_per_response'] = sum(sizes) // len(sizes)
+            print('{:12} {:12} p50 {p50_ms}ms  {bytes_per_response} bytes'.format(route, mode, **results[route][mode]))
+    server.shutdown()
+
+    config = dict((key, value) for key, value in vars(args).items() if key != 'output')
+    config['database'] = database.split('://')[0]
+    fragments = m.http_cache.fragments.stats.as_dict() if m.http_cache.fragments is not None else None
+    path = common.write_results('repeat_views', {'config': config, 'routes': results, 'fragment_cache': fragments},
+                                args.output)
+    print('Results written to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
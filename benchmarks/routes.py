@@ -0,0 +1,147 @@
+"""Load test for the core routes.
+
+Seeds a database, points the app at local fake iTunes and SMTP servers, serves
+it with a threaded werkzeug server and hits each route from several threads.
+Reports p50/p95/p99 latency, throughput and queries per request, and writes
+everything as JSON (benchmarks/results/ by default) to compare commits.
+
+    python -m benchmarks.routes --songs 20000 --concurrency 16 --requests 500
+    python -m benchmarks.routes --routes all_songs,see_friends --database postgresql://localhost/songs_bench
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+
+import requests
+
+from benchmarks import common
+from benchmarks.fakes import FakeITunes, FakeSMTP
+from benchmarks.seed import seed, email_for, PASSWORD
+
+
+def _star(value):
+    return value.replace(' ', '*')
+
+
+# Each driver returns the request to make: (method, path, keyword arguments for requests)
+def song_search(ctx, rng):
+    title = rng.choice(ctx['tracks'])[0]
+    return 'POST', '/song/normal', {'data': {'song': title}}
+
+
+def song_status(ctx, rng):
+    title, artist, album = rng.choice(ctx['tracks'])
+    return 'GET', '/song_status', {'params': {'choice': ':'.join([_star(title), _star(artist), _star(album)])}}
+
+
+def all_songs(ctx, rng):
+    return 'GET', '/all_songs', {}
+
+
+def see_friends(ctx, rng):
+    title, artist, _ = rng.choice(ctx['tracks'])
+    return 'GET', '/see_friends/{}/{}'.format(_star(title), _star(artist)), {}
+
+
+def login(ctx, rng):
+    return 'POST', '/login', {'data': {'email': email_for(rng.randrange(ctx['users'])), 'password': PASSWORD}}
+
+
+def add_friends(ctx, rng):
+    n = rng.randrange(10 ** 9)
+    return 'GET', '/add_friends', {'params': {'name': 'New friend {}'.format(n), 'email': 'new{}@example.com'.format(n)}}
+
+
+ROUTES = [('song_search', song_search), ('song_status', song_status), ('all_songs', all_songs),
+          ('see_friends', see_friends), ('login', login), ('add_friends', add_friends)]
+
+
+def _log_in(session, base_url, user):
+    response = session.post(base_url + '/login', data={'email': email_for(user), 'password': PASSWORD},
+                            allow_redirects=False)
+    if response.status_code != 302:
+        raise RuntimeError('Could not log in as {}'.format(email_for(user)))
+
+
+def run_route(base_url, driver, ctx, concurrency, total):
+    """Sends `total` requests from `concurrency` logged-in threads; returns the summary dict"""
+    latencies, queries = [], []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [total]
+
+    def worker(n):
+        rng = random.Random(n)
+        session = requests.Session()
+        _log_in(session, base_url, n % ctx['users'])
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            method, path, kwargs = driver(ctx, rng)
+            started = time.time()
+            response = session.request(method, base_url + path, allow_redirects=False, **kwargs)
+            elapsed = time.time() - started
+            with lock:
+                if response.status_code >= 400 or '/login' in response.headers.get('Location', ''):
+                    errors[0] += 1
+                else:
+                    latencies.append(elapsed)
+                if 'X-Query-Count' in response.headers:
+                    queries.append(int(response.headers['X-Query-Count']))
+
+    threads = [threading.Thread(target=worker, args=[n]) for n in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return common.summarize(latencies, time.time() - started, errors[0], queries)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database', help='database URL (default: a fresh sqlite file)')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--friends', type=int, default=20, help='saved friends per user')
+    parser.add_argument('--songs', type=int, default=5000)
+    parser.add_argument('--artists', type=int, default=500)
+    parser.add_argument('--albums', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=200, help='requests per route')
+    parser.add_argument('--itunes-latency', type=float, default=0.0, help='seconds the fake iTunes waits')
+    parser.add_argument('--routes', help='comma separated subset of: ' + ', '.join(name for name, _ in ROUTES))
+    parser.add_argument('--output', help='where to write the JSON results')
+    args = parser.parse_args(argv)
+
+    database = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    itunes = FakeITunes(latency=args.itunes_latency).start()
+    smtp = FakeSMTP().start()
+    m = common.load_app(database, itunes_url=itunes.url, smtp_port=smtp.port)
+    ctx = seed(m, users=args.users, friends=args.friends, songs=args.songs, artists=args.artists, albums=args.albums)
+    base_url, server = common.serve(m.app)
+
+    wanted = set(args.routes.split(',')) if args.routes else None
+    results = {}
+    for name, driver in ROUTES:
+        if wanted and name not in wanted:
+            continue
+        results[name] = run_route(base_url, driver, ctx, args.concurrency, args.requests)
+        print('{:12} {}'.format(name, json.dumps(results[name], sort_keys=True)))
+    server.shutdown()
+
+    config = dict((key, value) for key, value in vars(args).items() if key != 'output')
+    config['database'] = database.split('://')[0]
+    path = common.write_results('routes', {'config': config, 'routes': results,
+                                           'upstream_calls': {'itunes': itunes.calls, 'smtp_messages': len(smtp.messages)}},
+                                args.output)
+    print('Results written to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
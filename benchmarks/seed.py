@@ -0,0 +1,34 @@
+"""Fills a database with made-up users, friends, songs, artists and albums for benchmarking."""
+
+PASSWORD = 'benchmark'
+
+
+def email_for(i):
+    return 'user{}@example.com'.format(i)
+
+
+def seed(m, users=50, friends=20, songs=5000, artists=500, albums=1000, chunk=1000):
+    """m is the imported msetton module. Tables are dropped and recreated first.
+    Returns a dict describing what was created, used by the route drivers."""
+    from werkzeug.security import generate_password_hash
+    with m.app.app_context():
+        m.db.drop_all()
+        m.db.create_all()
+        password_hash = generate_password_hash(PASSWORD)  # hashing once keeps seeding fast
+        m.db.session.execute(m.User.__table__.insert(), [
+            {'username': 'user{}'.format(i), 'email': email_for(i), 'password_hash': password_hash}
+            for i in range(users)])
+        user_ids = [user_id for user_id, in m.db.session.query(m.User.id).order_by(m.User.id)]
+        people = [{'name': 'Friend {}'.format(j), 'email': 'friend{}.{}@example.com'.format(u, j), 'user_id': u}
+                  for u in user_ids for j in range(friends)]
+        for start in range(0, len(people), chunk):
+            m.db.session.execute(m.Person.__table__.insert(), people[start:start + chunk])
+        m.db.session.commit()
+
+        tracks = [('Song {}'.format(i), 'Artist {}'.format(i % artists), 'Album {}'.format(i % albums))
+                  for i in range(songs)]
+        for start in range(0, len(tracks), chunk):
+            m.bulk_get_or_create_songs(m.db.session, tracks[start:start + chunk])
+        m.db.session.commit()
+    return {'users': users, 'friends': friends, 'songs': songs, 'artists': artists, 'albums': albums,
+            'tracks': tracks[:1000]}
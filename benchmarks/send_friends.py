@@ -0,0 +1,83 @@
+"""Sending a song to every saved friend: one request per friend against one request for all of them.
+
+Seeds a user with --friends saved friends, logs in and sends a song to all
+of them through /send_from_friends, first with one email per request (the
+only way before multi-recipient sends) and then with every friend picked in
+a single request. Reports the time spent in requests, the time until the
+fake SMTP server has every message, the SMTP connections opened and the
+queries run. The fake SMTP server adds --smtp-latency per message.
+
+    python -m benchmarks.send_friends --friends 100
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import requests
+
+from benchmarks import common
+from benchmarks.fakes import FakeITunes, FakeSMTP
+from benchmarks.seed import seed, email_for, PASSWORD
+
+
+def wait_for(smtp, count, timeout=60):
+    deadline = time.time() + timeout
+    while len(smtp.messages) < count and time.time() < deadline:
+        time.sleep(0.01)
+    return len(smtp.messages) >= count
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--database', help='database URL (default: a fresh sqlite file)')
+    parser.add_argument('--friends', type=int, default=50, help='saved friends of the logged in user')
+    parser.add_argument('--smtp-latency', type=float, default=0.005, help='seconds the fake SMTP server takes per message')
+    parser.add_argument('--output', help='where to write the JSON results')
+    args = parser.parse_args(argv)
+
+    database = args.database or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.sqlite')
+    itunes = FakeITunes().start()
+    smtp = FakeSMTP(latency=args.smtp_latency).start()
+    m = common.load_app(database, itunes_url=itunes.url, smtp_port=smtp.port)
+    seed(m, users=1, friends=args.friends, songs=100, artists=10, albums=20)
+    with m.app.app_context():
+        emails = [email for _, email in m.friends_of(1)]
+    base_url, server = common.serve(m.app)
+    session = requests.Session()
+    session.post(base_url + '/login', data={'email': email_for(0), 'password': PASSWORD}, allow_redirects=False)
+    url = base_url + '/send_from_friends/Song*0/Artist*0'
+
+    modes = {'one_per_request': [[email] for email in emails], 'all_at_once': [emails]}
+    results = {}
+    for mode in ('one_per_request', 'all_at_once'):
+        del smtp.messages[:]
+        connections = smtp.connections
+        queries = []
+        errors = 0
+        started = time.time()
+        for picked in modes[mode]:
+            response = session.post(url, data={'email': picked}, allow_redirects=False)
+            errors += response.status_code >= 400
+            queries.append(int(response.headers.get('X-Query-Count', 0)))
+        requests_done = time.time() - started
+        delivered = wait_for(smtp, len(emails))
+        results[mode] = {'requests': len(modes[mode]), 'errors': errors + (not delivered),
+                         'request_seconds': round(requests_done, 3),
+                         'delivered_seconds': round(time.time() - started, 3),
+                         'smtp_connections': smtp.connections - connections,
+                         'queries': sum(queries)}
+        print('{:16} {requests} requests in {request_seconds}s, all delivered after {delivered_seconds}s '
+              'over {smtp_connections} SMTP connections, {queries} queries'.format(mode, **results[mode]))
+    if session.get(base_url + '/send_status').status_code != 200:
+        print('/send_status failed')
+    server.shutdown()
+
+    config = dict((key, value) for key, value in vars(args).items() if key != 'output')
+    config['database'] = database.split('://')[0]
+    path = common.write_results('send_friends', {'config': config, 'modes': results}, args.output)
+    print('Results written to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
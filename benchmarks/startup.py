@@ -0,0 +1,106 @@
+"""Start-up time of msetton.py: importing it, and running CLI commands, from `python -X importtime`.
+
+Imports msetton --runs times, each in a fresh `python -X importtime`
+process, and reports the median of the total import time and of the time
+spent in msetton's own body, plus the imports that cost the most (by
+cumulative time, as msetton's direct imports: what deferring one would
+save). It splits the import into the frameworks every command needs (Flask,
+and SQLAlchemy through database.py) and the rest: forms, extension setup,
+models and the module-level clients, caches and indexes, which is the most
+an application factory could take off the start-up. Then times whole CLI
+commands (--commands) from start to exit. The database is a fresh sqlite
+file and nothing is fetched from anywhere.
+
+    python -m benchmarks.startup --runs 10
+    python -m benchmarks.startup --commands "--help;db heads"
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks import common
+
+FRAMEWORKS = ('flask', 'database')  # msetton's imports that every command needs; database.py brings in SQLAlchemy
+LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)')
+
+
+def parse_importtime(stderr, module='msetton'):
+    """(self us, cumulative us, {direct import: cumulative us}) for module from -X importtime output"""
+    children = {}
+    for line in stderr.splitlines():
+        match = LINE.match(line)
+        if match is None:
+            continue
+        own, cumulative, indent, name = int(match.group(1)), int(match.group(2)), len(match.group(3)), match.group(4)
+        if indent == 3:
+            children[name] = cumulative  # printed before the module that imported them
+        elif indent == 1:
+            if name == module:
+                return own, cumulative, children
+            children = {}
+    raise ValueError('{} was not imported'.format(module))
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--top', type=int, default=10, help='slowest imports to list')
+    parser.add_argument('--commands', default='--help;db heads;drain_mail',
+                        help='CLI commands to time, separated by ;')
+    parser.add_argument('--output', help='where to write the JSON results')
+    args = parser.parse_args(argv)
+
+    tmp = tempfile.mkdtemp()
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + os.path.join(tmp, 'bench.sqlite'),
+               ITUNES_RATE_PATH=os.path.join(tmp, 'rate_limit.sqlite'),
+               SEARCH_CACHE_PATH=os.path.join(tmp, 'search_cache.sqlite'),
+               USER_CACHE_PATH=os.path.join(tmp, 'user_cache.sqlite'))
+    totals, own, frameworks, imports = [], [], [], {}
+    for _ in range(args.runs):
+        done = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import msetton'], cwd=common.ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+        if done.returncode:
+            sys.exit(done.stderr)
+        us, total, children = parse_importtime(done.stderr)
+        own.append(us)
+        totals.append(total)
+        frameworks.append(sum(children.get(name, 0) for name in FRAMEWORKS))
+        for name, cumulative in children.items():
+            imports.setdefault(name, []).append(cumulative)
+    slowest = sorted(((median(values) / 1000.0, name) for name, values in imports.items()), reverse=True)[:args.top]
+    rest = [total - framework for total, framework in zip(totals, frameworks)]
+    results = {'import_ms': round(median(totals) / 1000.0, 1), 'module_body_ms': round(median(own) / 1000.0, 1),
+               'frameworks_ms': round(median(frameworks) / 1000.0, 1), 'app_setup_ms': round(median(rest) / 1000.0, 1),
+               'slowest_imports_ms': [[name, round(ms, 1)] for ms, name in slowest], 'commands_ms': {}}
+    print('import msetton: {import_ms}ms (median of {runs}), {module_body_ms}ms of it in its own body'.format(
+        runs=args.runs, **results))
+    print('  {frameworks_ms}ms importing Flask and SQLAlchemy, {app_setup_ms}ms for everything else'.format(**results))
+    for ms, name in slowest:
+        print('  {:8.1f}ms  {}'.format(ms, name))
+
+    for command in filter(None, (c.strip() for c in args.commands.split(';'))):
+        times = []
+        for _ in range(max(1, args.runs // 2)):
+            started = time.time()
+            subprocess.run([sys.executable, 'msetton.py'] + command.split(), cwd=common.ROOT, env=env,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.time() - started)
+        results['commands_ms'][command] = round(median(times) * 1000, 1)
+        print('python msetton.py {}: {}ms'.format(command, results['commands_ms'][command]))
+
+    config = dict((key, value) for key, value in vars(args).items() if key != 'output')
+    path = common.write_results('startup', {'config': config, 'results': results}, args.output)
+    print('Results written to {}'.format(path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""Small caches used by the song app.
+
+LRUCache lives in the process; SQLiteCache keeps entries in a sqlite file so
+several worker processes on one machine can share them. Both have the same
+get/set/delete/clear/stats interface so the app can swap one for the other
+from config.
+
+An expired entry is kept for `stale_ttl` more seconds so get_stale can
+fall back on it, then dropped; with stale_ttl=0 it goes as soon as it is
+seen. Checking `key in cache` never counts as a hit or a miss.
+"""
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+_missing = object()
+
+
+def normalize_term(term):
+    """lowercase, trimmed and single-spaced, so 'Hey  Jude ' and 'hey jude' share a key"""
+    return re.sub(r'\s+', ' ', (term or '').strip().lower())
+
+
+class CacheStats(object):
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # dropped because the cache was full
+        self.expirations = 0  # found but too old to use
+
+    def as_dict(self):
+        return dict(hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, expirations=self.expirations)
+
+
+class LRUCache(object):
+    """In-process cache with a size limit and a time-to-live (seconds) per entry."""
+
+    def __init__(self, maxsize=256, ttl=300, stale_ttl=3600, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl  # seconds an expired entry is kept for get_stale
+        self.clock = clock
+        self._data = OrderedDict()  # key -> (stored_at, value)
+        self._lock = threading.Lock()
+        self._swept_at = clock()
+        self.stats = CacheStats()
+
+    def _expired(self, stored_at, now):
+        return bool(self.ttl) and now - stored_at > self.ttl
+
+    def _gone(self, stored_at, now):
+        return bool(self.ttl) and now - stored_at > self.ttl + self.stale_ttl
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            if entry is _missing:
+                self.stats.misses += 1
+                return default
+            stored_at, value = entry
+            now = self.clock()
+            if self._expired(stored_at, now):
+                if self._gone(stored_at, now):
+                    del self._data[key]
+                self.stats.expirations += 1
+                self.stats.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.stats.hits += 1
+            return value
+
+    def get_stale(self, key, default=None):
+        """the value even if it has expired (within stale_ttl), for when fresh data can't be fetched"""
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            if entry is _missing:
+                return default
+            if self._gone(entry[0], self.clock()):
+                del self._data[key]
+                return default
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            now = self.clock()
+            self._data[key] = (now, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.stats.evictions += 1
+            if self.ttl and now - self._swept_at > self.ttl:
+                self._sweep(now)
+
+    def _sweep(self, now):
+        # entries nobody asks for again are only found here, once per ttl, so they can't pile up until the cache is full
+        self._swept_at = now
+        for key in [key for key, (stored_at, _) in self._data.items() if self._gone(stored_at, now)]:
+            del self._data[key]
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            return entry is not _missing and not self._expired(entry[0], self.clock())
+
+
+class SQLiteCache(object):
+    """Cache shared between processes through a sqlite file. Values must be JSON serializable."""
+
+    def __init__(self, path, maxsize=10000, ttl=300, stale_ttl=3600, clock=time.time):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self.stats = CacheStats()
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cache '
+                         '(key TEXT PRIMARY KEY, stored_at REAL, value TEXT)')
+            conn.execute('CREATE INDEX IF NOT EXISTS cache_stored_at ON cache (stored_at)')
+
+    def _connect(self):
+        # sqlite connections can't be shared between threads, so keep one per thread (and per pid)
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get(self, key, default=None):
+        conn = self._connect()
+        row = conn.execute('SELECT stored_at, value FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.stats.misses += 1
+            return default
+        stored_at, value = row
+        if self.ttl and self.clock() - stored_at > self.ttl:
+            # kept for stale_ttl more seconds (deleted by set) so get_stale can still fall back on it
+            self.stats.expirations += 1
+            self.stats.misses += 1
+            return default
+        self.stats.hits += 1
+        return json.loads(value)
+
+    def get_stale(self, key, default=None):
+        """the value even if it has expired (within stale_ttl), for when fresh data can't be fetched"""
+        row = self._connect().execute('SELECT stored_at, value FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is None or (self.ttl and self.clock() - row[0] > self.ttl + self.stale_ttl):
+            return default
+        return json.loads(row[1])
+
+    def set(self, key, value):
+        conn = self._connect()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO cache (key, stored_at, value) VALUES (?, ?, ?)',
+                         (key, self.clock(), json.dumps(value)))
+            if self.ttl:  # past their stale time entries are no use to anyone (stored_at is indexed, so this is cheap)
+                conn.execute('DELETE FROM cache WHERE stored_at < ?', (self.clock() - self.ttl - self.stale_ttl,))
+            # oldest-written entries go first once we are over the limit
+            over = conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0] - self.maxsize
+            if over > 0:
+                conn.execute('DELETE FROM cache WHERE key IN '
+                             '(SELECT key FROM cache ORDER BY stored_at LIMIT ?)', (over,))
+                self.stats.evictions += over
+
+    def delete(self, key):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+
+    def clear(self):
+        conn = self._connect()
+        with conn:
+            conn.execute('DELETE FROM cache')
+
+    def __len__(self):
+        return self._connect().execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def __contains__(self, key):
+        row = self._connect().execute('SELECT stored_at FROM cache WHERE key = ?', (key,)).fetchone()
+        return row is not None and not (self.ttl and self.clock() - row[0] > self.ttl)
+
+
+def make_cache(backend='memory', maxsize=256, ttl=300, path=None, stale_ttl=3600):
+    """Builds a cache from config values. backend is 'memory' or 'sqlite'."""
+    if backend == 'sqlite':
+        return SQLiteCache(path or 'cache.sqlite', maxsize=maxsize, ttl=ttl, stale_ttl=stale_ttl)
+    if backend != 'memory':
+        raise ValueError('Unknown cache backend: {}'.format(backend))
+    return LRUCache(maxsize=maxsize, ttl=ttl, stale_ttl=stale_ttl)
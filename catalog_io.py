@@ -0,0 +1,138 @@
+"""Streaming import and export of the song catalog (`import_songs` / `export_songs` in msetton.py).
+
+Files are CSV with a title,artist,album header or JSON lines with the same
+keys, optionally gzipped (.gz). Rows are read and written one at a time and
+saved in batches, one transaction per batch, so memory stays flat however
+big the file is. On PostgreSQL each batch is COPYed into a temporary table
+and merged with a few INSERT ... SELECT ... ON CONFLICT DO NOTHING
+statements, and CSV exports are a single COPY ... TO STDOUT; on other
+databases batches go through the same set-based inserts the app uses.
+"""
+import contextlib
+import csv
+import gzip
+import io
+import json
+import sys
+import time
+
+FIELDS = ('title', 'artist', 'album')
+MAX_LENGTH = 64  # the name columns are VARCHAR(64)
+
+
+def detect_format(path, fmt=None):
+    if fmt:
+        return fmt
+    name = path[:-3] if path.endswith('.gz') else path
+    if name.endswith(('.jsonl', '.json', '.ndjson')):
+        return 'jsonl'
+    if name.endswith('.csv') or path == '-':
+        return 'csv'
+    raise ValueError('Cannot tell the format of {}, use --format csv or --format jsonl'.format(path))
+
+
+def open_file(path, mode):
+    """text file for path, gzipped if it ends in .gz; '-' is stdin or stdout, left open when the with block ends"""
+    if path == '-':
+        return contextlib.nullcontext(sys.stdin if mode == 'r' else sys.stdout)
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8', newline='')
+    return io.open(path, mode, encoding='utf-8', newline='')
+
+
+def read_tracks(f, fmt, stats):
+    """(title, artist, album) for each usable row; rows without a title or artist are counted in stats['skipped']"""
+    if fmt == 'csv':
+        rows = csv.DictReader(f)
+    else:
+        rows = (json.loads(line) for line in f if line.strip())
+    for row in rows:
+        title, artist, album = [(row.get(field) or '').strip()[:MAX_LENGTH] for field in FIELDS]
+        if not title or not artist:
+            stats['skipped'] += 1
+            continue
+        yield title, artist, album
+
+
+def write_tracks(f, fmt, rows, progress):
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        for row in rows:
+            writer.writerow(row)
+            progress.add()
+    else:
+        for row in rows:
+            f.write(json.dumps(dict(zip(FIELDS, row))) + '\n')
+            progress.add()
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class Progress(object):
+    """prints a running count and rate to stderr at most every `every` seconds"""
+
+    def __init__(self, verb, every=2.0, out=sys.stderr, clock=time.time):
+        self.verb = verb
+        self.every = every
+        self.out = out
+        self.clock = clock
+        self.count = 0
+        self.started = self.reported = clock()
+
+    def add(self, n=1):
+        self.count += n
+        if self.clock() - self.reported >= self.every:
+            self.reported = self.clock()
+            self.out.write('{} {:,} rows ({:,.0f} rows/s)\n'.format(self.verb, self.count, self.rate()))
+            self.out.flush()
+
+    def elapsed(self):
+        return self.clock() - self.started
+
+    def rate(self):
+        return self.count / max(self.elapsed(), 1e-9)
+
+
+## PostgreSQL
+
+def copy_tracks(cursor, chunk):
+    """saves a batch through COPY and set-based merges, on a psycopg2 cursor inside the batch's transaction"""
+    # ON COMMIT DROP keeps this to one transaction, so it also works through PgBouncer
+    cursor.execute('CREATE TEMP TABLE import_tracks (n serial, title text, artist text, album text) ON COMMIT DROP')
+    buf = io.StringIO()
+    csv.writer(buf).writerows(chunk)
+    buf.seek(0)
+    # CSV reads an unquoted empty field as NULL; songs without an album store '' like save_tracks, so the joins keep them
+    cursor.copy_expert('COPY import_tracks (title, artist, album) FROM STDIN '
+                       'WITH (FORMAT csv, FORCE_NOT_NULL (title, artist, album))', buf)
+    cursor.execute('INSERT INTO artists (name) SELECT DISTINCT artist FROM import_tracks ON CONFLICT DO NOTHING')
+    cursor.execute('INSERT INTO albums (name) SELECT DISTINCT album FROM import_tracks ON CONFLICT DO NOTHING')
+    cursor.execute('INSERT INTO collections (album_id, artist_id) '
+                   'SELECT DISTINCT al.id, ar.id FROM import_tracks t '
+                   'JOIN artists ar ON ar.name = t.artist JOIN albums al ON al.name = t.album '
+                   'ON CONFLICT DO NOTHING')
+    # the first album listed for a song wins, as in bulk_get_or_create_songs
+    cursor.execute('INSERT INTO songs (title, artist_id, album_id) '
+                   'SELECT DISTINCT ON (t.title, ar.id) t.title, ar.id, al.id FROM import_tracks t '
+                   'JOIN artists ar ON ar.name = t.artist JOIN albums al ON al.name = t.album '
+                   'ORDER BY t.title, ar.id, t.n '
+                   'ON CONFLICT DO NOTHING')
+
+
+def copy_export(cursor, f):
+    """writes the whole catalog as CSV with one COPY; returns the number of rows"""
+    f.write(','.join(FIELDS) + '\n')
+    cursor.copy_expert('COPY (SELECT s.title, ar.name, al.name FROM songs s '
+                       'LEFT JOIN artists ar ON ar.id = s.artist_id LEFT JOIN albums al ON al.id = s.album_id '
+                       'ORDER BY s.id) TO STDOUT WITH CSV', f)
+    return cursor.rowcount
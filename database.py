@@ -0,0 +1,234 @@
+"""Database access for the song app: engine settings, one transaction per request, pool metrics.
+
+Every request runs in a single transaction that is committed once, after
+the view returns and before the response goes out (so a failed commit is a
+500, not a lost write behind a 200). Error responses are rolled back. The
+get_or_create helpers only flush; anything that must wait until their rows
+are really saved (search indexes, queueing mail) goes through
+after_commit().
+
+The connection pool is sized explicitly (DB_POOL_SIZE, DB_MAX_OVERFLOW,
+DB_POOL_TIMEOUT), connections are recycled before servers or firewalls drop
+them (DB_POOL_RECYCLE) and checked before use (DB_PRE_PING). With
+DB_PGBOUNCER the app keeps no pool of its own: PgBouncer, in transaction
+pooling mode, hands each transaction a server connection, which one
+transaction per request is exactly right for.
+
+With DB_REPLICA_URL set, reads made while handling a request go to that
+replica (the 'replica' bind) and everything else to the primary: writes,
+reads after the session has written anything, reads outside requests (mail
+workers, CLI commands) and, for DB_PRIMARY_AFTER_WRITE seconds after a
+request wrote, every read by the same client, so people see their own
+changes even when the replica is behind. use_primary() sends the rest of a
+request to the primary.
+
+stats counts how long requests wait for a connection and how long they
+hold one, reported through /metrics when instrumentation is on.
+"""
+import threading
+import time
+
+import flask
+from flask import g, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, exc, orm
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.sql.dml import UpdateBase
+
+
+class PoolStats(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.commits = 0
+        self.rollbacks = 0
+        self.checkouts = 0
+        self.checkout_seconds = 0.0  # total time connections were checked out
+        self.max_checkout_seconds = 0.0
+        self.waits = 0
+        self.wait_seconds = 0.0  # total time spent getting a connection from the pool
+        self.max_wait_seconds = 0.0
+        self.timeouts = 0
+
+    def waited(self, seconds, timed_out=False):
+        with self._lock:
+            self.waits += 1
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            self.timeouts += timed_out
+
+    def checked_in(self, seconds):
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_seconds += seconds
+            self.max_checkout_seconds = max(self.max_checkout_seconds, seconds)
+
+    def as_dict(self):
+        with self._lock:
+            return dict((k, v) for k, v in vars(self).items() if not k.startswith('_'))
+
+
+def timed_pool(stats):
+    """a QueuePool class that records in stats how long each checkout waited (for a free connection, or to connect)"""
+    class TimedQueuePool(QueuePool):
+        def _do_get(self):
+            started = time.time()
+            try:
+                connection = QueuePool._do_get(self)
+            except exc.TimeoutError:
+                stats.waited(time.time() - started, timed_out=True)
+                raise
+            stats.waited(time.time() - started)
+            return connection
+    return TimedQueuePool
+
+
+class RoutingSession(SignallingSession):
+    """Flask-SQLAlchemy's session, except that reads go to the replica while Database.read_from_replica() says so"""
+
+    def __init__(self, db, **options):
+        self.router = db.router
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase):  # INSERT/UPDATE/DELETE run through session.execute
+            self.info['wrote'] = True
+        elif self.router is not None and not self.info.get('wrote') and self.router.read_from_replica():
+            return self.router.replica_engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """flask_sqlalchemy.SQLAlchemy with RoutingSession sessions; Database sets the router"""
+    router = None
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+class Database(object):
+
+    def __init__(self, app=None, db=None):
+        self.stats = PoolStats()
+        self.db = None
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db):
+        app.config.setdefault('DB_POOL_SIZE', 5)
+        app.config.setdefault('DB_MAX_OVERFLOW', 10)
+        app.config.setdefault('DB_POOL_TIMEOUT', 10)
+        app.config.setdefault('DB_POOL_RECYCLE', 1800)
+        app.config.setdefault('DB_PRE_PING', True)
+        app.config.setdefault('DB_PGBOUNCER', False)
+        app.config.setdefault('DB_REPLICA_URL', None)
+        app.config.setdefault('DB_PRIMARY_AFTER_WRITE', 10)
+        if app.config['DB_REPLICA_URL']:
+            app.config['SQLALCHEMY_BINDS'] = dict(app.config.get('SQLALCHEMY_BINDS') or {}, replica=app.config['DB_REPLICA_URL'])
+        self.primary_after_write = app.config['DB_PRIMARY_AFTER_WRITE']
+        app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = False  # we commit in after_request instead
+        # SQLAlchemy(app) has already set this key (to {}), so merge rather than setdefault; explicit settings win
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(self.engine_options(app.config),
+                                                       **(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}))
+        self.db = db
+        app.after_request(self._end_transaction)
+        app.teardown_request(self._end_streamed_transaction)
+        event.listen(db.session, 'after_commit', self._after_commit)
+        event.listen(db.session, 'after_rollback', self._after_rollback)
+        event.listen(db.session, 'before_flush', self._before_flush)
+        with app.app_context():
+            engine = db.get_engine()
+            self.replica_engine = db.get_engine(bind='replica') if app.config['DB_REPLICA_URL'] else None
+        db.router = self
+        event.listen(engine, 'commit', self._count_commit)
+        event.listen(engine, 'rollback', self._count_rollback)
+        event.listen(engine, 'checkout', self._checkout)
+        event.listen(engine, 'checkin', self._checkin)
+        self.engine = engine
+
+    def engine_options(self, config):
+        url = config['SQLALCHEMY_DATABASE_URI']
+        if config['DB_PGBOUNCER']:
+            return {'poolclass': NullPool}  # PgBouncer does the pooling; a second pool here would just hold its slots
+        if url.startswith('sqlite'):
+            return {}  # local files, the sqlite defaults are right
+        return {'poolclass': timed_pool(self.stats), 'pool_size': config['DB_POOL_SIZE'],
+                'max_overflow': config['DB_MAX_OVERFLOW'], 'pool_timeout': config['DB_POOL_TIMEOUT'],
+                'pool_recycle': config['DB_POOL_RECYCLE'], 'pool_pre_ping': config['DB_PRE_PING']}
+
+    ## Routing
+
+    def read_from_replica(self):
+        if self.replica_engine is None or not has_request_context() or g.get('_db_use_primary'):
+            return False
+        return flask.session.get('_db_primary_until', 0) < time.time()
+
+    def use_primary(self):
+        """the rest of this request reads from the primary, e.g. before checking something it is about to write"""
+        g._db_use_primary = True
+
+    def _before_flush(self, session, flush_context, instances):
+        session.info['wrote'] = True
+
+    ## Transactions
+
+    def after_commit(self, fn, *args):
+        """runs fn(*args) once the current transaction commits, and not at all if it rolls back"""
+        self.db.session.info.setdefault('after_commit', []).append((fn, args))
+
+    def _end_transaction(self, response):
+        session = self.db.session
+        if response.status_code >= 400:
+            session.rollback()
+            return response
+        session.flush()
+        if self.replica_engine is not None and session.info.get('wrote'):
+            # until the replica has caught up, this client reads what it just wrote from the primary
+            flask.session['_db_primary_until'] = time.time() + self.primary_after_write
+        if response.is_streamed:
+            g._commit_after_stream = True  # the body is still reading from the transaction
+        else:
+            session.commit()
+        return response
+
+    def _end_streamed_transaction(self, error=None):
+        if g.pop('_commit_after_stream', False) and error is None:
+            self.db.session.commit()
+
+    def _after_commit(self, session):
+        session.info.pop('wrote', None)
+        callbacks = session.info.pop('after_commit', [])
+        for fn, args in callbacks:
+            fn(*args)
+
+    def _after_rollback(self, session):
+        session.info.pop('wrote', None)
+        session.info.pop('after_commit', None)
+
+    ## Metrics
+
+    def _count_commit(self, conn):
+        with self.stats._lock:
+            self.stats.commits += 1
+
+    def _count_rollback(self, conn):
+        with self.stats._lock:
+            self.stats.rollbacks += 1
+
+    def _checkout(self, dbapi_connection, record, proxy):
+        record.info['checked_out_at'] = time.time()
+
+    def _checkin(self, dbapi_connection, record):
+        started = record.info.pop('checked_out_at', None)
+        if started is not None:
+            self.stats.checked_in(time.time() - started)
+
+    def metrics(self):
+        """(name, type, value) for /metrics: the counters in stats plus the pool's current state"""
+        samples = [(name + ('' if name.startswith('max_') else '_total'), 'gauge' if name.startswith('max_') else 'counter', value)
+                   for name, value in sorted(self.stats.as_dict().items())]
+        pool = self.engine.pool
+        for name in ('size', 'checkedout', 'overflow', 'checkedin'):
+            if hasattr(pool, name):
+                samples.append(('pool_' + name, 'gauge', getattr(pool, name)()))
+        return samples
@@ -0,0 +1,196 @@
+"""Background enrichment of saved songs with their iTunes details (the `enrich` command in msetton.py).
+
+Saving a song only adds a row to the enrichment_jobs table, in the same
+transaction, and never calls iTunes; the song's unique row there means a
+song is queued once however often it is saved. `python msetton.py enrich`
+runs a pool of worker threads that claim due jobs in batches, fetch the
+details and save duration, genre, artwork and iTunes ids on the song, album
+and artist.
+
+Songs picked from a search carry their iTunes track id, and up to
+LOOKUP_IDS of those are fetched with a single lookup call. Songs without
+one (imported, or picked from the saved songs) are found with one search
+each. Every call waits its turn twice: on a bucket shared by the threads
+of this process, so the pool stays under `calls_per_minute`, and on
+`limiter`, the iTunes limit shared with the web workers and any other
+enrich process on the machine (see rate_limit.py). Claims are
+conditional updates tagged with the claiming worker, so any number of
+workers, in any number of processes, never work on the same job; jobs left
+claimed by a crashed worker are picked up again after `stale_after`
+seconds. Failed calls are retried with exponential backoff.
+"""
+import datetime
+import threading
+import uuid
+
+from itunes import LOOKUP_IDS
+from rate_limit import TokenBucket
+
+PENDING = 'pending'
+WORKING = 'working'
+DONE = 'done'
+MISSING = 'missing'  # iTunes has no such track
+FAILED = 'failed'
+
+
+class Enricher(object):
+
+    def __init__(self, app, db, model, itunes, tracks, save, workers=2, batch_size=LOOKUP_IDS, searches=10,
+                 calls_per_minute=20, limiter=None, max_attempts=5, backoff=60, stale_after=600, poll_every=5):
+        self.app = app
+        self.db = db
+        self.model = model  # the job table, see EnrichmentJob in msetton.py
+        self.itunes = itunes
+        self.tracks = tracks  # tracks(song ids) -> [(song id, title, artist name)]
+        self.save = save  # save([(song id, TrackDetails)]) in the current transaction
+        self.workers = workers
+        self.batch_size = batch_size  # jobs with a track id claimed at once, all fetched in one lookup
+        self.searches = searches  # and jobs without one, each a call of its own
+        self.own_limit = TokenBucket(calls_per_minute)  # this process's threads only
+        self.limiter = limiter  # shared with everything else calling iTunes; None for no shared limit
+        self.max_attempts = max_attempts
+        self.backoff = backoff  # seconds before the first retry, doubled every attempt
+        self.stale_after = stale_after
+        self.poll_every = poll_every  # seconds between looks at the table when there was nothing to do
+        self.stats = {'enriched': 0, 'missing': 0, 'failed': 0, 'calls': 0}
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+
+    ## Producer side
+
+    def job_rows(self, song_ids, track_ids=None):
+        """rows for the job table that queue the songs; insert them ignoring duplicates, so songs queued
+        before are left alone. track_ids, when known, are the iTunes track ids in the same order."""
+        now = datetime.datetime.utcnow()
+        return [{'song_id': song_id, 'itunes_id': track_id, 'status': PENDING, 'attempts': 0,
+                 'created_at': now, 'next_attempt_at': now}
+                for song_id, track_id in zip(song_ids, track_ids or [None] * len(song_ids))]
+
+    ## Worker pool
+
+    def run(self, until_empty=False):
+        """Runs the worker threads until stop() (or, with until_empty, until nothing is due). Returns stats."""
+        threads = []
+        for i in range(self.workers):
+            thr = threading.Thread(target=self._work, args=[until_empty], name='enrich-worker-{}'.format(i))
+            thr.daemon = True
+            thr.start()
+            threads.append(thr)
+        try:
+            for thr in threads:
+                while thr.is_alive():
+                    thr.join(1)
+        except KeyboardInterrupt:
+            self.stop()
+        return dict(self.stats)
+
+    def stop(self):
+        self._stop.set()
+
+    def _work(self, until_empty):
+        while not self._stop.is_set():
+            with self.app.app_context():
+                try:
+                    jobs = self._claim()
+                    if jobs:
+                        self._process(jobs)
+                except Exception:
+                    self.app.logger.exception('Enrichment worker failed')
+                    jobs = None
+                finally:
+                    self.db.session.remove()
+            if not jobs:
+                if until_empty:
+                    return
+                self._stop.wait(self.poll_every)
+
+    def _count(self, name, n=1):
+        with self._stats_lock:
+            self.stats[name] += n
+
+    ## Claiming
+
+    def _claim(self):
+        """Marks due jobs (batch_size with a track id, `searches` without) as this worker's and returns them.
+        The conditional UPDATE means two workers never claim the same job; the token tells this worker which ones it got."""
+        now = datetime.datetime.utcnow()
+        stale = now - datetime.timedelta(seconds=self.stale_after)
+        Job = self.model
+        due = self.db.or_(self.db.and_(Job.status == PENDING, Job.next_attempt_at <= now),
+                          self.db.and_(Job.status == WORKING, Job.claimed_at < stale))
+        ids = [job_id for has_id, limit in ((Job.itunes_id.isnot(None), self.batch_size), (Job.itunes_id.is_(None), self.searches))
+               for job_id, in self.db.session.query(Job.id).filter(due, has_id).order_by(Job.id).limit(limit)]
+        if not ids:
+            self.db.session.rollback()
+            return []
+        token = uuid.uuid4().hex
+        self.db.session.query(Job).filter(Job.id.in_(ids), due)\
+            .update({'status': WORKING, 'claimed_at': now, 'claimed_by': token}, synchronize_session=False)
+        self.db.session.commit()
+        return self.db.session.query(Job.id, Job.song_id, Job.itunes_id).filter_by(claimed_by=token, status=WORKING).all()
+
+    ## Fetching and saving
+
+    def _call(self, fn, *args):
+        self.own_limit.acquire()
+        if self.limiter is not None:
+            self.limiter.acquire()  # no timeout: a background job can always wait for its turn
+        self._count('calls')
+        return fn(*args)
+
+    def _process(self, jobs):
+        """jobs are (job id, song id, track id) rows. No transaction is open while waiting on iTunes."""
+        import requests  # here rather than at the top, so importing the app doesn't load requests
+        tracks = dict((song_id, (title, artist)) for song_id, title, artist in self.tracks([job.song_id for job in jobs]))
+        self.db.session.rollback()
+        found, failed = {}, {}
+        known = [job for job in jobs if job.itunes_id]
+        for start in range(0, len(known), LOOKUP_IDS):
+            batch = known[start:start + LOOKUP_IDS]
+            try:
+                details = self._call(self.itunes.lookup, [job.itunes_id for job in batch])
+            except (requests.RequestException, ValueError) as e:
+                failed.update((job.id, e) for job in batch)
+                continue
+            found.update((job.id, details[job.itunes_id]) for job in batch if job.itunes_id in details)
+        for job in jobs:
+            if job.itunes_id or job.song_id not in tracks:
+                continue
+            try:
+                detail = self._call(self.itunes.find_track, *tracks[job.song_id])
+            except (requests.RequestException, ValueError) as e:
+                failed[job.id] = e
+                continue
+            if detail is not None:
+                found[job.id] = detail
+
+        self.save([(job.song_id, found[job.id]) for job in jobs if job.id in found])
+        now = datetime.datetime.utcnow()
+        statuses = []
+        for job in self.model.query.filter(self.model.id.in_([job.id for job in jobs])):
+            job.claimed_by = None
+            if job.id in found:
+                job.status = DONE
+                job.itunes_id = found[job.id].track_id
+            elif job.id in failed:
+                self._retry_later(job, failed[job.id], now)
+            else:
+                job.status = MISSING
+            statuses.append(job.status)
+        self.db.session.commit()
+        for name, status in (('enriched', DONE), ('missing', MISSING), ('failed', FAILED)):
+            self._count(name, statuses.count(status))
+
+    def _retry_later(self, job, error, now):
+        job.attempts = (job.attempts or 0) + 1
+        job.last_error = str(error)[:255]
+        if job.attempts >= self.max_attempts:
+            job.status = FAILED
+            return
+        job.status = PENDING
+        job.next_attempt_at = now + datetime.timedelta(seconds=self.backoff * 2 ** (job.attempts - 1))
+
+    def counts(self):
+        """{status: number of jobs}"""
+        Job = self.model
+        return dict(self.db.session.query(Job.status, self.db.func.count(Job.id)).group_by(Job.status))
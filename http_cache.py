@@ -0,0 +1,141 @@
+"""HTTP caching for the rendered pages: ETags, 304s, compression and a rendered page cache.
+
+A view wrapped in @http_cache.cached(version) gets a weak ETag made from the
+request path, the logged-in user (unless per_user=False), the templates on
+disk and version(**view args), a cheap query that changes whenever the data behind the page does
+(the newest song id, the user's friend rows). A conditional GET with that
+ETag is answered 304 without running the view. Pages with flashed messages
+waiting are never cached, and version() can return None to skip caching a
+request.
+
+HTML, JSON and text responses of at least HTTP_COMPRESS_MIN_SIZE bytes are
+sent gzip or brotli compressed (brotli when the brotli package is installed
+and the client accepts it).
+
+With FRAGMENT_CACHE_SIZE > 0 rendered pages are also kept in an in-process
+LRU cache under their ETag, along with the compressed copies, so a page
+someone else already asked for is neither rendered nor compressed again.
+Entries can never be stale, since the ETag changes with the data; old ones
+just age out.
+"""
+import gzip
+import hashlib
+import os
+from functools import wraps
+
+from flask import request, session, make_response
+from flask_login import current_user
+
+from cache import LRUCache
+
+try:
+    import brotli
+except ImportError:  # optional, gzip only without it
+    brotli = None
+
+COMPRESSIBLE = ('text/html', 'text/plain', 'text/css', 'application/json', 'application/javascript')
+
+
+def compress(body, encoding, level=6):
+    if encoding == 'br':
+        return brotli.compress(body, quality=min(level, 11))
+    return gzip.compress(body, compresslevel=level)
+
+
+class HTTPCache(object):
+
+    def __init__(self, app=None):
+        self.fragments = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault('HTTP_COMPRESS_MIN_SIZE', 1024)  # bytes
+        app.config.setdefault('HTTP_COMPRESS_LEVEL', 6)
+        app.config.setdefault('FRAGMENT_CACHE_SIZE', 256)  # rendered pages kept per process, 0 to turn it off
+        app.config.setdefault('FRAGMENT_CACHE_TTL', 300)  # seconds
+        self.min_size = app.config['HTTP_COMPRESS_MIN_SIZE']
+        self.level = app.config['HTTP_COMPRESS_LEVEL']
+        if app.config['FRAGMENT_CACHE_SIZE']:
+            self.fragments = LRUCache(app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'])
+        self.templates_version = self._templates_version(os.path.join(app.root_path, app.template_folder))
+        app.after_request(self._compress_response)
+
+    def _templates_version(self, folder):
+        """changes when a template file does, so a deploy never answers 304 for the old markup"""
+        stamp = []
+        for root, _, files in os.walk(folder):
+            for name in sorted(files):
+                stat = os.stat(os.path.join(root, name))
+                stamp.append((os.path.relpath(os.path.join(root, name), folder), stat.st_size, int(stat.st_mtime)))
+        return hashlib.sha1(repr(sorted(stamp)).encode('utf-8')).hexdigest()[:8]
+
+    ## Conditional GETs
+
+    def cached(self, version, per_user=True):
+        """decorator for GET views whose page only changes when version(**view_args) does
+        (and with per_user, on who is logged in)"""
+        def decorator(view):
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+                    return view(*args, **kwargs)
+                data_version = version(**kwargs)
+                if data_version is None:
+                    return view(*args, **kwargs)
+                etag = self.etag(data_version, per_user)
+                if request.if_none_match.contains_weak(etag):
+                    response = make_response('', 304)
+                else:
+                    entry = self.fragments.get(etag) if self.fragments is not None else None
+                    if entry is not None:
+                        response = self._from_fragment(entry)
+                    else:
+                        response = make_response(view(*args, **kwargs))
+                        if self.fragments is not None and response.status_code == 200 and not response.is_streamed:
+                            self.fragments.set(etag, {'body': response.get_data(), 'mimetype': response.mimetype,
+                                                      'content_type': response.headers['Content-Type']})
+                response.set_etag(etag, weak=True)
+                response.headers['Cache-Control'] = 'private, no-cache'  # per user, and always checked with us first
+                response.vary.add('Accept-Encoding')
+                return response
+            return wrapper
+        return decorator
+
+    def etag(self, data_version, per_user=True):
+        user = current_user.get_id() if per_user else None
+        key = repr((self.templates_version, request.full_path, user, data_version))
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()[:20]
+
+    def _from_fragment(self, entry):
+        encoding = self._encoding(entry['body'], entry['mimetype'])
+        if encoding is None:
+            return make_response(entry['body'], 200, {'Content-Type': entry['content_type']})
+        if encoding not in entry:  # compressed once, then served from the entry
+            entry[encoding] = compress(entry['body'], encoding, self.level)
+        response = make_response(entry[encoding], 200, {'Content-Type': entry['content_type']})
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+    ## Compression
+
+    def _encoding(self, body, mimetype):
+        if len(body) < self.min_size or mimetype not in COMPRESSIBLE:
+            return None
+        accepted = request.accept_encodings
+        if brotli is not None and accepted['br']:
+            return 'br'
+        if accepted['gzip']:
+            return 'gzip'
+        return None
+
+    def _compress_response(self, response):
+        if response.status_code != 200 or response.is_streamed or 'Content-Encoding' in response.headers:
+            return response
+        body = response.get_data()
+        encoding = self._encoding(body, response.mimetype)
+        if encoding is not None:
+            response.set_data(compress(body, encoding, self.level))
+            response.headers['Content-Encoding'] = encoding
+            response.vary.add('Accept-Encoding')
+        return response
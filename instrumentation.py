@@ -0,0 +1,262 @@
+"""Opt-in request timing for the song app (INSTRUMENTATION=true).
+
+Every request gets timing spans for the database, outbound HTTP, template
+rendering and mail, plus a count of the SQL queries it ran (sent back in the
+X-Query-Count header and logged when it passes QUERY_COUNT_WARNING, which is
+how N+1 loops show up). Totals are served at /metrics in the Prometheus text
+format. A sample of requests runs under cProfile and the profile is written
+to PROFILE_DIR when the request turns out to be slow.
+
+When it is disabled nothing is hooked up and span() hands back a shared
+no-op context manager, so the instrumented code paths cost next to nothing.
+
+Work a request hands to other threads (the iTunes fetches) counts towards
+that request when it is wrapped with carry(), and queries count whichever
+engine they ran on, the primary or a replica bind.
+"""
+import cProfile
+import os
+import random
+import threading
+import time
+from collections import defaultdict
+
+from flask import Response, g, request, signals_available, before_render_template, template_rendered
+from sqlalchemy import event
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100)
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_span = _NullSpan()
+
+
+class _Span(object):
+    def __init__(self, instrumentation, kind):
+        self.instrumentation = instrumentation
+        self.kind = kind
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.instrumentation.record(self.kind, time.time() - self.start)
+        return False
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.total += 1
+        self.sum += value
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in sorted(labels.items())) + '}'
+
+
+class Instrumentation(object):
+
+    def __init__(self, app=None, db=None):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.requests = defaultdict(int)  # (endpoint, status) -> count
+        self.durations = defaultdict(lambda: Histogram(DURATION_BUCKETS))  # endpoint -> seconds
+        self.queries = defaultdict(lambda: Histogram(QUERY_BUCKETS))  # endpoint -> queries per request
+        self.span_seconds = defaultdict(float)  # kind -> total seconds
+        self.span_count = defaultdict(int)
+        self.collectors = []
+        self._local = threading.local()  # spans of the request whose work this thread is doing, see carry()
+        if app is not None:
+            self.init_app(app, db)
+
+    def init_app(self, app, db=None):
+        app.config.setdefault('INSTRUMENTATION', False)
+        app.config.setdefault('QUERY_COUNT_WARNING', 20)
+        app.config.setdefault('PROFILE_SAMPLE_RATE', 0.0)  # fraction of requests to run under cProfile
+        app.config.setdefault('SLOW_REQUEST_SECONDS', 1.0)  # profiles of requests slower than this are kept
+        app.config.setdefault('PROFILE_DIR', 'profiles')
+        self.enabled = bool(app.config['INSTRUMENTATION'])
+        if not self.enabled:
+            return
+        self.app = app
+        app.before_request(self._before_request)
+        # Flask runs after_request hooks last registered first, so this one goes to the front of the list: it then
+        # sees the request end to end, including the commit and the flush before it (Database) and compression
+        app.after_request_funcs.setdefault(None, []).insert(0, self._after_request)
+        app.add_url_rule('/metrics', 'metrics', self.metrics_view)
+        if db is not None:
+            with app.app_context():
+                engines = [db.get_engine()] + [db.get_engine(bind=bind) for bind in app.config.get('SQLALCHEMY_BINDS') or ()]
+            for engine in engines:
+                event.listen(engine, 'before_cursor_execute', self._before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute', self._after_cursor_execute)
+        if signals_available:
+            before_render_template.connect(self._before_render, app)
+            template_rendered.connect(self._after_render, app)
+
+    ## Recording
+
+    def span(self, kind):
+        """context manager timing a block of the current request under `kind`"""
+        if not self.enabled:
+            return _null_span
+        return _Span(self, kind)
+
+    def record(self, kind, seconds):
+        spans = g.get('_spans') if self._in_request() else getattr(self._local, 'spans', None)
+        with self._lock:
+            self.span_seconds[kind] += seconds
+            self.span_count[kind] += 1
+            if spans is not None:  # carried spans are added to from several threads at once
+                spans[kind] = spans.get(kind, 0.0) + seconds
+
+    def carry(self, fn):
+        """fn, made to record its spans into the current request when it runs on another thread"""
+        spans = g.get('_spans') if self.enabled and self._in_request() else None
+        if spans is None:
+            return fn
+
+        def run(*args, **kwargs):
+            previous = getattr(self._local, 'spans', None)
+            self._local.spans = spans
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self._local.spans = previous
+        return run
+
+    def add_collector(self, collector):
+        """collector() returns (name, type, value, labels) tuples to add to /metrics, e.g. cache hit counts"""
+        self.collectors.append(collector)
+
+    def _in_request(self):
+        try:
+            return bool(request)
+        except RuntimeError:  # outside a request (worker threads, CLI)
+            return False
+
+    ## Hooks
+
+    def _before_request(self):
+        g._request_started = time.time()
+        g._spans = {}
+        g._query_count = 0
+        g._profiler = None
+        rate = self.app.config['PROFILE_SAMPLE_RATE']
+        if rate and random.random() < rate:
+            g._profiler = cProfile.Profile()
+            g._profiler.enable()
+
+    def _after_request(self, response):
+        started = g.get('_request_started')
+        if started is None:
+            return response
+        duration = time.time() - started
+        endpoint = request.endpoint or 'unknown'
+        queries = g.get('_query_count', 0)
+        with self._lock:
+            self.requests[(endpoint, response.status_code)] += 1
+            self.durations[endpoint].observe(duration)
+            self.queries[endpoint].observe(queries)
+        response.headers['X-Query-Count'] = str(queries)
+        response.headers['Server-Timing'] = ', '.join(
+            ['{};dur={:.1f}'.format(kind, seconds * 1000) for kind, seconds in sorted(g._spans.items())] +
+            ['total;dur={:.1f}'.format(duration * 1000)])
+        if queries > self.app.config['QUERY_COUNT_WARNING']:
+            self.app.logger.warning('%s ran %d queries (possible N+1)', request.path, queries)
+        profiler = g.get('_profiler')
+        if profiler is not None:
+            profiler.disable()
+            if duration >= self.app.config['SLOW_REQUEST_SECONDS']:
+                self._dump_profile(profiler, endpoint, duration)
+        return response
+
+    def _dump_profile(self, profiler, endpoint, duration):
+        directory = self.app.config['PROFILE_DIR']
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, '{}-{}-{:.0f}ms.prof'.format(endpoint, int(time.time()), duration * 1000))
+        profiler.dump_stats(path)
+        self.app.logger.warning('Slow request %s took %.2fs, profile saved to %s', request.path, duration, path)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('_query_started', []).append(time.time())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info['_query_started'].pop()
+        self.record('db', time.time() - started)
+        if self._in_request() and '_query_count' in g:
+            g._query_count += 1
+
+    def _before_render(self, sender, template, context, **extra):
+        g.setdefault('_render_started', []).append(time.time())
+
+    def _after_render(self, sender, template, context, **extra):
+        starts = g.get('_render_started')
+        if starts:
+            self.record('template', time.time() - starts.pop())
+
+    def http_hook(self, response, *args, **kwargs):
+        """requests response hook, e.g. session.hooks['response'].append(instrumentation.http_hook)"""
+        self.record('http', response.elapsed.total_seconds())
+        return response
+
+    ## /metrics
+
+    def render_metrics(self):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append('{}{}{} {}'.format(name, suffix, _labels(labels), value))
+
+        def histogram(name, help_text, histograms):
+            samples = []
+            for endpoint, hist in sorted(histograms.items()):
+                for bound, count in zip(hist.buckets, hist.counts):
+                    samples.append(('_bucket', {'endpoint': endpoint, 'le': bound}, count))
+                samples.append(('_bucket', {'endpoint': endpoint, 'le': '+Inf'}, hist.total))
+                samples.append(('_sum', {'endpoint': endpoint}, hist.sum))
+                samples.append(('_count', {'endpoint': endpoint}, hist.total))
+            metric(name, 'histogram', help_text, samples)
+
+        with self._lock:
+            metric('songs_requests_total', 'counter', 'Requests handled.',
+                   [('', {'endpoint': e, 'status': s}, n) for (e, s), n in sorted(self.requests.items())])
+            histogram('songs_request_duration_seconds', 'Time spent handling requests.', self.durations)
+            histogram('songs_request_queries', 'SQL queries run per request.', self.queries)
+            metric('songs_span_seconds_total', 'counter', 'Time spent in database, http, template and mail work.',
+                   [('', {'kind': k}, v) for k, v in sorted(self.span_seconds.items())])
+            metric('songs_span_total', 'counter', 'Number of database, http, template and mail operations.',
+                   [('', {'kind': k}, v) for k, v in sorted(self.span_count.items())])
+        collected = defaultdict(list)
+        for collector in self.collectors:
+            for name, kind, value, labels in collector():
+                collected[(name, kind)].append(('', labels, value))
+        for (name, kind), samples in sorted(collected.items()):
+            metric(name, kind, name.replace('_', ' ') + '.', samples)
+        return '\n'.join(lines) + '\n'
+
+    def metrics_view(self):
+        return Response(self.render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
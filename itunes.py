@@ -0,0 +1,361 @@
+"""Client for the iTunes search API.
+
+The payload is decoded exactly once (with orjson when it is installed) and
+each result becomes a TrackHit, so callers never touch the raw JSON.
+ITunesClient keeps pooled keep-alive connections (opened, and requests
+imported, on the first call rather than when the app is imported), uses
+strict timeouts and stops calling iTunes for a while (serving cached
+results, even stale ones) after repeated failures. Each search asks for a large page of several search
+variants at once and keeps the merged hits, so "more results" and deeper
+pages are served from what is stored (topped up in the background).
+
+Searches for the same term that arrive while one is already being fetched
+wait for that fetch instead of making their own ("single flight"), and
+every search takes its calls from a rate limiter (see rate_limit.py) shared
+with the other workers. A search that would have to wait more than
+`limit_wait` seconds for its turn is served what is stored, like when
+iTunes is failing, instead of queueing for longer.
+
+lookup() and find_track() fetch the details of known tracks (duration,
+genre, artwork, iTunes ids) for the enrichment worker; they are never
+cached and never used while answering a request.
+"""
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from cache import normalize_term
+from rate_limit import Throttled
+
+try:
+    import orjson as _fast_json
+except ImportError:  # orjson is optional, the standard library works fine
+    _fast_json = None
+import json
+
+SEARCH_URL = 'https://itunes.apple.com/search'
+LOOKUP_IDS = 200  # track ids per lookup call
+
+
+def loads(text):
+    if _fast_json is not None:
+        return _fast_json.loads(text)
+    return json.loads(text)
+
+
+def _encode(value):
+    return value.replace(' ', '*')
+
+
+def _decode(value):
+    return value.replace('*', ' ')
+
+
+class TrackHit(namedtuple('TrackHit', ['song', 'artist', 'album', 'track_id'])):
+    """One song from a search. `both` is the 'title:artist:album:track id' string the song list form posts back.
+    track_id is the iTunes trackId, None for hits from the saved songs."""
+    __slots__ = ()
+
+    def __new__(cls, song, artist, album, track_id=None):
+        return super(TrackHit, cls).__new__(cls, song, artist, album, track_id)
+
+    @property
+    def both(self):
+        parts = [_encode(self.song), _encode(self.artist), _encode(self.album)]
+        return ':'.join(parts + ([str(self.track_id)] if self.track_id else []))
+
+    @classmethod
+    def from_result(cls, result):
+        return cls(result['trackName'], result.get('artistName', ''),
+                   result.get('collectionCensoredName') or result.get('collectionName') or '', result.get('trackId'))
+
+    @classmethod
+    def from_choice(cls, choice):
+        """Inverse of `both`, used when the user picks a song from the list"""
+        track, artist, album, track_id = (choice.split(':') + ['', '', ''])[:4]
+        return cls(_decode(track), _decode(artist), _decode(album), int(track_id) if track_id.isdigit() else None)
+
+
+class TrackDetails(namedtuple('TrackDetails', ['track_id', 'title', 'artist', 'artist_id', 'album_id',
+                                               'duration_ms', 'genre', 'artwork_url'])):
+    """What the enrichment worker keeps from a lookup or search result"""
+    __slots__ = ()
+
+    @classmethod
+    def from_result(cls, result):
+        return cls(result['trackId'], result.get('trackName', ''), result.get('artistName', ''),
+                   result.get('artistId'), result.get('collectionId'), result.get('trackTimeMillis'),
+                   result.get('primaryGenreName'), result.get('artworkUrl100'))
+
+
+def parse_search_results(payload):
+    """list of TrackHit from a search response (text, bytes or already-decoded dict).
+    Results without a track name (e.g. albums or artists) are skipped, and any number of results is fine."""
+    if isinstance(payload, (str, bytes)):
+        payload = loads(payload)
+    return [TrackHit.from_result(r) for r in payload.get('results', ()) if r.get('trackName')]
+
+
+class ITunesUnavailable(Exception):
+    """iTunes could not be reached and nothing was cached for the search"""
+
+
+class CircuitBreaker(object):
+    """Opens after `threshold` failures in a row; once `reset_after` seconds have passed one trial call is let through."""
+
+    def __init__(self, threshold=3, reset_after=30, clock=time.time):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if self.clock() - self.opened_at >= self.reset_after:
+                self.opened_at = self.clock()  # half-open: this caller tries, everyone else keeps waiting
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = self.clock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+
+# Searches run for every term, concurrently, and merged in this order without duplicates
+VARIANTS = (
+    {'entity': 'song'},
+    {'entity': 'musicTrack'},
+    {'entity': 'song', 'attribute': 'artistTerm'},
+)
+MAX_LIMIT = 200  # the most results iTunes returns for one call
+
+
+class ITunesClient(object):
+
+    def __init__(self, base_url=SEARCH_URL, cache=None, connect_timeout=2, read_timeout=5,
+                 pool_size=30, breaker=None, session=None, page_size=50, variants=VARIANTS,
+                 prefetch_margin=10, lookup_url=None, limiter=None, limit_wait=3):
+        self.base_url = base_url
+        self.lookup_url = lookup_url or base_url.rsplit('/', 1)[0] + '/lookup'
+        self.cache = cache  # normalized term -> {'limit', 'more', 'hits'}
+        self.timeout = (connect_timeout, read_timeout)
+        self.breaker = breaker or CircuitBreaker()
+        self._session = None
+        self._given_session = session
+        self.response_hooks = []  # added to the session when it is opened
+        self.wrap_task = None  # wrap_task(fn) -> what runs on the fetch threads instead of fn, e.g. to carry request state
+        self.pool_size = pool_size
+        self.page_size = page_size  # results asked for per variant on the first search
+        self.variants = variants
+        self.prefetch_margin = prefetch_margin  # fetch more in the background once a page gets this close to the end
+        self.executor = ThreadPoolExecutor(max_workers=pool_size)  # one thread per pooled connection
+        self.limiter = limiter  # None for no limit
+        self.limit_wait = limit_wait  # seconds a search may wait for its turn before stored results are served instead
+        self.stats = {'fetches': 0, 'coalesced': 0, 'throttled': 0}
+        self._prefetching = set()
+        self._inflight = {}  # (term, limit) -> Future of the fetch being made for it
+        self._lock = threading.Lock()
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    @property
+    def session(self):
+        return self._session or self.open_session()
+
+    def open_session(self):
+        """the pooled requests session, made on first use: requests takes longer to import than anything else here"""
+        with self._lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = self._given_session or requests.Session()
+                adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                session.hooks['response'].extend(self.response_hooks)
+                self._session = session
+        return self._session
+
+    def _fetch(self, term, limit, params):
+        query = dict(params, term=term, limit=limit)
+        response = self.session.get(self.base_url, params=query, timeout=self.timeout)
+        response.raise_for_status()
+        return parse_search_results(response.content)
+
+    def _fetch_all(self, term, limit):
+        """every variant at once, merged. Raises ITunesUnavailable only if all of them failed."""
+        import requests
+        fetch = self.wrap_task(self._fetch) if self.wrap_task is not None else self._fetch
+        futures = [self.executor.submit(fetch, term, limit, params) for params in self.variants]
+        outcomes = []
+        for future in futures:
+            try:
+                outcomes.append(future.result())
+            except (requests.RequestException, ValueError) as e:
+                outcomes.append(e)
+        return self.merge(term, limit, outcomes)
+
+    def merge(self, term, limit, outcomes):
+        """one stored entry from each variant's hits (or the exception it failed with), in variant order"""
+        hits, seen, more = [], set(), False
+        failures = [outcome for outcome in outcomes if isinstance(outcome, Exception)]
+        if len(failures) == len(outcomes):
+            raise ITunesUnavailable(term)
+        for variant_hits in outcomes:
+            if isinstance(variant_hits, Exception):
+                continue
+            more = more or len(variant_hits) >= limit  # a full page means iTunes may have more
+            for hit in variant_hits:
+                if hit[:3] not in seen:  # the same song listed twice (say on an album and a single) shows once
+                    seen.add(hit[:3])
+                    hits.append(hit)
+        return {'limit': limit, 'more': more and limit < MAX_LIMIT, 'hits': [list(hit) for hit in hits]}
+
+    def needs_fetch(self, term, limit):
+        """True when nothing fresh is stored for the (normalized) term with at least `limit` results per variant"""
+        entry = self.cache.get(term) if self.cache is not None else None
+        return entry is None or (entry['limit'] < limit and entry['more'])
+
+    def store(self, term, entry):
+        self.breaker.record_success()
+        if self.cache is not None:
+            self.cache.set(term, entry)
+
+    def wait_turn(self, timeout=None):
+        """waits until the rate limit allows a search (one call per variant); raises Throttled past `timeout`"""
+        if self.limiter is None:
+            return
+        try:
+            self.limiter.acquire(len(self.variants), timeout=self.limit_wait if timeout is None else timeout)
+        except Throttled:
+            self._count('throttled')
+            raise
+
+    def _stored(self, term, limit):
+        entry = self.cache.get(term) if self.cache is not None else None
+        return entry, entry is not None and (entry['limit'] >= limit or not entry['more'])
+
+    def _load(self, term, limit, wait=None):
+        """the stored results for term, fetched again if fewer than `limit` per variant were asked for.
+        `wait` is how long to wait for the rate limit (default limit_wait)"""
+        entry, fresh_enough = self._stored(term, limit)
+        if fresh_enough:
+            return entry
+        return self._single_flight((term, limit), self._refresh, term, limit, wait)
+
+    def _single_flight(self, key, fn, *args):
+        """fn(*args), unless a call for the same key is already running: then its result (or error) is shared"""
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+            else:
+                self.stats['coalesced'] += 1
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def _refresh(self, term, limit, wait=None):
+        entry, fresh_enough = self._stored(term, limit)
+        if fresh_enough:  # a fetch that finished just before ours started already stored it
+            return entry
+        if self.breaker.allow():
+            try:
+                self.wait_turn(wait)
+                self._count('fetches')
+                fresh = self._fetch_all(term, limit)
+            except Throttled:
+                pass  # not iTunes failing, so the breaker is left alone
+            except ITunesUnavailable:
+                self.breaker.record_failure()
+            else:
+                self.store(term, fresh)
+                return fresh
+        # iTunes is failing (or we are over the limit): what we already have, even a smaller or stale page, is better than nothing
+        entry = entry or (self.cache.get_stale(term) if self.cache is not None else None)
+        if entry is None:
+            raise ITunesUnavailable(term)
+        return entry
+
+    def _prefetch(self, term, limit):
+        with self._lock:
+            if term in self._prefetching:
+                return
+            self._prefetching.add(term)
+
+        def run():
+            try:
+                self._load(term, limit, wait=0)  # only with calls to spare, never queued ahead of searches
+            except ITunesUnavailable:
+                pass
+            finally:
+                with self._lock:
+                    self._prefetching.discard(term)
+        thr = threading.Thread(target=run)
+        thr.daemon = True
+        thr.start()
+
+    def search(self, term, start=0, count=10):
+        """TrackHits start to start+count for the search. All pages come from one stored result list,
+        fetched once and grown in the background as the user pages towards its end. Cached results are
+        used first and stale ones when iTunes is failing; raises ITunesUnavailable when there is nothing to serve."""
+        if start >= MAX_LIMIT * len(self.variants):
+            return []  # past the most iTunes returns for a search, so there is nothing to fetch
+        term = normalize_term(term)
+        end = start + count
+        entry = self._load(term, min(MAX_LIMIT, max(self.page_size, end)))
+        if entry['more'] and end > len(entry['hits']):  # deep page past what we have: this one has to wait
+            entry = self._load(term, min(MAX_LIMIT, max(end, entry['limit'] * 2)))
+        if entry['more'] and end + self.prefetch_margin > len(entry['hits']):
+            self._prefetch(term, min(MAX_LIMIT, entry['limit'] * 2))
+        return [TrackHit(*row) for row in entry['hits'][start:end]]
+
+    ## Track details, for the enrichment worker
+
+    def _results(self, url, params):
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return [TrackDetails.from_result(r) for r in loads(response.content).get('results', ())
+                if r.get('wrapperType', 'track') == 'track' and r.get('trackId')]
+
+    def lookup(self, track_ids):
+        """{track id: TrackDetails} for up to LOOKUP_IDS ids in one call; ids iTunes doesn't know are left out"""
+        details = self._results(self.lookup_url, {'id': ','.join(str(track_id) for track_id in track_ids),
+                                                  'entity': 'song'})
+        return dict((detail.track_id, detail) for detail in details)
+
+    def find_track(self, title, artist):
+        """TrackDetails of the song with this title and artist (ignoring case), or None"""
+        for detail in self._results(self.base_url, {'term': title + ' ' + artist, 'entity': 'song', 'limit': 10}):
+            if detail.title.lower() == title.lower() and detail.artist.lower() == artist.lower():
+                return detail
+        return None
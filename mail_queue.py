@@ -0,0 +1,269 @@
+"""Outgoing mail: a durable outbox table drained by a fixed pool of worker threads.
+
+send_email only writes a row to the outbox and hands its id to the pool. A
+worker claims as many queued messages as it can (up to batch_size) and sends
+them over one SMTP connection. add_many saves one row per recipient of a
+message that was rendered once, and queues them together so a single worker
+sends them all over the same connection, however many there are. A message
+the server turns down (a refused recipient, say) is retried on its own with
+exponential backoff while the rest of the batch goes on; only a lost
+connection puts everything not yet sent back for a retry. Retries are not
+timers: the workers poll the outbox when the next retry is due, and rows
+that are still pending after a restart are picked up the same way, or by
+the `drain_mail` manager command.
+"""
+import datetime
+import queue
+import smtplib
+import threading
+import time
+
+from sqlalchemy import select
+
+
+PENDING = 'pending'
+SENDING = 'sending'
+SENT = 'sent'
+FAILED = 'failed'
+
+
+class MailOutbox(object):
+
+    def __init__(self, app, db, model, workers=2, batch_size=20, max_attempts=5, backoff=30,
+                 stale_after=600, after_commit=None):
+        self.app = app
+        self.db = db
+        self.mail = None  # the Flask-Mail extension, set up when the first batch is sent
+        self.model = model  # the outbox table, see Outbox in msetton.py
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.backoff = backoff  # seconds before the first retry, doubled every attempt
+        self.stale_after = stale_after  # a 'sending' row older than this was left by a crashed worker
+        self.after_commit = after_commit  # after_commit(fn, *args) runs fn once the caller's transaction commits
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._next_poll = None  # time.time() when a retry is next due, None when none is known of
+
+    ## Producer side
+
+    def add(self, subject, sender, recipients, body=None, html=None):
+        """Stores the message in the outbox and queues it for the worker pool. Returns the outbox row's id.
+        With after_commit the row is saved with the rest of the caller's transaction and queued once that commits."""
+        return self.add_many(subject, sender, [recipients], body=body, html=html)[0]
+
+    def add_many(self, subject, sender, recipient_lists, body=None, html=None):
+        """Like add, with one outbox row (and so one status) for each list of recipients. Returns the ids."""
+        now = datetime.datetime.utcnow()
+        ids = self._insert([dict(subject=subject, sender=sender, recipients=','.join(recipients), body=body, html=html,
+                                 status=PENDING, attempts=0, created_at=now, next_attempt_at=now)
+                            for recipients in recipient_lists])
+        if self.after_commit is None:
+            self.db.session.commit()  # the rows have to exist before a worker can claim them
+            self.enqueue_many(ids)
+        else:
+            self.after_commit(self.enqueue_many, ids)
+        return ids
+
+    def _insert(self, rows):
+        """inserts the rows in one statement however many there are, returning their ids in order"""
+        table = self.model.__table__
+        session = self.db.session
+        if session.get_bind(clause=table.insert()).dialect.name == 'postgresql':
+            return [row_id for row_id, in session.execute(table.insert().values(rows).returning(table.c.id))]
+        # no RETURNING here (sqlite): one executemany, then our rows are the newest ones, since the insert holds the
+        # database's write lock until the transaction ends
+        session.execute(table.insert(), rows)
+        newest = session.execute(select([table.c.id]).order_by(table.c.id.desc()).limit(len(rows)))
+        return sorted(row_id for row_id, in newest)
+
+    def enqueue(self, message_id):
+        self.start()
+        self._queue.put([message_id])
+
+    def enqueue_many(self, message_ids):
+        """queues the messages as one item, so they are claimed and sent together"""
+        if message_ids:
+            self.start()
+            self._queue.put(list(message_ids))
+
+    ## Worker pool
+
+    def start(self):
+        """Starts the worker threads the first time mail is sent, so CLI commands never spawn them"""
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thr = threading.Thread(target=self._work, args=[i == 0], name='mail-worker-{}'.format(i))
+                thr.daemon = True
+                thr.start()
+                self._threads.append(thr)
+
+    def _work(self, recover=False):
+        if recover:
+            self._poll_at(time.time())  # anything left over from before a restart
+        while True:
+            try:
+                ids = self._queue.get(timeout=self._poll_timeout())  # a list of ids, all of them sent together
+            except queue.Empty:
+                self._poll()
+                continue
+            while len(ids) < self.batch_size:  # take whatever else is waiting so it shares the connection
+                try:
+                    ids = ids + self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            with self.app.app_context():
+                try:
+                    self._send_batch(self._claim(ids))
+                except Exception:
+                    self.app.logger.exception('Mail worker failed on messages %s', ids)
+                finally:
+                    self.db.session.remove()
+
+    def _poll_at(self, when):
+        with self._lock:
+            if self._next_poll is None or when < self._next_poll:
+                self._next_poll = when
+
+    def _poll_timeout(self):
+        with self._lock:
+            return None if self._next_poll is None else max(0.0, self._next_poll - time.time())
+
+    def _poll(self):
+        """queues the rows that are due, once the next retry's time has come, and notes when the one after is due.
+        Whichever worker wakes up first polls; the others find nothing to do."""
+        with self._lock:
+            if self._next_poll is None or self._next_poll > time.time():
+                return
+            self._next_poll = None
+        with self.app.app_context():
+            try:
+                ids = self._due_ids()
+                Outbox = self.model
+                later = self.db.session.query(self.db.func.min(Outbox.next_attempt_at))\
+                    .filter(Outbox.status == PENDING, Outbox.next_attempt_at > datetime.datetime.utcnow()).scalar()
+            except Exception:
+                self.app.logger.exception('Mail worker could not poll the outbox')
+                later = datetime.datetime.utcnow() + datetime.timedelta(seconds=self.backoff)
+                ids = []
+            finally:
+                self.db.session.remove()
+        for i in range(0, len(ids), self.batch_size):
+            self._queue.put(ids[i:i + self.batch_size])
+        if later is not None:
+            self._poll_at(time.time() + max(0.0, (later - datetime.datetime.utcnow()).total_seconds()))
+
+    ## Sending
+
+    def _due_ids(self):
+        now = datetime.datetime.utcnow()
+        stale = now - datetime.timedelta(seconds=self.stale_after)
+        Outbox = self.model
+        rows = self.db.session.query(Outbox.id).filter(
+            self.db.or_(self.db.and_(Outbox.status == PENDING, Outbox.next_attempt_at <= now),
+                        self.db.and_(Outbox.status == SENDING, Outbox.claimed_at < stale)))
+        return [message_id for message_id, in rows.order_by(Outbox.id).limit(self.batch_size * self.workers)]
+
+    def _claim(self, ids):
+        """Marks the rows as being sent. The conditional UPDATE means two workers (or processes) never send the same row."""
+        if not ids:
+            return []
+        now = datetime.datetime.utcnow()
+        stale = now - datetime.timedelta(seconds=self.stale_after)
+        Outbox = self.model
+        count = self.db.session.query(Outbox).filter(
+            Outbox.id.in_(ids),
+            self.db.or_(Outbox.status == PENDING,
+                        self.db.and_(Outbox.status == SENDING, Outbox.claimed_at < stale)))\
+            .update({'status': SENDING, 'claimed_at': now}, synchronize_session=False)
+        self.db.session.commit()
+        if not count:
+            return []
+        # the rows this claim took are the ones stamped with its time; another worker's claim has a different one
+        return Outbox.query.filter(Outbox.id.in_(ids), Outbox.status == SENDING, Outbox.claimed_at == now)\
+            .order_by(Outbox.id).all()
+
+    def _send_batch(self, rows):
+        """Sends rows over one SMTP connection. Returns the number sent."""
+        sent = 0
+        unsent = list(rows)
+        try:
+            if unsent:
+                with self._connect() as conn:
+                    while unsent:
+                        row = unsent[0]
+                        try:
+                            conn.send(self._message(row))
+                        except Exception as e:
+                            if _connection_lost(e):
+                                raise
+                            self._retry_later(row, e)  # only this message was turned down
+                        else:
+                            row.status = SENT
+                            row.sent_at = datetime.datetime.utcnow()
+                            sent += 1
+                        unsent.pop(0)
+        except Exception as e:
+            # the connection broke or could not be opened, so everything not yet sent waits for a retry
+            for row in unsent:
+                self._retry_later(row, e)
+        self.db.session.commit()
+        return sent
+
+    def _retry_later(self, row, error):
+        row.attempts = (row.attempts or 0) + 1
+        row.last_error = str(error)[:255]
+        if row.attempts >= self.max_attempts:
+            row.status = FAILED
+            return
+        delay = self.backoff * 2 ** (row.attempts - 1)
+        row.status = PENDING
+        row.next_attempt_at = datetime.datetime.utcnow() + datetime.timedelta(seconds=delay)
+        self._poll_at(time.time() + delay)
+
+    def _connect(self):
+        if self.mail is None:
+            from flask_mail import Mail  # only the mail workers need Flask-Mail, CLI commands never load it
+            self.mail = Mail(self.app)
+        return self.mail.connect()
+
+    def _message(self, row):
+        from flask_mail import Message
+        return Message(row.subject, sender=row.sender, recipients=row.recipients.split(','),
+                       body=row.body, html=row.html)
+
+    def status(self, message_ids):
+        """(recipients, status, last error) for each message, in the order given"""
+        Outbox = self.model
+        rows = dict((row.id, row) for row in Outbox.query.filter(Outbox.id.in_(message_ids))) if message_ids else {}
+        return [(rows[message_id].recipients, rows[message_id].status, rows[message_id].last_error)
+                for message_id in message_ids if message_id in rows]
+
+    def drain(self):
+        """Sends every message that is due, in this thread. Returns (sent, still pending, failed)."""
+        sent = 0
+        while True:
+            ids = self._due_ids()
+            if not ids:
+                break
+            rows = self._claim(ids)
+            if not rows:
+                break  # another worker got to them first
+            sent += self._send_batch(rows)
+        Outbox = self.model
+        pending = Outbox.query.filter(Outbox.status.in_([PENDING, SENDING])).count()
+        failed = Outbox.query.filter_by(status=FAILED).count()
+        return sent, pending, failed
+
+
+def _connection_lost(error):
+    """True for errors that leave the SMTP connection unusable, as opposed to one message being refused.
+    SMTPException is an OSError too, so the socket errors are told apart from the server's replies."""
+    if isinstance(error, smtplib.SMTPServerDisconnected):
+        return True
+    return isinstance(error, OSError) and not isinstance(error, smtplib.SMTPException)
@@ -0,0 +1,44 @@
+"""Unique constraints on artists, albums, songs and collections for bulk upserts
+
+Revision ID: 9a4e2c7b5d10
+Revises: 3c1f7a9d2e41
+Create Date: 2026-10-17 10:02:17.508112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4e2c7b5d10'
+down_revision = '3c1f7a9d2e41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Merge the duplicates concurrent saves created before these constraints existed,
+    # pointing songs and collections at the lowest id for each name first
+    for table, column in (('artists', 'artist_id'), ('albums', 'album_id')):
+        for referencing in ('songs', 'collections'):
+            op.execute("""
+                UPDATE {ref} SET {col} = d.keep
+                FROM (SELECT id, MIN(id) OVER (PARTITION BY name) AS keep FROM {table}) d
+                WHERE {ref}.{col} = d.id AND d.id <> d.keep
+            """.format(ref=referencing, col=column, table=table))
+        op.execute("DELETE FROM {table} a USING {table} b WHERE a.name = b.name AND a.id > b.id".format(table=table))
+    op.execute("DELETE FROM songs a USING songs b WHERE a.title = b.title AND a.artist_id = b.artist_id AND a.id > b.id")
+    op.execute("DELETE FROM collections a USING collections b "
+               "WHERE a.album_id = b.album_id AND a.artist_id = b.artist_id AND a.ctid > b.ctid")
+
+    op.create_unique_constraint('artists_name_key', 'artists', ['name'])
+    op.create_unique_constraint('albums_name_key', 'albums', ['name'])
+    op.create_unique_constraint('songs_title_artist_id_key', 'songs', ['title', 'artist_id'])
+    op.create_unique_constraint('collections_album_id_artist_id_key', 'collections', ['album_id', 'artist_id'])
+
+
+def downgrade():
+    op.drop_constraint('collections_album_id_artist_id_key', 'collections', type_='unique')
+    op.drop_constraint('songs_title_artist_id_key', 'songs', type_='unique')
+    op.drop_constraint('albums_name_key', 'albums', type_='unique')
+    op.drop_constraint('artists_name_key', 'artists', type_='unique')
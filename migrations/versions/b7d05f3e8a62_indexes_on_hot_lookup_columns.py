@@ -0,0 +1,32 @@
+"""Indexes on hot lookup columns
+
+Revision ID: b7d05f3e8a62
+Revises: 9a4e2c7b5d10
+Create Date: 2026-10-17 10:48:05.117420
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d05f3e8a62'
+down_revision = '9a4e2c7b5d10'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # songs.title, artists.name, albums.name and collections (album_id, artist_id) are already
+    # covered by the unique constraints from 9a4e2c7b5d10
+    op.create_index(op.f('ix_songs_artist_id'), 'songs', ['artist_id'], unique=False)
+    op.create_index(op.f('ix_songs_album_id'), 'songs', ['album_id'], unique=False)
+    op.create_index('ix_person_user_id_name', 'person', ['user_id', 'name'], unique=False)
+    op.create_index('ix_collections_artist_id', 'collections', ['artist_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_collections_artist_id', table_name='collections')
+    op.drop_index('ix_person_user_id_name', table_name='person')
+    op.drop_index(op.f('ix_songs_album_id'), table_name='songs')
+    op.drop_index(op.f('ix_songs_artist_id'), table_name='songs')
@@ -0,0 +1,65 @@
+"""Enrichment jobs table and iTunes details on songs, albums and artists
+
+Revision ID: d4a81c6f2b93
+Revises: b7d05f3e8a62
+Create Date: 2026-10-17 15:02:37.480112
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a81c6f2b93'
+down_revision = 'b7d05f3e8a62'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('enrichment_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('song_id', sa.Integer(), nullable=True),
+    sa.Column('itunes_id', sa.BigInteger(), nullable=True),
+    sa.Column('status', sa.String(length=16), nullable=True),
+    sa.Column('attempts', sa.Integer(), nullable=True),
+    sa.Column('last_error', sa.String(length=255), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=True),
+    sa.Column('next_attempt_at', sa.DateTime(), nullable=True),
+    sa.Column('claimed_at', sa.DateTime(), nullable=True),
+    sa.Column('claimed_by', sa.String(length=32), nullable=True),
+    sa.ForeignKeyConstraint(['song_id'], ['songs.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('song_id', name='enrichment_jobs_song_id_key')
+    )
+    op.create_index(op.f('ix_enrichment_jobs_status'), 'enrichment_jobs', ['status'], unique=False)
+    op.create_index(op.f('ix_enrichment_jobs_claimed_by'), 'enrichment_jobs', ['claimed_by'], unique=False)
+    # batch mode so the downgrade can drop columns on SQLite too
+    with op.batch_alter_table('songs') as batch_op:
+        batch_op.add_column(sa.Column('itunes_id', sa.BigInteger(), nullable=True))
+        batch_op.add_column(sa.Column('duration_ms', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('genre', sa.String(length=64), nullable=True))
+        batch_op.add_column(sa.Column('artwork_url', sa.String(length=255), nullable=True))
+        batch_op.add_column(sa.Column('enriched_at', sa.DateTime(), nullable=True))
+    with op.batch_alter_table('albums') as batch_op:
+        batch_op.add_column(sa.Column('itunes_id', sa.BigInteger(), nullable=True))
+        batch_op.add_column(sa.Column('artwork_url', sa.String(length=255), nullable=True))
+    with op.batch_alter_table('artists') as batch_op:
+        batch_op.add_column(sa.Column('itunes_id', sa.BigInteger(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('artists') as batch_op:
+        batch_op.drop_column('itunes_id')
+    with op.batch_alter_table('albums') as batch_op:
+        batch_op.drop_column('artwork_url')
+        batch_op.drop_column('itunes_id')
+    with op.batch_alter_table('songs') as batch_op:
+        batch_op.drop_column('enriched_at')
+        batch_op.drop_column('artwork_url')
+        batch_op.drop_column('genre')
+        batch_op.drop_column('duration_ms')
+        batch_op.drop_column('itunes_id')
+    op.drop_index(op.f('ix_enrichment_jobs_claimed_by'), table_name='enrichment_jobs')
+    op.drop_index(op.f('ix_enrichment_jobs_status'), table_name='enrichment_jobs')
+    op.drop_table('enrichment_jobs')
@@ -1,25 +1,39 @@
+import contextlib
 import os
-from flask import Flask, render_template, session, redirect, request, url_for, flash
+import sys
+from flask import Flask, render_template, session, redirect, request, url_for, flash, Response, stream_with_context, jsonify
 from flask_script import Manager, Shell
 from flask_wtf import FlaskForm
 from wtforms import StringField, SubmitField, FileField, PasswordField, BooleanField, SelectMultipleField, ValidationError
 from wtforms.validators import Required, Length, Email, Regexp, EqualTo
-from flask_sqlalchemy import SQLAlchemy
+from database import Database, RoutingSQLAlchemy
+import sqlalchemy
+from sqlalchemy import event, func, select, bindparam
+from sqlalchemy.orm import make_transient_to_detached
 import random
-from flask_migrate import Migrate, MigrateCommand
+import datetime
+import time
 
 # Imports for email from app
-from flask_mail import Mail, Message
-from threading import Thread
+from mail_queue import MailOutbox
 from werkzeug import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
+from passwords import PasswordHasher
 
 # Imports for login management
 from flask_login import LoginManager, login_required, logout_user, login_user, UserMixin, current_user
 
 # for looking up itunes
-import requests
-import json
+from cache import make_cache
+from rate_limit import make_limiter
+from itunes import ITunesClient, CircuitBreaker, ITunesUnavailable, TrackHit, SEARCH_URL, VARIANTS
+
+from song_index import SongIndex
+from prefix_index import PrefixIndex
+
+from instrumentation import Instrumentation
+from http_cache import HTTPCache
+from enrichment import Enricher
+from trending import Trending
 
 # Configure base directory of app
 basedir = os.path.abspath(os.path.dirname(__file__))
@@ -29,27 +43,141 @@ app = Flask(__name__)
 app.static_folder = 'static'
 app.config['SECRET_KEY'] = 'hardtoguessstring'
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get('DATABASE_URL') or "postgresql://localhost/msetton_364_final"  
-# Lines for db setup so it will work as expected
-app.config['SQLALCHEMY_COMMIT_ON_TEARDOWN'] = True
+# Lines for db setup so it will work as expected. Each request is one transaction, committed once (see database.py)
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['DB_POOL_SIZE'] = int(os.environ.get('DB_POOL_SIZE') or 5) # connections kept open per worker process
+app.config['DB_MAX_OVERFLOW'] = int(os.environ.get('DB_MAX_OVERFLOW') or 10) # extra connections allowed at peaks
+app.config['DB_POOL_TIMEOUT'] = float(os.environ.get('DB_POOL_TIMEOUT') or 10) # seconds to wait for a free connection
+app.config['DB_POOL_RECYCLE'] = int(os.environ.get('DB_POOL_RECYCLE') or 1800) # seconds before a connection is replaced
+app.config['DB_PRE_PING'] = True # check connections before use so a restarted server doesn't fail requests
+app.config['DB_REPLICA_URL'] = os.environ.get('DATABASE_REPLICA_URL') # reads in requests go here when it is set
+app.config['DB_PRIMARY_AFTER_WRITE'] = int(os.environ.get('DB_PRIMARY_AFTER_WRITE') or 10) # seconds a client reads from the primary after writing, longer than the replica lag
+app.config['DB_PGBOUNCER'] = (os.environ.get('DB_PGBOUNCER') or '').lower() == 'true' # DATABASE_URL points at PgBouncer (transaction pooling)
+app.config['SONGS_PER_PAGE'] = int(os.environ.get('SONGS_PER_PAGE') or 50) # page size for /all_songs
 
 # Set up email config stuff
-app.config['MAIL_SERVER'] = 'smtp.googlemail.com'
-app.config['MAIL_PORT'] = 587 #default
-app.config['MAIL_USE_TLS'] = True
+app.config['MAIL_SERVER'] = os.environ.get('MAIL_SERVER') or 'smtp.googlemail.com' # e.g. localhost with `python -m aiosmtpd -n -l localhost:1025` for testing
+app.config['MAIL_PORT'] = int(os.environ.get('MAIL_PORT') or 587) #default
+app.config['MAIL_USE_TLS'] = (os.environ.get('MAIL_USE_TLS') or 'true').lower() == 'true'
 app.config['MAIL_USERNAME'] = os.environ.get('MAIL_USERNAME') # TODO export to your environs -- may want a new account just for this. It's expecting gmail, not umich
 app.config['MAIL_PASSWORD'] = os.environ.get('MAIL_PASSWORD')
 app.config['MAIL_SUBJECT_PREFIX'] = '[Songs App]'
 app.config['MAIL_SENDER'] = 'Admin <>' # TODO fill in email
 app.config['ADMIN'] = os.environ.get('ADMIN') or "marielse4321@gmail.com" # If Admin in environ variable / in prod or this fake email
 app.config['HEROKU_ON'] = os.environ.get('HEROKU')
+app.config['MAIL_WORKERS'] = int(os.environ.get('MAIL_WORKERS') or 2) # threads sending from the outbox
+app.config['MAIL_BATCH_SIZE'] = 20 # messages sent over one SMTP connection
+app.config['MAIL_MAX_ATTEMPTS'] = 5
+app.config['MAIL_RETRY_BACKOFF'] = 30 # seconds before the first retry, doubled each time
+app.config['MAX_RECIPIENTS'] = int(os.environ.get('MAX_RECIPIENTS') or 100) # friends one send may go to
+app.config['SEND_STATUS_REFRESHES'] = 10 # times the status page reloads itself while messages are pending
+
+# Cache for iTunes search results -- 'memory' is per process, 'sqlite' is shared by every worker on the machine
+app.config['SEARCH_CACHE_BACKEND'] = os.environ.get('SEARCH_CACHE_BACKEND') or 'memory'
+app.config['SEARCH_CACHE_PATH'] = os.environ.get('SEARCH_CACHE_PATH') or os.path.join(basedir, 'search_cache.sqlite')
+app.config['SEARCH_CACHE_SIZE'] = int(os.environ.get('SEARCH_CACHE_SIZE') or 512)
+app.config['SEARCH_CACHE_TTL'] = int(os.environ.get('SEARCH_CACHE_TTL') or 600) # seconds
+app.config['SEARCH_CACHE_STALE_TTL'] = int(os.environ.get('SEARCH_CACHE_STALE_TTL') or 3600) # seconds expired results are kept to serve while iTunes is down
+# Cache for logged in users and their friend lists. With several workers use 'sqlite' so an update in one worker
+# clears the entry for all of them; with 'memory' other workers can be behind by up to USER_CACHE_TTL
+app.config['USER_CACHE_BACKEND'] = os.environ.get('USER_CACHE_BACKEND') or 'memory'
+app.config['USER_CACHE_PATH'] = os.environ.get('USER_CACHE_PATH') or os.path.join(basedir, 'user_cache.sqlite')
+app.config['USER_CACHE_SIZE'] = int(os.environ.get('USER_CACHE_SIZE') or 1024)
+app.config['USER_CACHE_TTL'] = int(os.environ.get('USER_CACHE_TTL') or 300) # seconds
+# Answer searches from the saved songs when a full page of them contain every word searched for, see song_index.py
+app.config['LOCAL_SEARCH'] = (os.environ.get('LOCAL_SEARCH') or 'true').lower() == 'true'
+app.config['LOCAL_SEARCH_REFRESH'] = 30 # seconds between checks for songs saved by other workers
+app.config['AUTOCOMPLETE_MAX_ENTRIES'] = int(os.environ.get('AUTOCOMPLETE_MAX_ENTRIES') or 1000000) # titles, artists and albums kept for suggestions
+app.config['ITUNES_PAGE_SIZE'] = 50 # results asked for per search variant; later pages are served from these
+# Search variants fetched and merged per search: 1 is by song, 2 adds music tracks, 3 adds by artist. Each one is a
+# call counted against ITUNES_CALLS_PER_MINUTE, so 3 means a third as many searches a minute
+app.config['ITUNES_SEARCH_VARIANTS'] = int(os.environ.get('ITUNES_SEARCH_VARIANTS') or 1)
+# Password hashing: any werkzeug method, e.g. 'pbkdf2:sha256:260000'. Logins with older settings are rehashed
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD') or 'pbkdf2:sha256'
+app.config['PASSWORD_SALT_LENGTH'] = int(os.environ.get('PASSWORD_SALT_LENGTH') or 8)
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS') or 2) # threads doing hashing at once
+app.config['ITUNES_SEARCH_URL'] = os.environ.get('ITUNES_SEARCH_URL') or SEARCH_URL # point at a local fake server for testing
+app.config['ITUNES_CONNECT_TIMEOUT'] = float(os.environ.get('ITUNES_CONNECT_TIMEOUT') or 2) # seconds
+app.config['ITUNES_READ_TIMEOUT'] = float(os.environ.get('ITUNES_READ_TIMEOUT') or 5)
+app.config['ITUNES_POOL_SIZE'] = int(os.environ.get('ITUNES_POOL_SIZE') or 30) # keep-alive connections (and fetch threads)
+app.config['ITUNES_FAILURE_THRESHOLD'] = 3 # failures in a row before we stop calling iTunes for a while
+app.config['ITUNES_RETRY_AFTER'] = 30 # seconds
+app.config['ITUNES_LOOKUP_URL'] = os.environ.get('ITUNES_LOOKUP_URL') # default: the search URL with /search replaced by /lookup
+# Rate limit on iTunes search calls (each search is one call per variant), see rate_limit.py. 'sqlite' shares the
+# limit between every worker on the machine; with 'memory' each worker gets the whole limit to itself
+app.config['ITUNES_CALLS_PER_MINUTE'] = float(os.environ.get('ITUNES_CALLS_PER_MINUTE') or 20) # what Apple allows, roughly
+app.config['ITUNES_RATE_BURST'] = int(os.environ.get('ITUNES_RATE_BURST') or 20) # calls that can be made at once after a quiet spell
+app.config['ITUNES_RATE_WAIT'] = float(os.environ.get('ITUNES_RATE_WAIT') or 3) # seconds a search waits for its turn before stored results are served
+app.config['ITUNES_RATE_BACKEND'] = os.environ.get('ITUNES_RATE_BACKEND') or 'sqlite'
+app.config['ITUNES_RATE_PATH'] = os.environ.get('ITUNES_RATE_PATH') or os.path.join(basedir, 'rate_limit.sqlite')
+# Background enrichment with durations, genres, artwork and iTunes ids (python msetton.py enrich), see enrichment.py
+app.config['ENRICH_WORKERS'] = int(os.environ.get('ENRICH_WORKERS') or 2) # threads in the enrich process
+app.config['ENRICH_CALLS_PER_MINUTE'] = int(os.environ.get('ENRICH_CALLS_PER_MINUTE') or 10) # per enrich process, out of ITUNES_CALLS_PER_MINUTE for the machine
+# Save and share counters behind /trending, see trending.py
+app.config['TRENDING_HALF_LIFE'] = float(os.environ.get('TRENDING_HALF_LIFE') or 24) * 3600 # hours until a save or share counts half as much
+app.config['TRENDING_SHARE_WEIGHT'] = 3 # a share counts as much as this many saves
+app.config['TRENDING_FLUSH_EVERY'] = 10 # seconds between writes of each worker's counters
+app.config['TRENDING_SIZE'] = 50 # songs on each list
+app.config['TRENDING_REFRESH'] = 30 # seconds a worker reuses the lists before reading them again
+
+# Request timing, query counts and /metrics -- off unless INSTRUMENTATION=true, see instrumentation.py
+app.config['INSTRUMENTATION'] = (os.environ.get('INSTRUMENTATION') or '').lower() == 'true'
+app.config['PROFILE_SAMPLE_RATE'] = float(os.environ.get('PROFILE_SAMPLE_RATE') or 0) # e.g. 0.01 to profile 1% of requests
+app.config['SLOW_REQUEST_SECONDS'] = float(os.environ.get('SLOW_REQUEST_SECONDS') or 1)
+app.config['PROFILE_DIR'] = os.path.join(basedir, 'profiles')
+
+# ETags, 304s and compression for the listing and form pages, see http_cache.py
+app.config['HTTP_COMPRESS_MIN_SIZE'] = 1024 # bytes, smaller pages aren't worth compressing
+app.config['FRAGMENT_CACHE_SIZE'] = int(os.environ.get('FRAGMENT_CACHE_SIZE') or 256) # rendered pages kept per worker, 0 turns it off
+app.config['FRAGMENT_CACHE_TTL'] = 300 # seconds
+
+# Production server, see server.py. WEB_CONCURRENCY is what Heroku sets for the number of processes
+app.config['SERVER_WORKERS'] = int(os.environ.get('WEB_CONCURRENCY') or 0) # 0 means one per CPU
+app.config['SERVER_THREADS'] = int(os.environ.get('SERVER_THREADS') or 4) # threads per worker
+app.config['SERVER_PIDFILE'] = os.environ.get('SERVER_PIDFILE') or os.path.join(basedir, 'server.pid')
 
 # Set up Flask debug and necessary additions to app
 manager = Manager(app)
-db = SQLAlchemy(app) # For database use
-migrate = Migrate(app, db) # For database use/updating
-manager.add_command('db', MigrateCommand) # Add migrate command to manager
-mail = Mail(app) # For email sending
+db = RoutingSQLAlchemy(app) # For database use (flask_sqlalchemy, with reads routed to the replica if there is one)
+database = Database(app, db) # pool settings and the per-request transaction
+search_cache = make_cache(app.config['SEARCH_CACHE_BACKEND'], maxsize=app.config['SEARCH_CACHE_SIZE'],
+                          ttl=app.config['SEARCH_CACHE_TTL'], path=app.config['SEARCH_CACHE_PATH'],
+                          stale_ttl=app.config['SEARCH_CACHE_STALE_TTL'])
+user_cache = make_cache(app.config['USER_CACHE_BACKEND'], maxsize=app.config['USER_CACHE_SIZE'],
+                        ttl=app.config['USER_CACHE_TTL'], path=app.config['USER_CACHE_PATH'])
+itunes = ITunesClient(app.config['ITUNES_SEARCH_URL'], cache=search_cache,
+                      connect_timeout=app.config['ITUNES_CONNECT_TIMEOUT'], read_timeout=app.config['ITUNES_READ_TIMEOUT'],
+                      pool_size=app.config['ITUNES_POOL_SIZE'],
+                      breaker=CircuitBreaker(app.config['ITUNES_FAILURE_THRESHOLD'], app.config['ITUNES_RETRY_AFTER']),
+                      page_size=app.config['ITUNES_PAGE_SIZE'], variants=VARIANTS[:app.config['ITUNES_SEARCH_VARIANTS']],
+                      lookup_url=app.config['ITUNES_LOOKUP_URL'],
+                      limiter=make_limiter(app.config['ITUNES_RATE_BACKEND'], app.config['ITUNES_CALLS_PER_MINUTE'],
+                                           burst=app.config['ITUNES_RATE_BURST'], path=app.config['ITUNES_RATE_PATH'],
+                                           name='itunes_search'),
+                      limit_wait=app.config['ITUNES_RATE_WAIT'])
+passwords = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], salt_length=app.config['PASSWORD_SALT_LENGTH'],
+                           workers=app.config['PASSWORD_HASH_WORKERS'])
+song_index = SongIndex(loader=lambda after_id: song_listing_query(after_id).yield_per(1000),
+                       refresh_every=app.config['LOCAL_SEARCH_REFRESH'])
+autocomplete = PrefixIndex(loader=lambda after_id: load_song_listing(after_id),
+                           max_entries=app.config['AUTOCOMPLETE_MAX_ENTRIES'], refresh_every=app.config['LOCAL_SEARCH_REFRESH'])
+instrumentation = Instrumentation(app, db)
+http_cache = HTTPCache(app)
+if instrumentation.enabled:
+    itunes.response_hooks.append(instrumentation.http_hook)
+    itunes.wrap_task = instrumentation.carry # the fetches run on the client's threads, outside the request
+    instrumentation.add_collector(lambda: [('songs_search_cache_' + name, 'counter', value, {})
+                                           for name, value in sorted(search_cache.stats.as_dict().items())])
+    instrumentation.add_collector(lambda: [('songs_itunes_' + name, 'counter', value, {})
+                                           for name, value in sorted(itunes.stats.items())])
+    instrumentation.add_collector(lambda: [('songs_itunes_rate_limit_' + name, 'counter', value, {})
+                                           for name, value in sorted(itunes.limiter.stats.as_dict().items())])
+    instrumentation.add_collector(lambda: [('songs_autocomplete_' + name, 'gauge', value, {})
+                                           for name, value in sorted(autocomplete.stats().items())])
+    if http_cache.fragments is not None:
+        instrumentation.add_collector(lambda: [('songs_fragment_cache_' + name, 'counter', value, {})
+                                               for name, value in sorted(http_cache.fragments.stats.as_dict().items())])
+    instrumentation.add_collector(lambda: [('songs_db_' + name, kind, value, {}) for name, kind, value in database.metrics()])
 
 # Login configurations setup
 login_manager = LoginManager()
@@ -60,29 +188,36 @@ login_manager.init_app(app) # set up login manager
 ## Set up Shell context so it's easy to use the shell to debug
 # Define function
 def make_shell_context():
-    return dict( app=app, db=db, Song=Song, Artist=Artist, User=User)#, Playlist=Playlist)
+    return dict( app=app, db=db, Song=Song, Artist=Artist, User=User, Outbox=Outbox, search_cache=search_cache, itunes=itunes, song_index=song_index, autocomplete=autocomplete, bulk_get_or_create_songs=bulk_get_or_create_songs)#, Playlist=Playlist)
 # Add function use to manager
 manager.add_command("shell", Shell(make_context=make_shell_context))
 
+## Migrations (python msetton.py db upgrade). Flask-Migrate imports all of alembic, a quarter of the time it takes
+## to start any command, so it is only set up when a db command runs
+def init_migrations():
+    from flask_migrate import Migrate, MigrateCommand
+    Migrate(app, db)
+    return MigrateCommand
+
 #########
 ######### Everything above this line is important/useful setup, not mostly application-specific problem-solving.
 #########
 
 ##### Functions to send email #####
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
-
 def send_email(to, subject, template, **kwargs): # kwargs = 'keyword arguments', this syntax means to unpack any keyword arguments into the function in the invocation...
-    msg = Message(app.config['MAIL_SUBJECT_PREFIX'] + ' ' + subject,
-                  sender=app.config['MAIL_SENDER'], recipients=[to])
-    msg.body = render_template(template + '.txt', **kwargs)
-    msg.html = render_template(template + '.html', **kwargs)
-    thr = Thread(target=send_async_email, args=[app, msg]) # using the async email to make sure the email sending doesn't take up all the "app energy" -- the main thread -- at once
-    thr.start()
-    return thr # The thread being returned
-    # However, if your app sends a LOT of email, it'll be better to set up some additional "queuing" software libraries to handle it. But we don't need to do that yet. Not quite enough users!
+    # The message is saved in the outbox table and sent by the mail worker pool, so the request doesn't wait on SMTP
+    # and nothing is lost if the app restarts before it goes out (see mail_queue.py)
+    return send_emails([to], subject, template, **kwargs)[0]
+
+def send_emails(recipients, subject, template, **kwargs):
+    # The same message to each recipient, separately: rendered once, one outbox row (and status) per recipient,
+    # and sent together over one SMTP connection. Returns the outbox ids
+    body = render_template(template + '.txt', **kwargs)
+    html = render_template(template + '.html', **kwargs)
+    with instrumentation.span('mail'):
+        return mail_outbox.add_many(app.config['MAIL_SUBJECT_PREFIX'] + ' ' + subject, app.config['MAIL_SENDER'],
+                                    [[to] for to in recipients], body=body, html=html)
 
 ##### Set up Models #####
 
@@ -90,7 +225,9 @@ def send_email(to, subject, template, **kwargs): # kwargs = 'keyword arguments',
 #collections = db.Table('collections', db.Column('user_id',db.Integer, db.ForeignKey('person.id')),db.Column('song_id',db.Integer, db.ForeignKey('songs.id')))
 
 # Set up association Table between artists and albums
-collections = db.Table('collections',db.Column('album_id',db.Integer, db.ForeignKey('albums.id')),db.Column('artist_id',db.Integer, db.ForeignKey('artists.id')))
+collections = db.Table('collections',db.Column('album_id',db.Integer, db.ForeignKey('albums.id')),db.Column('artist_id',db.Integer, db.ForeignKey('artists.id')),
+                       db.UniqueConstraint('album_id','artist_id',name='collections_album_id_artist_id_key'),
+                       db.Index('ix_collections_artist_id','artist_id'))
 
 # Special model for users to log in
 class User(UserMixin, db.Model):
@@ -107,13 +244,14 @@ class User(UserMixin, db.Model):
 
     @password.setter
     def password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = passwords.hash(password)
 
     def verify_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return passwords.verify(self.password_hash, password)
 
 class Person(db.Model):
     __tablename__ = "person"
+    __table_args__ = (db.Index('ix_person_user_id_name','user_id','name'),) # friend list and get_or_create_person
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(64))
     name = db.Column(db.String(64))
@@ -121,28 +259,152 @@ class Person(db.Model):
 
 class Song(db.Model):
     __tablename__ = "songs"
+    __table_args__ = (db.UniqueConstraint('title','artist_id',name='songs_title_artist_id_key'),)
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(64))
-    artist_id = db.Column(db.Integer, db.ForeignKey("artists.id"))
-    album_id = db.Column(db.Integer, db.ForeignKey("albums.id"))
+    artist_id = db.Column(db.Integer, db.ForeignKey("artists.id"), index=True)
+    album_id = db.Column(db.Integer, db.ForeignKey("albums.id"), index=True)
+    # filled in by the enrich command
+    itunes_id = db.Column(db.BigInteger)
+    duration_ms = db.Column(db.Integer)
+    genre = db.Column(db.String(64))
+    artwork_url = db.Column(db.String(255))
+    enriched_at = db.Column(db.DateTime)
 
 class Artist(db.Model):
     __tablename__ = "artists"
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(64))
+    name = db.Column(db.String(64), unique=True)
+    itunes_id = db.Column(db.BigInteger)
     songs = db.relationship('Song',backref='Artist')
 
 class Album(db.Model):
     __tablename__ = "albums"
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(64))
+    name = db.Column(db.String(64), unique=True)
+    itunes_id = db.Column(db.BigInteger)
+    artwork_url = db.Column(db.String(255))
     artists = db.relationship('Artist',secondary=collections,backref=db.backref('albums',lazy='dynamic'),lazy='dynamic')
     songs = db.relationship('Song',backref='Album')
 
+# Emails waiting to be sent, see mail_queue.py
+class Outbox(db.Model):
+    __tablename__ = "outbox"
+    id = db.Column(db.Integer, primary_key=True)
+    subject = db.Column(db.String(255))
+    sender = db.Column(db.String(255))
+    recipients = db.Column(db.Text)
+    body = db.Column(db.Text)
+    html = db.Column(db.Text)
+    status = db.Column(db.String(16), index=True) # pending, sending, sent or failed
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime)
+    claimed_at = db.Column(db.DateTime)
+    sent_at = db.Column(db.DateTime)
+
+# Saves and shares of each song, see trending.py
+class SongStats(db.Model):
+    __tablename__ = "song_stats"
+    song_id = db.Column(db.Integer, db.ForeignKey("songs.id"), primary_key=True)
+    saves = db.Column(db.Integer, default=0)
+    shares = db.Column(db.Integer, default=0, index=True)
+    score = db.Column(db.Float, index=True) # time-decayed activity, higher is hotter
+
+# Songs waiting for their iTunes details, see enrichment.py
+class EnrichmentJob(db.Model):
+    __tablename__ = "enrichment_jobs"
+    id = db.Column(db.Integer, primary_key=True)
+    song_id = db.Column(db.Integer, db.ForeignKey("songs.id"), unique=True) # one job per song, however often it is saved
+    itunes_id = db.Column(db.BigInteger) # the track id from the search it was picked from, if any
+    status = db.Column(db.String(16), index=True) # pending, working, done, missing or failed
+    attempts = db.Column(db.Integer, default=0)
+    last_error = db.Column(db.String(255))
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime)
+    claimed_at = db.Column(db.DateTime)
+    claimed_by = db.Column(db.String(32), index=True)
+
+mail_outbox = MailOutbox(app, db, Outbox, workers=app.config['MAIL_WORKERS'],
+                         batch_size=app.config['MAIL_BATCH_SIZE'], max_attempts=app.config['MAIL_MAX_ATTEMPTS'],
+                         backoff=app.config['MAIL_RETRY_BACKOFF'], after_commit=database.after_commit)
+
+@manager.command
+def drain_mail():
+    """Send every email waiting in the outbox"""
+    sent, pending, failed = mail_outbox.drain()
+    print('Sent {} emails. {} still waiting for a retry, {} failed for good.'.format(sent, pending, failed))
+
+@manager.option('-s', '--server', dest='server', default='uvicorn', help='uvicorn or hypercorn')
+@manager.option('-t', '--threads', dest='threads', type=int, default=16, help='threads running the Flask views')
+@manager.option('-p', '--port', dest='port', type=int, default=5000)
+@manager.option('-h', '--host', dest='host', default='127.0.0.1')
+def serve_async(host, port, threads, server):
+    """Serve through an ASGI server; song searches await iTunes on the event loop instead of holding a thread"""
+    from asgi import AsyncSongApp, run
+    autocomplete.refresh_soon()
+    run(AsyncSongApp(app, itunes, local_search, threads=threads), host=host, port=port, server=server)
+
+def warm_indexes():
+    if app.config['LOCAL_SEARCH']:
+        song_index.refresh(force=True)
+    autocomplete.refresh(force=True)
+
+@manager.option('-t', '--threads', dest='threads', type=int, default=app.config['SERVER_THREADS'], help='threads per worker')
+@manager.option('-w', '--workers', dest='workers', type=int, default=app.config['SERVER_WORKERS'], help='processes, 0 for one per CPU')
+@manager.option('-p', '--port', dest='port', type=int, default=int(os.environ.get('PORT') or 5000))
+@manager.option('-h', '--host', dest='host', default='0.0.0.0')
+def serve(host, port, workers, threads):
+    """Serve with gunicorn: preforked workers that share the preloaded app and warm their db connections"""
+    from server import PreforkServer
+    PreforkServer(app, db, warmers=[warm_indexes, itunes.open_session], bind='{}:{}'.format(host, port), workers=workers or os.cpu_count() or 1,
+                  threads=threads, worker_class='gthread', pidfile=app.config['SERVER_PIDFILE']).run()
+
+@manager.command
+def reload_server():
+    """Restart the server started by serve with the current code, without dropping requests"""
+    from server import reload
+    print('Server now running as pid {}'.format(reload(app.config['SERVER_PIDFILE'])))
+
 # DB load functions
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id)) # returns User object or None
+    # returns User object or None. The columns are cached so most requests don't need to query the users table.
+    # The password hash is left out, so it is never written to the cache (a file with the sqlite backend); login
+    # loads the user from the database, and anything else reading it from a cached user loads it then
+    key = 'user:{}'.format(int(user_id))
+    data = user_cache.get(key)
+    if data is None:
+        user = User.query.get(int(user_id))
+        if user is not None:
+            user_cache.set(key, dict(id=user.id, username=user.username, email=user.email))
+        return user
+    user = User(**data)
+    make_transient_to_detached(user) # so merge can attach it to the session as an existing row without a SELECT
+    return db.session.merge(user, load=False)
+
+def friends_of(user_id):
+    """(name, email) for each saved friend of the user"""
+    key = 'friends:{}'.format(user_id)
+    friends = user_cache.get(key)
+    if friends is None:
+        friends = [(name, email) for name, email in db.session.query(Person.name, Person.email).filter_by(user_id=user_id).order_by(Person.id)]
+        user_cache.set(key, friends)
+    return friends
+
+# Drop cached users and friend lists whenever the rows behind them change. These events fire at flush time, so the
+# entry is dropped once the transaction commits: dropped any earlier, another request could cache the old rows again
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def user_changed(mapper, connection, user):
+    database.after_commit(user_cache.delete, 'user:{}'.format(user.id))
+
+@event.listens_for(Person, 'after_insert')
+@event.listens_for(Person, 'after_update')
+@event.listens_for(Person, 'after_delete')
+def friend_changed(mapper, connection, person):
+    database.after_commit(user_cache.delete, 'friends:{}'.format(person.user_id))
 
 ##### Forms #####
 
@@ -154,6 +416,10 @@ class sendEamil(FlaskForm):
     email = StringField("Enter your friend's email:", validators=[Required(),Length(1,64),Email()])
     submit = SubmitField('Submit')
 
+class SendToFriendsForm(FlaskForm):
+    # the friends are checkboxes written by the template; the form is here for its CSRF token
+    submit = SubmitField('Send to the friends you picked')
+
 class RegistrationForm(FlaskForm):
     email = StringField('Enter your email:', validators=[Required(),Length(1,64),Email()])
     username = StringField('Enter your username:',validators=[Required(),Length(1,64),Regexp('^[A-Za-z][A-Za-z0-9_.]*$',0,'Usernames must have only letters, numbers, dots or underscores')])
@@ -190,27 +456,73 @@ def get_or_create_artist(db_session,artist_name):
     else:
         artist = Artist(name=artist_name)
         db_session.add(artist)
-        db_session.commit()
+        db_session.flush()
         return artist
 
 def get_or_create_song(db_session, song_title, song_artist, song_album):
-    artist = get_or_create_artist(db_session, song_artist)
-    album = get_or_create_album(db_session, song_album, artists_list=[song_artist])
-    song = db_session.query(Song).filter_by(title=song_title, artist_id=artist.id).first()
-    if song:
-        return song
-    song = Song(title=song_title,artist_id=artist.id,album_id=album.id)
-    db_session.add(song)
-    db_session.commit()
+    # goes through the bulk path so the artist, album and song are saved in one transaction without racing other requests
+    song = bulk_get_or_create_songs(db_session, [(song_title, song_artist, song_album)])[0]
+    database.after_commit(trending.add, song_title, song_artist, 'saves')
     return song
 
+def _insert_ignoring_duplicates(db_session, table, rows):
+    """INSERT ... ON CONFLICT DO NOTHING on postgres, INSERT OR IGNORE on sqlite"""
+    if not rows:
+        return
+    if db_session.get_bind().dialect.name == 'postgresql':
+        from sqlalchemy.dialects import postgresql
+        stmt = postgresql.insert(table).on_conflict_do_nothing()
+    else:
+        stmt = table.insert().prefix_with('OR IGNORE')
+    db_session.execute(stmt, rows)
+
+def save_tracks(db_session, tracks):
+    """Saves many (title, artist name, album name) tuples with a few set-based statements, however many
+    tracks there are, in the caller's transaction, without loading any objects.
+    Returns ({artist name: id}, {album name: id}, {(title, artist id): album id})."""
+    artist_names = set(artist for _, artist, _ in tracks)
+    album_names = set(album for _, _, album in tracks)
+    _insert_ignoring_duplicates(db_session, Artist.__table__, [{'name': name} for name in artist_names])
+    _insert_ignoring_duplicates(db_session, Album.__table__, [{'name': name} for name in album_names])
+    artist_ids = dict(db_session.query(Artist.name, Artist.id).filter(Artist.name.in_(artist_names)))
+    album_ids = dict(db_session.query(Album.name, Album.id).filter(Album.name.in_(album_names)))
+
+    pairs = set((album_ids[album], artist_ids[artist]) for _, artist, album in tracks)
+    _insert_ignoring_duplicates(db_session, collections, [{'album_id': album_id, 'artist_id': artist_id} for album_id, artist_id in pairs])
+    new_songs = {}
+    for title, artist, album in tracks:
+        new_songs.setdefault((title, artist_ids[artist]), album_ids[album]) # first album wins, like get_or_create_song always did
+    _insert_ignoring_duplicates(db_session, Song.__table__, [{'title': title, 'artist_id': artist_id, 'album_id': album_id}
+                                                             for (title, artist_id), album_id in new_songs.items()])
+    return artist_ids, album_ids, new_songs
+
+def bulk_get_or_create_songs(db_session, tracks):
+    """save_tracks, then the Song for each tuple, in the same order"""
+    tracks = [tuple(track) for track in tracks]
+    if not tracks:
+        return []
+    artist_ids, album_ids, new_songs = save_tracks(db_session, tracks)
+    titles = set(title for title, _ in new_songs)
+    songs = db_session.query(Song).filter(Song.title.in_(titles), Song.artist_id.in_(set(artist_ids.values())))
+    songs = dict(((song.title, song.artist_id), song) for song in songs)
+    artist_names = dict((artist_id, name) for name, artist_id in artist_ids.items())
+    album_names = dict((album_id, name) for name, album_id in album_ids.items())
+    saved = [(song.id, song.title, artist_names[song.artist_id], album_names.get(song.album_id, '')) for song in songs.values()]
+    database.after_commit(index_songs, saved) # only songs that really got saved go into the search indexes
+    return [songs[(title, artist_ids[artist])] for title, artist, _ in tracks]
+
+def index_songs(saved):
+    for song_id, title, artist, album in saved:
+        song_index.add(song_id, title, artist, album)
+    autocomplete.invalidate()
+
 def get_or_create_person(db_session, person_name, person_email):
     person = db_session.query(Person).filter_by(name=person_name, user_id=current_user.id).first()
     if person:
         return person
     person = Person(name=person_name, email=person_email, user_id=current_user.id)
     db_session.add(person)
-    db_session.commit()
+    db_session.flush()
     return person
 
 def get_or_create_album(db_session, album_name, artists_list=[]):
@@ -223,10 +535,209 @@ def get_or_create_album(db_session, album_name, artists_list=[]):
             artist = get_or_create_artist(db_session,artist)
             album.artists.append(artist)
         db_session.add(album)
-        db_session.commit()
+        db_session.flush()
     return album
 
 
+def hot_queries():
+    """(name, query, index it must use) for the lookups that run on every request, checked by check_query_plans"""
+    return [
+        ('get_song_by_name', Song.query.filter_by(title='x'), 'songs_title_artist_id_key'),
+        ('get_or_create_song', Song.query.filter_by(title='x', artist_id=1), 'songs_title_artist_id_key'),
+        ('songs by artist', Song.query.filter_by(artist_id=1), 'ix_songs_artist_id'),
+        ('get_or_create_artist', Artist.query.filter_by(name='x'), 'artists_name_key'),
+        ('get_or_create_album', Album.query.filter_by(name='x'), 'albums_name_key'),
+        ('saved_friends', Person.query.filter_by(user_id=1), 'ix_person_user_id_name'),
+        ('get_or_create_person', Person.query.filter_by(name='x', user_id=1), 'ix_person_user_id_name'),
+        ('album artists', db.session.query(collections).filter_by(album_id=1), 'collections_album_id_artist_id_key'),
+        ('artist albums', db.session.query(collections).filter_by(artist_id=1), 'ix_collections_artist_id'),
+    ]
+
+# sqlite names the indexes behind unique constraints itself
+SQLITE_INDEX_NAMES = {'songs_title_artist_id_key': 'sqlite_autoindex_songs_1', 'artists_name_key': 'sqlite_autoindex_artists_1',
+                      'albums_name_key': 'sqlite_autoindex_albums_1',
+                      'collections_album_id_artist_id_key': 'sqlite_autoindex_collections_1'}
+# the fixed dataset the plans are checked against, big enough that an index beats reading the table
+PLAN_CHECK_ROWS = dict(users=500, friends=20, artists=2000, albums=4000, songs=20000)
+
+def seed_plan_check(connection):
+    rows = PLAN_CHECK_ROWS
+    connection.execute(User.__table__.insert(), [dict(id=i, username='user{}'.format(i), email='user{}@example.com'.format(i))
+                                                 for i in range(1, rows['users'] + 1)])
+    connection.execute(Person.__table__.insert(), [dict(id=i, name='friend{}'.format(i), email='friend{}@example.com'.format(i),
+                                                        user_id=i % rows['users'] + 1)
+                                                   for i in range(1, rows['users'] * rows['friends'] + 1)])
+    connection.execute(Artist.__table__.insert(), [dict(id=i, name='Artist {}'.format(i)) for i in range(1, rows['artists'] + 1)])
+    connection.execute(Album.__table__.insert(), [dict(id=i, name='Album {}'.format(i)) for i in range(1, rows['albums'] + 1)])
+    connection.execute(collections.insert(), [dict(album_id=i, artist_id=i % rows['artists'] + 1) for i in range(1, rows['albums'] + 1)])
+    connection.execute(Song.__table__.insert(), [dict(id=i, title='Song {}'.format(i), artist_id=i % rows['artists'] + 1,
+                                                      album_id=i % rows['albums'] + 1)
+                                                 for i in range(1, rows['songs'] + 1)])
+    connection.execute('ANALYZE')
+
+@contextlib.contextmanager
+def plan_check_database():
+    """a connection to a scratch copy of the schema holding the PLAN_CHECK_ROWS dataset, thrown away afterwards:
+    a temporary schema rolled back at the end on PostgreSQL, an in-memory database otherwise"""
+    engine = db.get_engine()
+    if engine.dialect.name != 'postgresql':
+        engine = sqlalchemy.create_engine('sqlite://')
+    connection = engine.connect()
+    transaction = connection.begin()
+    try:
+        if engine.dialect.name == 'postgresql':
+            connection.execute('CREATE SCHEMA query_plan_check')
+            connection.execute('SET LOCAL search_path TO query_plan_check')
+        db.metadata.create_all(connection)
+        seed_plan_check(connection)
+        yield connection
+    finally:
+        transaction.rollback()
+        connection.close()
+
+def missing_indexes():
+    """(name, expected index, plan) for each hot query whose plan does not use its index"""
+    failures = []
+    with plan_check_database() as connection:
+        dialect = connection.dialect
+        for name, query, index in hot_queries():
+            sql = str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+            if dialect.name == 'postgresql':
+                plan = ' '.join(row[0] for row in connection.execute('EXPLAIN ' + sql))
+            else:
+                plan = ' '.join(row[-1] for row in connection.execute('EXPLAIN QUERY PLAN ' + sql))
+                index = SQLITE_INDEX_NAMES.get(index, index)
+            if index not in plan.replace('(', ' ').split():
+                failures.append((name, index, plan))
+    return failures
+
+@manager.command
+def check_query_plans():
+    """EXPLAIN every hot lookup against a seeded scratch database and fail if any of them misses its index"""
+    failures = missing_indexes()
+    for name, index, plan in failures:
+        print('{}: expected {}, got {}'.format(name, index, plan))
+    if failures:
+        sys.exit(1)
+    print('All {} hot queries use their index.'.format(len(hot_queries())))
+
+## Catalog import / export, see catalog_io.py
+
+def catalog_counts():
+    return dict(songs=Song.query.count(), artists=Artist.query.count(), albums=Album.query.count())
+
+@manager.option('-b', '--batch', dest='batch', type=int, default=5000, help='rows saved per transaction')
+@manager.option('-f', '--format', dest='fmt', default=None, help='csv or jsonl (default: from the file name)')
+@manager.option('path', help='CSV or JSON lines file with title, artist and album, optionally .gz; - for stdin')
+def import_songs(path, fmt, batch):
+    """Add the songs in a CSV or JSON lines file to the catalog, skipping the ones already saved"""
+    import catalog_io
+    fmt = catalog_io.detect_format(path, fmt)
+    use_copy = db.session.get_bind().dialect.name == 'postgresql'
+    before = catalog_counts()
+    stats = {'skipped': 0}
+    progress = catalog_io.Progress('Imported')
+    with catalog_io.open_file(path, 'r') as f:
+        for chunk in catalog_io.chunked(catalog_io.read_tracks(f, fmt, stats), batch):
+            if use_copy:
+                catalog_io.copy_tracks(db.session.connection().connection.cursor(), chunk)
+            else:
+                save_tracks(db.session, chunk)
+            db.session.commit()
+            progress.add(len(chunk))
+    added = dict((name, count - before[name]) for name, count in catalog_counts().items())
+    print('Read {:,} rows ({:,} skipped) in {:.1f}s, {:,.0f} rows/s. Added {songs:,} songs, {artists:,} artists, '
+          '{albums:,} albums.'.format(progress.count + stats['skipped'], stats['skipped'], progress.elapsed(),
+                                      progress.rate(), **added))
+
+@manager.option('-b', '--batch', dest='batch', type=int, default=5000, help='rows fetched from the database at a time')
+@manager.option('-f', '--format', dest='fmt', default=None, help='csv or jsonl (default: from the file name)')
+@manager.option('path', help='file to write, .gz to compress it; - for stdout')
+def export_songs(path, fmt, batch):
+    """Write the whole catalog to a CSV or JSON lines file, streaming it from the database"""
+    import catalog_io
+    fmt = catalog_io.detect_format(path, fmt)
+    progress = catalog_io.Progress('Exported')
+    with catalog_io.open_file(path, 'w') as f:
+        if fmt == 'csv' and db.session.get_bind().dialect.name == 'postgresql':
+            progress.add(catalog_io.copy_export(db.session.connection().connection.cursor(), f))
+        else:
+            # stream_results gives a server-side cursor where the driver has one
+            rows = song_listing_query().execution_options(stream_results=True).yield_per(batch)
+            catalog_io.write_tracks(f, fmt, ((title, artist or '', album or '') for _, title, artist, album in rows), progress)
+    db.session.rollback()
+    sys.stderr.write('Wrote {:,} songs in {:.1f}s, {:,.0f} rows/s.\n'.format(progress.count, progress.elapsed(), progress.rate()))
+
+## iTunes details for saved songs, see enrichment.py
+
+def enrichment_tracks(song_ids):
+    return db.session.query(Song.id, Song.title, Artist.name).join(Artist, Song.artist_id == Artist.id)\
+        .filter(Song.id.in_(song_ids)).all()
+
+def save_enrichment(found):
+    """found is [(song id, TrackDetails)]; albums and artists keep the first iTunes id and artwork they get"""
+    if not found:
+        return
+    songs, albums, artists = Song.__table__, Album.__table__, Artist.__table__
+    rows = [{'song': song_id, 'itunes_id': d.track_id, 'duration_ms': d.duration_ms, 'genre': (d.genre or '')[:64] or None,
+             'artwork_url': d.artwork_url, 'album_itunes_id': d.album_id, 'artist_itunes_id': d.artist_id,
+             'enriched_at': datetime.datetime.utcnow()} for song_id, d in found]
+    db.session.execute(songs.update().where(songs.c.id == bindparam('song')).values(
+        itunes_id=bindparam('itunes_id'), duration_ms=bindparam('duration_ms'), genre=bindparam('genre'),
+        artwork_url=bindparam('artwork_url'), enriched_at=bindparam('enriched_at')), rows)
+    song_album = select([songs.c.album_id]).where(songs.c.id == bindparam('song')).as_scalar()
+    db.session.execute(albums.update().where(albums.c.id == song_album).where(albums.c.itunes_id.is_(None)).values(
+        itunes_id=bindparam('album_itunes_id'), artwork_url=bindparam('artwork_url')), rows)
+    song_artist = select([songs.c.artist_id]).where(songs.c.id == bindparam('song')).as_scalar()
+    db.session.execute(artists.update().where(artists.c.id == song_artist).where(artists.c.itunes_id.is_(None)).values(
+        itunes_id=bindparam('artist_itunes_id')), rows)
+
+enricher = Enricher(app, db, EnrichmentJob, itunes, tracks=enrichment_tracks, save=save_enrichment,
+                    workers=app.config['ENRICH_WORKERS'], calls_per_minute=app.config['ENRICH_CALLS_PER_MINUTE'],
+                    limiter=itunes.limiter)
+
+def queue_enrichment(db_session, song_ids, track_ids=None):
+    # one INSERT in the caller's transaction; iTunes is only called by the enrich command
+    _insert_ignoring_duplicates(db_session, EnrichmentJob.__table__, enricher.job_rows(song_ids, track_ids))
+
+## Trending songs, see trending.py
+
+def song_ids_for(keys):
+    """{(title, artist name): song id} for the songs that exist"""
+    keys = set(keys)
+    rows = db.session.query(Song.title, Artist.name, Song.id).join(Artist, Song.artist_id == Artist.id)\
+        .filter(Song.title.in_(set(title for title, _ in keys)), Artist.name.in_(set(artist for _, artist in keys)))
+    return dict(((title, artist), song_id) for title, artist, song_id in rows if (title, artist) in keys)
+
+def song_names(song_ids):
+    return dict((song_id, (title, artist, album)) for song_id, title, artist, album in song_listing_query().filter(Song.id.in_(song_ids)))
+
+trending = Trending(app, db, SongStats, resolve=song_ids_for, describe=song_names, half_life=app.config['TRENDING_HALF_LIFE'],
+                    share_weight=app.config['TRENDING_SHARE_WEIGHT'], flush_every=app.config['TRENDING_FLUSH_EVERY'],
+                    top_n=app.config['TRENDING_SIZE'], refresh_every=app.config['TRENDING_REFRESH'])
+if instrumentation.enabled:
+    instrumentation.add_collector(lambda: [('songs_trending_' + name, 'counter', value, {}) for name, value in sorted(trending.stats.items())]
+                                  + [('songs_trending_pending', 'gauge', trending.pending(), {})])
+
+@manager.option('--backfill', dest='backfill', action='store_true', help='first queue every saved song that never was')
+@manager.option('--once', dest='once', action='store_true', help='stop when no job is due instead of waiting for more')
+@manager.option('-w', '--workers', dest='workers', type=int, default=app.config['ENRICH_WORKERS'])
+def enrich(workers, once, backfill):
+    """Fetch iTunes details (duration, genre, artwork, ids) for queued songs until stopped with Ctrl-C"""
+    if backfill:
+        unqueued = db.session.query(Song.id).outerjoin(EnrichmentJob, EnrichmentJob.song_id == Song.id)\
+            .filter(EnrichmentJob.id.is_(None), Song.enriched_at.is_(None)).order_by(Song.id)
+        song_ids = [song_id for song_id, in unqueued]
+        for start in range(0, len(song_ids), 5000):
+            queue_enrichment(db.session, song_ids[start:start + 5000])
+        db.session.commit()
+        print('Queued {:,} songs.'.format(len(song_ids)))
+    enricher.workers = workers
+    stats = enricher.run(until_empty=once)
+    print('Enriched {enriched:,} songs ({missing:,} not on iTunes, {failed:,} failed for good) '
+          'with {calls:,} iTunes calls.'.format(**stats))
+    print(', '.join('{}: {:,}'.format(status, count) for status, count in sorted(enricher.counts().items())))
+
 ##### Set up Controllers (view functions) #####
 
 ## Error handling routes
@@ -239,18 +750,68 @@ def page_not_found(e):
 def internal_server_error(e):
     return render_template('500.html'), 500
 
+# Versions for the HTTP cache: each one changes whenever the data on its page does
+def songs_version(**view_args):
+    return db.session.query(func.max(Song.id)).scalar() or 0 # songs are only ever added
+
+def friends_version(**view_args):
+    # the page holds the form that sends to friends, so it carries a CSRF token like the song form
+    form = song_form_version()
+    if form is None:
+        return None
+    return tuple(db.session.query(func.max(Person.id), func.count(Person.id)).filter_by(user_id=current_user.id).one()) + form
+
+def song_form_version(**view_args):
+    # the CSRF token in the form belongs to the session and expires, so a page is reused for half an hour at most
+    if request.args.get('q') or 'csrf_token' not in session:
+        return None
+    return session['csrf_token'], int(time.time() // 1800)
+
+def trending_version(**view_args):
+    trending.refresh()
+    return trending.version
+
 @app.route('/')
 def index():
     return redirect('song/normal')
 
+def load_song_listing(after_id):
+    # the autocomplete index reads on a thread of its own, outside any request, so it needs its own app context
+    with app.app_context():
+        for row in song_listing_query(after_id).yield_per(1000):
+            yield row
+
+def song_listing_query(after_id=0):
+    """songs with their artist and album names in one joined query, in id order starting after after_id"""
+    return db.session.query(Song.id, Song.title, Artist.name, Album.name)\
+        .outerjoin(Artist, Song.artist_id == Artist.id)\
+        .outerjoin(Album, Song.album_id == Album.id)\
+        .filter(Song.id > after_id)\
+        .order_by(Song.id)
+
 @app.route('/all_songs')
+@http_cache.cached(songs_version, per_user=False)
 def see_all_songs():
-    all_songs = [] 
-    songs = Song.query.all()
-    for song in songs:
-        artist = Artist.query.filter_by(id=song.artist_id).first()
-        all_songs.append((song.title, artist.name))
-    return render_template('all_songs.html',all_songs=all_songs)
+    # keyset pagination: ?after=<last song id seen> instead of OFFSET, so later pages cost the same as the first
+    after = request.args.get('after', 0, type=int)
+    if request.args.get('stream'):
+        # render rows as they come off the cursor instead of building the whole list first
+        rows = ((title, artist, album) for _, title, artist, album in song_listing_query(after).yield_per(500))
+        context = dict(all_songs=rows, next_after=None)
+        app.update_template_context(context)
+        template = app.jinja_env.get_template('all_songs.html')
+        return Response(stream_with_context(template.generate(context)), mimetype='text/html')
+    per_page = app.config['SONGS_PER_PAGE']
+    rows = song_listing_query(after).limit(per_page + 1).all() # one extra row tells us whether there is a next page
+    all_songs = [(title, artist, album) for _, title, artist, album in rows[:per_page]]
+    next_after = rows[per_page - 1][0] if len(rows) > per_page else None
+    return render_template('all_songs.html',all_songs=all_songs, next_after=next_after)
+
+@app.route('/trending')
+@http_cache.cached(trending_version, per_user=False)
+def trending_songs():
+    # only the lists trending keeps in memory, reloaded from song_stats every TRENDING_REFRESH seconds
+    return render_template('trending.html', trending=trending.top('trending'), shared=trending.top('shared'))
 
 ## Login routes
 @app.route('/login',methods=["GET","POST"])
@@ -259,6 +820,8 @@ def login():
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
         if user is not None and user.verify_password(form.password.data):
+            if passwords.needs_rehash(user.password_hash): # made with older hash settings, upgrade it while we have the password
+                user.password = form.password.data
             login_user(user, form.remember_me.data)
             return redirect(request.args.get('next') or url_for('index'))
         flash('Invalid username or password.')
@@ -277,49 +840,76 @@ def register():
     if form.validate_on_submit():
         user = User(email=form.email.data,username=form.username.data,password=form.password.data)
         db.session.add(user)
-        db.session.commit()
         flash('You can now log in!')
         return redirect(url_for('login'))
     return render_template('register.html',form=form)
 
+def local_search(term, number):
+    """TrackHits from the saved songs when at least `number` of them contain every word of the search as a whole word,
+    otherwise None (prefix and typo matches alone never keep a search from iTunes)"""
+    if not app.config['LOCAL_SEARCH']:
+        return None
+    local = [hit for hit in song_index.search(term, limit=number) if hit.complete]
+    if len(local) < number:
+        return None
+    return [TrackHit(hit.title, hit.artist, hit.album) for hit in local]
+
+def search_songs(term, number, page=0):
+    """TrackHits for a search: from the saved songs when enough of them match, otherwise from iTunes"""
+    # when the first page came from the saved songs, "more results" carries on with iTunes from its first result,
+    # so no iTunes result is skipped (the index only answers from its memory, so asking again is cheap)
+    local = local_search(term, number)
+    if local is not None:
+        if page == 0:
+            return local
+        page -= 1
+    # every page comes from the results stored for the term, so "more results" doesn't go back to iTunes
+    return itunes.search(term, start=page * number, count=number)
+
 @app.route('/song/<more>',methods=["GET","POST"])
+@http_cache.cached(song_form_version)
 def song_input(more):
-    base_url = 'https://itunes.apple.com/search?entity=song&limit=10&term='
     form = SongForm()
+    song = None
     if form.validate_on_submit():
         song = form.song.data 
-        url = base_url + song
-        x = requests.get(url).text
-        #print(x)
-        song_list = []
-        #finalString = 'The top 5 artists who sing {} are: '.format(song)
-        song = json.loads(x)['results'][0]['trackName']
-        params_dict = song.replace(' ', '*') + ":"
-        for i in range(10):
-            artist = json.loads(x)['results'][i]['artistName']
-            album = json.loads(x)['results'][i]['collectionCensoredName']
-            dictor = {'song':song, 'artist':artist, 'both':params_dict+artist.replace(' ', '*')+':'+album.replace(' ','*')}
-            song_list.append(dictor)
-            #finalString += json.loads(x)['results'][i]['artistName']
+    elif request.args.get('q'): # "more results" links carry the search with them
+        song = request.args.get('q')
+    if song:
+        number = 5 if more == 'normal' else 10
+        page = max(request.args.get('page', 0, type=int), 0)
+        try:
+            song_list = search_songs(song, number, page)
+        except ITunesUnavailable:
+            flash('Song search is not available right now, please try again in a minute.')
+            return render_template('song.html',form=form)
+        if not song_list:
+            flash('No songs found for "{}".'.format(song))
+            return render_template('song.html',form=form)
         if more == 'normal':
-            return render_template('song_list.html', songs=song_list, name=song, params_dict=params_dict, number=5)
+            more_url = url_for('song_input', more='more', q=song)
         else:
-            return render_template('song_list.html', songs=song_list, name=song, params_dict=params_dict, number=10)
+            more_url = url_for('song_input', more='more', q=song, page=page + 1) if len(song_list) == number else None
+        return render_template('song_list.html', songs=song_list[:number], name=song_list[0].song, more_url=more_url)
     return render_template('song.html',form=form)
 
+@app.route('/autocomplete')
+def autocomplete_songs():
+    # suggestions for the search box as the user types, e.g. /autocomplete?q=hey%20ju
+    limit = max(1, min(request.args.get('limit', 8, type=int), autocomplete.top_size))
+    suggestions = autocomplete.lookup(request.args.get('q', ''), limit=limit)
+    return jsonify(query=request.args.get('q', ''), suggestions=[dict(text=s.text, kind=s.kind) for s in suggestions])
+
 @app.route('/song_status',methods=["GET","POST"])
 def song_status():
     if request.method == 'GET':
         result = request.args
-        choice = result.get('choice')
-        choice = choice.split(':')
-        track = choice[0]
-        if '*' in track:
-            track = track.replace('*', ' ')
-        artist = choice[1].replace('*', ' ')
-        album = choice[2].replace('*', ' ')
+        hit = TrackHit.from_choice(result.get('choice'))
+        track, artist, album = hit.song, hit.artist, hit.album
         # add the song to the song/artist table
-        get_or_create_song(db.session, track, artist, album)
+        song = get_or_create_song(db.session, track, artist, album)
+        if song.enriched_at is None:
+            queue_enrichment(db.session, [song.id], [hit.track_id]) # details are fetched later by the enrich command
         url = '/send/' + track.replace(' ', '*') + '/' + artist.replace(' ', '*')
     return render_template('save_and_send.html', song_name=track, song_artist=artist, url=url)
 
@@ -333,33 +923,61 @@ def send_song(song, artist):
         song = song.replace('*', ' ')
         artist = artist.replace('*', ' ')
         send_email(email, 'This is a cool song', 'mail/new_song', song_name=song, song_artist=artist)
+        database.after_commit(trending.add, song, artist, 'shares')
         return redirect(url_for('index'))
     return render_template('email_friend.html',form=form, url=url)
 
-@app.route('/send_from_friends/<song>/<artist>',methods=["GET","POST"])
+@app.route('/send_from_friends/<song>/<artist>',methods=["POST"])
+@login_required
 def send_from_friends(song, artist):
-    if request.method == 'GET':
-        result = request.args
-        email = result.get('email')
-        song = song.replace('*', ' ')
-        artist = artist.replace('*', ' ')
-        send_email(email, 'This is a cool song', 'mail/new_song', song_name=song, song_artist=artist)
-    return redirect(url_for('index'))
+    form = SendToFriendsForm()
+    if not form.validate_on_submit():
+        flash('The form expired, please pick your friends again.')
+        return redirect(url_for('saved_friends', name=song, artist=artist))
+    saved = set(email for _, email in friends_of(current_user.id))
+    picked = dict.fromkeys(email.strip() for email in request.form.getlist('email')) # each friend once, in order
+    emails = [email for email in picked if email in saved] # only ever mail the user's own saved friends
+    if not emails:
+        flash('Pick at least one friend to send the song to.')
+        return redirect(url_for('saved_friends', name=song, artist=artist))
+    if len(emails) > app.config['MAX_RECIPIENTS']:
+        flash('You can send a song to at most {} friends at once.'.format(app.config['MAX_RECIPIENTS']))
+        return redirect(url_for('saved_friends', name=song, artist=artist))
+    song = song.replace('*', ' ')
+    artist = artist.replace('*', ' ')
+    ids = send_emails(emails, 'This is a cool song', 'mail/new_song', song_name=song, song_artist=artist)
+    database.after_commit(trending.add, song, artist, 'shares', len(ids))
+    session['sent_mail'] = ids
+    return redirect(url_for('send_status'))
+
+@app.route('/send_status')
+@login_required
+def send_status():
+    # what happened to each email of the last send to friends
+    statuses = mail_outbox.status(session.get('sent_mail', []))
+    pending = any(status in ('pending', 'sending') for _, status, _ in statuses)
+    # reload a few times only, and not at all once a message has failed: a retry is at least MAIL_RETRY_BACKOFF away
+    failing = any(error and status != 'sent' for _, status, error in statuses)
+    tries = request.args.get('tries', 0, type=int)
+    refresh_url = None
+    if pending and not failing and tries < app.config['SEND_STATUS_REFRESHES']:
+        refresh_url = url_for('send_status', tries=tries + 1)
+    return render_template('send_status.html', statuses=statuses, pending=pending, refresh_url=refresh_url)
 
 
 @app.route('/see_friends/<name>/<artist>')
 @login_required
+@http_cache.cached(friends_version)
 def saved_friends(name, artist):
     # keep track of the song name and artist
     url = 'http://localhost:5000/send_from_friends/' + name + '/' + artist
-    friend_list = []
-    friends = Person.query.filter_by(user_id=current_user.id).all()
-    for friend in friends:
-        friend_list.append((friend.name,friend.email))
-    return render_template('saved_friends.html', friend_list=friend_list, length=len(friend_list), url=url)
+    friend_list = friends_of(current_user.id)
+    return render_template('saved_friends.html', friend_list=friend_list, length=len(friend_list), url=url,
+                           form=SendToFriendsForm())
 
 @app.route('/friend/form')
 @login_required
+@http_cache.cached(lambda: 'static', per_user=False)
 def friend_form():
     return render_template('add_friend.html')
 
@@ -373,7 +991,11 @@ def add_friends():
     return redirect(url_for('index'))
 
 if __name__ == '__main__':
-    db.create_all()
+    if sys.argv[1:2] == ['db']:
+        manager.add_command('db', init_migrations()) # migrations own the schema here, so no create_all
+    else:
+        manager.add_command('db', Manager(usage='Perform database migrations')) # listed in --help without loading alembic
+        db.create_all()
     manager.run() # NEW: run with this: python main_app.py runserver
     # Also provides more tools for debugging
 
@@ -0,0 +1,39 @@
+"""Password hashing with a configurable method and a bounded pool for the CPU work.
+
+`method` is anything werkzeug's generate_password_hash accepts, for example
+'pbkdf2:sha256:150000' (algorithm and iteration count). Hashes made with other
+settings still verify, and needs_rehash() tells the login view to store a new
+hash with the current settings. Hashing runs on at most `workers` threads so
+a burst of logins can't take every CPU from the other requests.
+"""
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class PasswordHasher(object):
+
+    def __init__(self, method='pbkdf2:sha256', salt_length=8, workers=2):
+        self.method = method
+        self.salt_length = salt_length
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self._stored_method = None
+
+    def hash(self, password):
+        return self.executor.submit(generate_password_hash, password, self.method, self.salt_length).result()
+
+    def verify(self, pwhash, password):
+        return self.executor.submit(check_password_hash, pwhash, password).result()
+
+    @property
+    def stored_method(self):
+        """the method part of the hashes we make now, e.g. 'pbkdf2:sha256:150000' even if method has no iteration count"""
+        if self._stored_method is None:
+            self._stored_method = generate_password_hash('', self.method, self.salt_length).split('$', 1)[0]
+        return self._stored_method
+
+    def needs_rehash(self, pwhash):
+        if not pwhash or '$' not in pwhash:
+            return True
+        method, salt, _ = pwhash.split('$', 2)
+        return method != self.stored_method or len(salt) != self.salt_length
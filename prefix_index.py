@@ -0,0 +1,198 @@
+"""Sorted-array prefix index behind the autocomplete endpoint.
+
+Every distinct song title, artist and album is one entry: its normalized
+text (the sort key), what to display, its kind and a weight (how many saved
+songs it belongs to). The entries live in parallel lists sorted by key, so
+a lookup is two binary searches plus a scan of the matching range. Short
+prefixes match too many entries to rank on every keystroke: a range longer
+than `wide_range` is ranked once, and its best `top_size` suggestions are
+kept until the index changes.
+
+Lookups never read the database themselves. When the index is due for a
+refresh, a lookup starts one on a background thread and answers from what
+is already loaded; refresh() can also be called directly to build the
+index up front.
+
+Memory is bounded by `max_entries`: once the index grows past it, the
+lowest-weight entries are dropped. stats() reports the size and an estimate
+of the memory used.
+"""
+import bisect
+import heapq
+import sys
+import threading
+import time
+from array import array
+from collections import namedtuple
+
+from cache import normalize_term
+
+KINDS = ('song', 'artist', 'album')
+
+Suggestion = namedtuple('Suggestion', ['text', 'kind', 'weight'])
+
+
+class PrefixIndex(object):
+
+    def __init__(self, loader=None, max_entries=1000000, wide_range=1000, top_size=50, refresh_every=30, clock=time.time):
+        self.loader = loader  # loader(after_id) -> iterable of (song id, title, artist, album) in id order
+        self.max_entries = max_entries
+        self.wide_range = wide_range  # prefixes matching more entries than this have their ranking cached
+        self.top_size = top_size  # suggestions cached per wide prefix, the most a lookup gets from one
+        self.refresh_every = refresh_every
+        self.clock = clock
+        self.keys = []
+        self.labels = []
+        self.kinds = bytearray()
+        self.weights = array('l')
+        self.loaded_through = 0
+        self.refreshed_at = None
+        self.evicted = 0
+        self._top = {}  # (key, kinds) -> best Suggestions for a wide prefix, emptied on every change
+        self._lock = threading.RLock()
+        self._refreshing = threading.Lock()
+        self._thread = None
+
+    def __len__(self):
+        return len(self.keys)
+
+    ## Building
+
+    def _find(self, key, label, kind):
+        i = bisect.bisect_left(self.keys, key)
+        while i < len(self.keys) and self.keys[i] == key:
+            if self.kinds[i] == kind and self.labels[i] == label:
+                return i, True
+            i += 1
+        return i, False
+
+    def add(self, label, kind, weight=1):
+        """adds `weight` to the entry for label (a title, artist or album name), creating it if needed"""
+        key = normalize_term(label)
+        if not key:
+            return
+        kind = KINDS.index(kind)
+        with self._lock:
+            i, found = self._find(key, label, kind)
+            self._top = {}
+            if found:
+                self.weights[i] += weight
+                return
+            self.keys.insert(i, key)
+            self.labels.insert(i, label)
+            self.kinds.insert(i, kind)
+            self.weights.insert(i, weight)
+            if len(self.keys) > self.max_entries * 1.1:  # trim in batches, not on every insert
+                self._trim()
+
+    def add_songs(self, rows):
+        """adds (title, artist, album) rows; large batches are merged with one sort instead of one insert each"""
+        counts = {}
+        for title, artist, album in rows:
+            for label, kind in ((title, 0), (artist, 1), (album, 2)):
+                if label:
+                    counts[(label, kind)] = counts.get((label, kind), 0) + 1
+        with self._lock:
+            if len(counts) < 1000:
+                for (label, kind), weight in counts.items():
+                    self.add(label, KINDS[kind], weight)
+                return
+            entries = {}
+            for i in range(len(self.keys)):
+                entries[(self.labels[i], self.kinds[i])] = self.weights[i]
+            for entry, weight in counts.items():
+                entries[entry] = entries.get(entry, 0) + weight
+            self._rebuild(entries)
+            if len(self.keys) > self.max_entries:
+                self._trim()
+
+    def _rebuild(self, entries):
+        ordered = sorted((normalize_term(label), label, kind, weight) for (label, kind), weight in entries.items())
+        self._top = {}
+        self.keys = [key for key, _, _, _ in ordered]
+        self.labels = [label for _, label, _, _ in ordered]
+        self.kinds = bytearray(kind for _, _, kind, _ in ordered)
+        self.weights = array('l', (weight for _, _, _, weight in ordered))
+
+    def _trim(self):
+        """keeps the max_entries heaviest entries"""
+        order = sorted(range(len(self.keys)), key=lambda i: -self.weights[i])
+        keep = sorted(order[:self.max_entries])
+        self._top = {}
+        self.evicted += len(self.keys) - len(keep)
+        self.keys = [self.keys[i] for i in keep]
+        self.labels = [self.labels[i] for i in keep]
+        self.kinds = bytearray(self.kinds[i] for i in keep)
+        self.weights = array('l', (self.weights[i] for i in keep))
+
+    def _due(self):
+        return self.refreshed_at is None or self.clock() - self.refreshed_at >= self.refresh_every
+
+    def refresh(self, force=False):
+        """reads songs saved since the last refresh (all of them the first time). Lookups go on while it reads."""
+        if self.loader is None:
+            return
+        with self._refreshing:
+            if not force and not self._due():
+                return
+            self.refreshed_at = self.clock()
+            rows = []
+            loaded_through = self.loaded_through
+            for song_id, title, artist, album in self.loader(loaded_through):
+                rows.append((title, artist, album))
+                loaded_through = max(loaded_through, song_id)
+            with self._lock:
+                self.add_songs(rows)
+                self.loaded_through = loaded_through
+
+    def refresh_soon(self):
+        """starts a refresh on a background thread if one is due and none is running"""
+        if self.loader is None or not self._due():
+            return
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self.refresh, name='prefix-index-refresh')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def invalidate(self):
+        """new songs were saved: the next lookup reads them in"""
+        self.refreshed_at = None
+
+    ## Lookups
+
+    def lookup(self, prefix, limit=8, kinds=None):
+        """Suggestions starting with prefix, heaviest first (at most top_size of them)"""
+        self.refresh_soon()
+        key = normalize_term(prefix)
+        if not key:
+            return []
+        wanted = frozenset(KINDS.index(kind) for kind in kinds) if kinds else None
+        with self._lock:
+            start = bisect.bisect_left(self.keys, key)
+            end = bisect.bisect_left(self.keys, key + '\uffff')
+            if end - start <= self.wide_range:
+                return self._rank(start, end, wanted, limit)
+            top = self._top.get((key, wanted))
+            if top is None:
+                top = self._top[(key, wanted)] = self._rank(start, end, wanted, self.top_size)
+            return top[:limit]
+
+    def _rank(self, start, end, wanted, limit):
+        matches = (i for i in range(start, end) if wanted is None or self.kinds[i] in wanted)
+        best = heapq.nsmallest(limit, matches, key=lambda i: (-self.weights[i], self.keys[i]))
+        return [Suggestion(self.labels[i], KINDS[self.kinds[i]], self.weights[i]) for i in best]
+
+    def stats(self):
+        """entry count and an estimate of the memory the index holds, in bytes"""
+        with self._lock:
+            size = len(self.keys)
+            approx = sys.getsizeof(self.keys) + sys.getsizeof(self.labels) + sys.getsizeof(self.kinds) + \
+                sys.getsizeof(self.weights)
+            if size:
+                step = max(1, size // 1000)  # sample the strings rather than walk a million of them
+                sample = range(0, size, step)
+                per_entry = sum(sys.getsizeof(self.keys[i]) + sys.getsizeof(self.labels[i]) for i in sample) / float(len(sample))
+                approx += int(per_entry * size)
+            return {'entries': size, 'max_entries': self.max_entries, 'evicted': self.evicted, 'approx_bytes': approx}
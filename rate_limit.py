@@ -0,0 +1,139 @@
+"""Token bucket rate limiters for calls to iTunes.
+
+A bucket refills at `per_minute` tokens a minute up to `burst`. reserve(n)
+takes n tokens straight away, letting the balance go below zero, and
+returns how long the caller has to wait before making its calls, so callers
+queue up in the order they came instead of polling. When the wait would be
+longer than the caller's `timeout` nothing is taken and Throttled is raised
+instead. acquire() is reserve() plus the sleep.
+
+TokenBucket lives in the process; SQLiteTokenBucket keeps the balance in a
+sqlite file so every worker process on the machine draws from the same
+bucket (each reserve is one short write transaction). make_limiter builds
+either one from config, like cache.make_cache.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+
+class Throttled(Exception):
+    """the bucket could not give the tokens within the caller's timeout"""
+
+    def __init__(self, wait):
+        Exception.__init__(self, 'rate limited, the next call would have to wait {:.1f}s'.format(wait))
+        self.wait = wait
+
+
+class LimiterStats(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0  # tokens handed out
+        self.delayed = 0  # reservations that had to wait
+        self.delay_seconds = 0.0
+        self.throttled = 0  # reservations refused because the wait was too long
+
+    def record(self, n, wait=0.0, throttled=False):
+        with self._lock:
+            if throttled:
+                self.throttled += 1
+                return
+            self.calls += n
+            if wait > 0:
+                self.delayed += 1
+                self.delay_seconds += wait
+
+    def as_dict(self):
+        with self._lock:
+            return dict((k, v) for k, v in vars(self).items() if not k.startswith('_'))
+
+
+def _take(tokens, updated, now, n, per_second, burst, timeout):
+    """(tokens left, seconds to wait) after taking n; raises Throttled if the wait would be over timeout"""
+    tokens = min(burst, tokens + (now - updated) * per_second)
+    wait = max(0.0, (n - tokens) / per_second)
+    if timeout is not None and wait > timeout:
+        raise Throttled(wait)
+    return tokens - n, wait
+
+
+class TokenBucket(object):
+
+    def __init__(self, per_minute, burst=1, clock=time.time, sleep=time.sleep):
+        self.per_second = per_minute / 60.0
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.stats = LimiterStats()
+        self._tokens = float(burst)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, n=1, timeout=None):
+        with self._lock:
+            now = self.clock()
+            try:
+                self._tokens, wait = _take(self._tokens, self._updated, now, n, self.per_second, self.burst, timeout)
+            except Throttled:
+                self.stats.record(n, throttled=True)
+                raise
+            self._updated = now
+        self.stats.record(n, wait)
+        return wait
+
+    def acquire(self, n=1, timeout=None):
+        """waits until n calls are allowed (at most timeout seconds, else Throttled). Returns the seconds waited."""
+        wait = self.reserve(n, timeout)
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+
+class SQLiteTokenBucket(TokenBucket):
+    """TokenBucket whose balance is shared by every process using the same file and name"""
+
+    def __init__(self, path, name, per_minute, burst=1, clock=time.time, sleep=time.sleep):
+        TokenBucket.__init__(self, per_minute, burst, clock, sleep)
+        self.path = path
+        self.name = name
+        self._local = threading.local()
+
+    def _connect(self):
+        # one connection per thread (and per pid, since workers are forked), in autocommit mode so BEGIN is ours
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute('CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL, updated REAL)')
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def reserve(self, n=1, timeout=None):
+        conn = self._connect()
+        conn.execute('BEGIN IMMEDIATE')  # takes the write lock first, so two processes never read the same balance
+        try:
+            now = self.clock()
+            row = conn.execute('SELECT tokens, updated FROM buckets WHERE name = ?', (self.name,)).fetchone()
+            tokens, updated = row if row is not None else (float(self.burst), now)
+            tokens, wait = _take(tokens, updated, now, n, self.per_second, self.burst, timeout)
+            conn.execute('INSERT OR REPLACE INTO buckets (name, tokens, updated) VALUES (?, ?, ?)', (self.name, tokens, now))
+            conn.execute('COMMIT')
+        except Throttled:
+            conn.execute('ROLLBACK')
+            self.stats.record(n, throttled=True)
+            raise
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        self.stats.record(n, wait)
+        return wait
+
+
+def make_limiter(backend='memory', per_minute=20, burst=1, path=None, name='default'):
+    """Builds a limiter from config values. backend is 'memory' or 'sqlite'."""
+    if backend == 'sqlite':
+        return SQLiteTokenBucket(path or 'rate_limit.sqlite', name, per_minute, burst)
+    if backend != 'memory':
+        raise ValueError('Unknown rate limit backend: {}'.format(backend))
+    return TokenBucket(per_minute, burst)
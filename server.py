@@ -0,0 +1,112 @@
+"""Production serving for the song app (`python msetton.py serve`).
+
+Runs the app under gunicorn with preforked worker processes, one per CPU by
+default. Everything the workers can share is loaded once in the master
+before the fork: the app itself, every Jinja template compiled, the
+SQLAlchemy mappers configured and whatever `warmers` are given (the search
+indexes). The master's database connections are then closed, so no worker
+inherits a socket, and the loaded objects are moved out of the garbage
+collector's reach so the workers keep sharing those pages copy-on-write.
+Each worker opens its database connections right after the fork, before it
+takes a request.
+
+Reloading after a deploy: `python msetton.py reload_server` sends the master
+USR2, which starts a new master (and workers) with the new code next to the
+old one, then stops the old master gracefully once the new one is up. The
+old workers finish the requests they have. HUP on the master also replaces
+the workers gracefully, but they are forked from the already loaded code.
+"""
+import gc
+import os
+import signal
+import time
+
+from sqlalchemy.orm import configure_mappers
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # only needed to serve, CLI commands work without it
+    BaseApplication = object
+
+
+def preload(app, db, warmers=()):
+    """loads what the workers should share instead of each building its own after the fork"""
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    configure_mappers()
+    with app.app_context():
+        for warm in warmers:
+            warm()
+    db.engine.dispose()
+    if hasattr(gc, 'freeze'):  # python 3.7+
+        gc.collect()
+        gc.freeze()
+
+
+def warm_connections(app, db, count):
+    """opens `count` pooled connections at once, so the first requests don't pay for connecting"""
+    with app.app_context():
+        db.engine.dispose()  # in case the master connected after preload
+        connections = []
+        try:
+            for _ in range(count):
+                connection = db.engine.connect()
+                connection.execute('SELECT 1')
+                connections.append(connection)
+        finally:
+            for connection in connections:
+                connection.close()  # back to the pool, still open
+
+
+class PreforkServer(BaseApplication):
+
+    def __init__(self, app, db, warmers=(), **options):
+        if BaseApplication is object:
+            raise RuntimeError('serve needs gunicorn: pip install gunicorn')
+        self.application = app
+        self.db = db
+        self.warmers = warmers
+        self.options = options
+        super(PreforkServer, self).__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+        self.cfg.set('preload_app', True)
+        self.cfg.set('post_fork', self._post_fork)
+
+    def load(self):
+        preload(self.application, self.db, self.warmers)
+        return self.application
+
+    def _post_fork(self, server, worker):
+        size = getattr(self.db.engine.pool, 'size', None)
+        count = min(size(), self.cfg.threads) if size else 1
+        warm_connections(self.application, self.db, count)
+
+
+def _read_pid(pidfile):
+    try:
+        with open(pidfile) as f:
+            return int(f.read().strip() or 0)
+    except (IOError, ValueError):
+        return None
+
+
+def reload(pidfile, timeout=60):
+    """Starts a new master with the current code next to the running one, then stops the old one gracefully"""
+    old = _read_pid(pidfile)
+    if not old:
+        raise RuntimeError('No server running (nothing in {})'.format(pidfile))
+    os.kill(old, signal.SIGUSR2)
+    deadline = time.time() + timeout
+    new = None
+    while not new:  # the new master writes <pidfile>.2 once it has loaded the app
+        if time.time() > deadline:
+            raise RuntimeError('The new server did not start within {} seconds; the old one is still running'.format(timeout))
+        time.sleep(0.5)
+        new = _read_pid(pidfile + '.2')
+    os.kill(old, signal.SIGTERM)
+    while _read_pid(pidfile) != new and time.time() < deadline:  # and takes over the pidfile when the old one exits
+        time.sleep(0.5)
+    return new
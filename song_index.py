@@ -0,0 +1,146 @@
+"""In-memory full-text index over the saved songs.
+
+Words from each song's title, artist and album go into an inverted index.
+A search matches every query word exactly, as a prefix of an indexed word,
+or with one typo (through a table of single-character deletions), and ranks
+songs by how rare the matched words are and which field they were in. Only
+songs containing every query word as a whole word are `complete`, which is
+what lets a search skip iTunes.
+
+The index is filled from the database the first time it is searched and then
+kept up to date incrementally: songs saved by this process are added right
+away, and every `refresh_every` seconds songs with a higher id than the last
+one seen (saved by other workers) are loaded.
+"""
+import bisect
+import math
+import re
+import threading
+import time
+from collections import namedtuple
+
+FIELD_WEIGHTS = {'title': 3.0, 'artist': 2.0, 'album': 1.0}
+EXACT, PREFIX, FUZZY = 1.0, 0.6, 0.4  # how much a query word counts for each kind of match
+MAX_PREFIX_TERMS = 50  # a one letter prefix would otherwise match half the vocabulary
+
+SearchResult = namedtuple('SearchResult', ['score', 'song_id', 'title', 'artist', 'album', 'complete'])
+
+
+def tokenize(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+
+def _deletes(word):
+    return set(word[:i] + word[i + 1:] for i in range(len(word)))
+
+
+class SongIndex(object):
+
+    def __init__(self, loader=None, refresh_every=30, clock=time.time):
+        self.loader = loader  # loader(after_id) -> iterable of (id, title, artist, album) in id order
+        self.refresh_every = refresh_every
+        self.clock = clock
+        self.songs = {}  # id -> (title, artist, album)
+        self.postings = {}  # word -> {song id: best field weight}
+        self.vocabulary = []  # sorted words, for prefix lookups
+        self.deletes = {}  # word with one letter removed -> set of words, for typo matching
+        self.loaded_through = 0  # highest song id read by refresh(); songs add()ed directly may be above it
+        self.refreshed_at = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.songs)
+
+    ## Building
+
+    def add(self, song_id, title, artist, album):
+        with self._lock:
+            if song_id in self.songs:
+                self._remove(song_id)
+            self.songs[song_id] = (title, artist, album)
+            for field, text in (('title', title), ('artist', artist), ('album', album)):
+                weight = FIELD_WEIGHTS[field]
+                for word in tokenize(text):
+                    postings = self.postings.get(word)
+                    if postings is None:
+                        postings = self.postings[word] = {}
+                        bisect.insort(self.vocabulary, word)
+                        for deleted in _deletes(word):
+                            self.deletes.setdefault(deleted, set()).add(word)
+                    if postings.get(song_id, 0) < weight:
+                        postings[song_id] = weight
+
+    def _remove(self, song_id):
+        for word in set(tokenize(' '.join(self.songs.pop(song_id)))):
+            self.postings.get(word, {}).pop(song_id, None)
+
+    def refresh(self, force=False):
+        """loads songs saved since the last refresh (all of them the first time)"""
+        if self.loader is None:
+            return
+        with self._lock:
+            now = self.clock()
+            if not force and self.refreshed_at is not None and now - self.refreshed_at < self.refresh_every:
+                return
+            self.refreshed_at = now
+            for song_id, title, artist, album in self.loader(self.loaded_through):
+                self.add(song_id, title, artist, album)
+                self.loaded_through = max(self.loaded_through, song_id)
+
+    ## Searching
+
+    def _matches(self, word):
+        """{indexed word: match quality} for one query word"""
+        matches = {}
+        if word in self.postings:
+            matches[word] = EXACT
+        start = bisect.bisect_left(self.vocabulary, word)
+        for candidate in self.vocabulary[start:start + MAX_PREFIX_TERMS]:
+            if not candidate.startswith(word):
+                break
+            matches.setdefault(candidate, PREFIX)
+        if len(word) >= 4:  # one typo in a short word matches too much
+            candidates = set(self.deletes.get(word, ()))
+            for deleted in _deletes(word):
+                if deleted in self.postings:
+                    candidates.add(deleted)
+                candidates.update(self.deletes.get(deleted, ()))
+            for candidate in candidates:
+                matches.setdefault(candidate, FUZZY)
+        return matches
+
+    def search(self, query, limit=10):
+        """SearchResults best first. `complete` is True when every word of the query is a whole word of the song;
+        prefix and one-typo matches rank songs but never make them complete (Hello must not be Hells Bells)."""
+        self.refresh()
+        words = list(dict.fromkeys(tokenize(query)))
+        if not words:
+            return []
+        with self._lock:
+            total = float(len(self.songs)) or 1.0
+            scores = {}
+            matched = {}
+            exact = {}
+            for word in words:
+                best = {}
+                whole = set()
+                for term, quality in self._matches(word).items():
+                    postings = self.postings.get(term)
+                    if not postings:
+                        continue
+                    idf = math.log(1 + total / len(postings))
+                    for song_id, field_weight in postings.items():
+                        if quality == EXACT:
+                            whole.add(song_id)
+                        score = quality * idf * field_weight
+                        if score > best.get(song_id, 0):
+                            best[song_id] = score
+                for song_id, score in best.items():
+                    scores[song_id] = scores.get(song_id, 0) + score
+                    matched[song_id] = matched.get(song_id, 0) + 1
+                for song_id in whole:
+                    exact[song_id] = exact.get(song_id, 0) + 1
+            ranked = sorted(scores, key=lambda song_id: (-matched[song_id], -exact.get(song_id, 0), -scores[song_id],
+                                                         song_id))[:limit]
+            return [SearchResult(scores[song_id], song_id, *self.songs[song_id], complete=exact.get(song_id) == len(words))
+                    for song_id in ranked]
@@ -0,0 +1,205 @@
+"""Trending and most shared songs from save and share counters kept up incrementally.
+
+Saving or sharing a song only bumps a counter in memory (no query).
+Every `flush_every` seconds a background thread writes this process's
+counters to the song_stats table in batches, one upsert per song, adding to
+what other processes wrote. The trending page reads a top-N list that is
+loaded from song_stats (by indexed columns, so it never scans) at most
+every `refresh_every` seconds, and never the songs or mail tables.
+
+Trending is ranked by time-decayed activity: each save counts 1 and each
+share `share_weight`, and both halve in weight every `half_life` seconds.
+song_stats.score holds log(sum of weight * e^((t - EPOCH) / tau)) ("forward
+decay"). Adding an event never has to touch older ones, every song's score
+is on the same scale so ORDER BY score is the ranking, and in log form it
+never overflows. heat() turns a score back into today's decayed count.
+"""
+import atexit
+import math
+import threading
+import time
+from collections import namedtuple
+
+EPOCH = 1767225600  # 2026-01-01 UTC, any fixed time works
+KINDS = ('saves', 'shares')
+
+TrendingSong = namedtuple('TrendingSong', ['song_id', 'title', 'artist', 'album', 'saves', 'shares', 'heat'])
+
+
+def log_add(a, b):
+    """log(e^a + e^b) without overflowing"""
+    if a is None:
+        return b
+    high, low = max(a, b), min(a, b)
+    return high + math.log1p(math.exp(low - high))
+
+
+class Trending(object):
+
+    def __init__(self, app, db, model, resolve, describe, half_life=86400, share_weight=3, flush_every=10,
+                 batch_size=500, top_n=50, refresh_every=30, clock=time.time):
+        self.app = app
+        self.db = db
+        self.model = model  # the counters table, see SongStats in msetton.py
+        self.resolve = resolve  # resolve([(title, artist)]) -> {(title, artist): song id}
+        self.describe = describe  # describe(song ids) -> {song id: (title, artist, album)}
+        self.tau = half_life / math.log(2)
+        self.weights = {'saves': 1.0, 'shares': float(share_weight)}
+        self.flush_every = flush_every
+        self.batch_size = batch_size
+        self.top_n = top_n
+        self.refresh_every = refresh_every
+        self.clock = clock
+        self.stats = {'events': 0, 'flushes': 0, 'rows_flushed': 0, 'unknown_songs': 0, 'refreshes': 0}
+        self._pending = {}  # (title, artist) -> [saves, shares, score]
+        self._lock = threading.Lock()
+        self._thread = None
+        self._views = {'trending': [], 'shared': []}
+        self._refreshed_at = None
+        self.version = 0  # goes up whenever the lists change, for the page's ETag
+
+    ## Counting
+
+    def add(self, title, artist, kind, n=1):
+        """Counts n saves or shares of the song; nothing is written until the next flush"""
+        score = math.log(n * self.weights[kind]) + (self.clock() - EPOCH) / self.tau
+        with self._lock:
+            entry = self._pending.setdefault((title, artist), [0, 0, None])
+            entry[KINDS.index(kind)] += n
+            entry[2] = log_add(entry[2], score)
+            self.stats['events'] += n
+        self.start()
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    ## Flushing
+
+    def start(self):
+        """Starts the flush thread the first time something is counted, so CLI commands never spawn it"""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='trending-flush')
+            self._thread.daemon = True
+            self._thread.start()
+        atexit.register(self._flush_in_context)  # what was counted since the last flush, on a clean shutdown
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_every)
+            self._flush_in_context()
+
+    def _flush_in_context(self):
+        with self.app.app_context():
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Flushing trending counters failed')
+            finally:
+                self.db.session.remove()
+
+    def flush(self):
+        """Writes the counters gathered since the last flush, batch_size songs per statement, and commits"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            rows = self._write(pending)
+        except Exception:
+            self.db.session.rollback()
+            self._restore(pending)  # tried again with the next flush
+            raise
+        self.stats['flushes'] += 1
+        self.stats['rows_flushed'] += rows
+        self._refreshed_at = None  # our own counts show on the next view
+        return rows
+
+    def _write(self, pending):
+        keys = list(pending)
+        rows = {}
+        for start in range(0, len(keys), self.batch_size):
+            ids = self.resolve(keys[start:start + self.batch_size])
+            for key in keys[start:start + self.batch_size]:
+                if key not in ids:
+                    self.stats['unknown_songs'] += 1  # not saved after all (or renamed); nothing to count against
+                    continue
+                saves, shares, score = pending[key]
+                row = rows.setdefault(ids[key], {'song_id': ids[key], 'saves': 0, 'shares': 0, 'score': None})
+                row['saves'] += saves
+                row['shares'] += shares
+                row['score'] = log_add(row['score'], score)
+        rows = list(rows.values())
+        statement = self._upsert()
+        for start in range(0, len(rows), self.batch_size):
+            self.db.session.execute(statement, rows[start:start + self.batch_size])
+        self.db.session.commit()
+        return len(rows)
+
+    def _restore(self, pending):
+        with self._lock:
+            for key, (saves, shares, score) in pending.items():
+                entry = self._pending.setdefault(key, [0, 0, None])
+                entry[0] += saves
+                entry[1] += shares
+                entry[2] = log_add(entry[2], score)
+
+    def _upsert(self):
+        """adds a row's counts to the stored ones; the new score is log_add(stored score, row score) in SQL"""
+        table = self.model.__tablename__
+        if self.db.session.get_bind().dialect.name == 'postgresql':
+            high, low = 'GREATEST', 'LEAST'
+        else:
+            high, low = 'MAX', 'MIN'
+            # SQLite only has ln() and exp() when it was built with its math functions
+            connection = self.db.session.connection().connection
+            connection.create_function('ln', 1, math.log)
+            connection.create_function('exp', 1, math.exp)
+        stored, new = table + '.score', 'excluded.score'
+        return self.db.text(
+            'INSERT INTO {t} (song_id, saves, shares, score) VALUES (:song_id, :saves, :shares, :score) '
+            'ON CONFLICT (song_id) DO UPDATE SET saves = {t}.saves + excluded.saves, '
+            'shares = {t}.shares + excluded.shares, '
+            'score = {high}({s}, {n}) + ln(1 + exp({low}({s}, {n}) - {high}({s}, {n})))'.format(
+                t=table, s=stored, n=new, high=high, low=low))
+
+    ## Reading
+
+    def heat(self, score, now=None):
+        """the decayed weighted count a score stands for right now"""
+        return math.exp(score - ((now or self.clock()) - EPOCH) / self.tau)
+
+    def refresh(self, force=False):
+        """reloads the top lists from song_stats when they are older than refresh_every"""
+        now = self.clock()
+        if not force and self._refreshed_at is not None and now - self._refreshed_at < self.refresh_every:
+            return
+        Stats = self.model
+        columns = (Stats.song_id, Stats.saves, Stats.shares, Stats.score)
+        trending = self.db.session.query(*columns).order_by(Stats.score.desc()).limit(self.top_n).all()
+        shared = self.db.session.query(*columns).filter(Stats.shares > 0)\
+            .order_by(Stats.shares.desc(), Stats.score.desc()).limit(self.top_n).all()
+        names = self.describe(set(row.song_id for row in trending + shared))
+        views = {}
+        for name, rows in (('trending', trending), ('shared', shared)):
+            views[name] = [TrendingSong(row.song_id, *names[row.song_id], saves=row.saves, shares=row.shares,
+                                        heat=self.heat(row.score, now))
+                           for row in rows if row.song_id in names]
+        # heat decays at the same rate for every song, so the order from the score index stays right
+        if self._shown(views) != self._shown(self._views):
+            self.version += 1
+        self._views = views
+        self._refreshed_at = now
+        self.stats['refreshes'] += 1
+
+    def _shown(self, views):
+        return dict((name, [song._replace(heat=round(song.heat, 1)) for song in songs]) for name, songs in views.items())
+
+    def top(self, view='trending', limit=None):
+        """TrendingSongs for 'trending' (by decayed activity) or 'shared' (most shared ever), best first"""
+        self.refresh()
+        return self._views[view][:limit or self.top_n]